@@ -0,0 +1,491 @@
+"""Per-request cost of dependency resolution on the app/main.py routes.
+
+Run from the repository root:
+
+    python -m app.bench --requests 5000 --rounds 5
+    python -m app.bench startup --rounds 5
+    python -m app.bench openapi --routes 500
+
+Each route is requested through the ASGI interface, once on app/main.py as
+it is (GraphRoute) and once on a copy of it with FastAPI's own APIRoute.
+"startup" times importing the apps in a fresh interpreter, like a new
+worker does, with -X importtime's numbers summed up by package, and for
+app.main until its lifespan has started and the first request is served. "openapi"
+times the first GET /openapi.json of a big app, FastAPI's own and cached.
+"""
+
+import argparse
+import asyncio
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Annotated
+
+from fastapi import Depends, FastAPI
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+
+from .dependency_graph import ConcurrentRoute, GraphRoute, plans
+from .lazy import load_all
+from .main import app
+from .openapi_cache import cache_openapi
+from .scopes import Depends as ScopedDepends
+from .scopes import scoped_lifespan
+
+TOKEN = {"x-token": "fake-super-secret-token"}
+CASES = {
+    "GET /": ("GET", "/", {}),
+    "GET /users/{username}": ("GET", "/users/rick", {}),
+    "GET /items/{item_id}": ("GET", "/items/plumbus", TOKEN),
+    "PUT /items/{item_id}": ("PUT", "/items/plumbus", TOKEN),
+    "POST /admin/": ("POST", "/admin/", TOKEN),
+    "GET /items/{item_id}, 400": ("GET", "/items/plumbus", {"x-token": "wrong"}),
+}
+
+
+def stock_copy(app: FastAPI) -> FastAPI:
+    """``app`` with the same routes and dependencies on APIRoute."""
+    stock = FastAPI()
+    for route in app.routes:
+        if isinstance(route, APIRoute):
+            stock.router.add_api_route(
+                route.path,
+                route.endpoint,
+                methods=route.methods,
+                dependencies=route.dependencies,
+                route_class_override=APIRoute,
+            )
+    return stock
+
+
+def io_apps(delay: float) -> dict[str, FastAPI]:
+    """Independent dependencies that each wait ``delay`` seconds, like a lookup.
+
+    GET / has two plain ones, like global-dependencies.py's verify_token and
+    verify_key doing token introspection. GET /yield has two with yield
+    that wait before their yield, like opening a DB session, and a third
+    using both.
+    """
+
+    async def introspect_token():
+        await asyncio.sleep(delay)
+        return "rick"
+
+    async def lookup_key():
+        await asyncio.sleep(delay)
+        return ["items:read"]
+
+    async def session():
+        await asyncio.sleep(delay)
+        try:
+            yield "session"
+        finally:
+            await asyncio.sleep(0)
+
+    async def cache():
+        await asyncio.sleep(delay)
+        try:
+            yield "cache"
+        finally:
+            await asyncio.sleep(0)
+
+    async def repository(
+        session: Annotated[str, Depends(session)], cache: Annotated[str, Depends(cache)]
+    ):
+        yield (session, cache)
+
+    apps = {}
+    for route_class in (APIRoute, GraphRoute, ConcurrentRoute):
+        io_app = apps[route_class.__name__] = FastAPI()
+        io_app.router.route_class = route_class
+
+        @io_app.get("/", dependencies=[Depends(introspect_token), Depends(lookup_key)])
+        async def read():
+            return {}
+
+        @io_app.get("/yield")
+        async def read_yield(repository: Annotated[tuple, Depends(repository)]):
+            return repository
+
+    return apps
+
+
+def scope_apps() -> dict[str, FastAPI]:
+    """Routes whose dependencies are built per request, or once with a scope."""
+    import httpx
+
+    items = [{"item_name": f"Item {n}", "price": n} for n in range(10_000)]
+
+    class ItemIndex:
+        def __init__(self):
+            self.by_name = {item["item_name"].lower(): item for item in items}
+
+    async def get_client():
+        async with httpx.AsyncClient(base_url="http://upstream") as client:
+            yield client
+
+    apps = {}
+    for scope in ("request", "app"):
+        scope_app = apps[scope] = FastAPI(lifespan=scoped_lifespan)
+
+        @scope_app.get("/client")
+        async def read_client(
+            client: Annotated[httpx.AsyncClient, ScopedDepends(get_client, scope=scope)]
+        ):
+            return str(client.base_url)
+
+        @scope_app.get("/index")
+        async def read_index(
+            index: Annotated[ItemIndex, ScopedDepends(ItemIndex, scope=scope)]
+        ):
+            return index.by_name["item 42"]
+
+    return apps
+
+
+async def peak_allocated(app, path: str, requests: int = 20) -> float:
+    """Median of the peak bytes allocated while serving one request."""
+    import statistics
+    import tracemalloc
+
+    await drive(app, 3, "GET", path, {})
+    tracemalloc.start()
+    peaks = []
+    try:
+        for _ in range(requests):
+            # An idle worker thread holds on to the last thing it returned,
+            # give it something else so the previous request's is freed.
+            await run_in_threadpool(int)
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            await drive(app, 1, "GET", path, {})
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return statistics.median(peaks)
+
+
+async def drive(app, requests: int, method: str, path: str, headers: dict) -> float:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"token=jessica",
+        "root_path": "",
+        "headers": [(b"host", b"bench"), *((k.encode(), v.encode()) for k, v in headers.items())],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+async def main(args):
+    load_all(app)
+    for route, stages in plans(app).items():
+        print(f"{route:<24} {' -> '.join(', '.join(stage) for stage in stages)}")
+    print()
+    apps = {"APIRoute": stock_copy(app), "GraphRoute": app}
+    for case, (method, path, headers) in CASES.items():
+        # Best of a few rounds, taking turns, so both see the same noise.
+        best = {name: float("inf") for name in apps}
+        for _ in range(args.rounds):
+            for name, variant in apps.items():
+                per_request = await drive(variant, args.requests, method, path, headers)
+                best[name] = min(best[name], per_request)
+        for name, per_request in best.items():
+            print(f"{case:<28} {name:<12} {per_request * 1e6:8.2f} us/request")
+    print(f"\nIndependent dependencies waiting {args.delay * 1e3:g} ms each")
+    for path in ("/", "/yield"):
+        for name, variant in io_apps(args.delay).items():
+            requests = max(10, args.requests // 25)
+            per_request = await drive(variant, requests, "GET", path, {})
+            print(f"{'GET ' + path:<28} {name:<16} {per_request * 1e3:8.2f} ms/request")
+
+    print("\nScoped dependencies, built per request or once (scope=\"app\")")
+    for name, scope_app in scope_apps().items():
+        async with scoped_lifespan(scope_app):
+            for path in ("/client", "/index"):
+                requests = max(10, args.requests // 25)
+                per_request = await drive(scope_app, requests, "GET", path, {})
+                allocated = await peak_allocated(scope_app, path)
+                print(
+                    f"{'GET ' + path:<28} {name:<16} {per_request * 1e6:10.1f} us/request"
+                    f" {allocated / 1024:10.1f} KiB allocated/request"
+                )
+
+
+# A worker's first request: app.main imported, its lifespan started (which
+# is when startup handlers load anything) and GET / served.
+FIRST_REQUEST = """
+import asyncio
+import app.main
+
+async def serve_first_request(app):
+    events = asyncio.Queue()
+    await events.put({"type": "lifespan.startup"})
+    sent = asyncio.Queue()
+    lifespan = asyncio.create_task(
+        app({"type": "lifespan", "asgi": {"version": "3.0"}}, events.get, sent.put)
+    )
+    assert (await sent.get())["type"] == "lifespan.startup.complete"
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": "/",
+        "raw_path": b"/",
+        "query_string": b"token=jessica",
+        "root_path": "",
+        "headers": [(b"host", b"bench")],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    assert messages[0]["status"] == 200
+    await events.put({"type": "lifespan.shutdown"})
+    await lifespan
+
+asyncio.run(serve_first_request(app.main.app))
+"""
+
+# What a worker imports, sql_app only if it's importable as a package.
+STARTUP_CASES = {
+    "app.main": "import app.main",
+    "app.main, first request": FIRST_REQUEST,
+    # -X importtime doesn't see importlib.import_module(), so LazyRouter's
+    # imports, import them by name first to have them in the breakdown.
+    "app.main, routers loaded": (
+        "import app.main, app.routers.users, app.routers.items, app.internal.admin; "
+        "from app.lazy import load_all; load_all(app.main.app)"
+    ),
+    "sql_app.main": "import sql_app.main",
+    "sql_app.main + init_db()": "import sql_app.main; sql_app.models.init_db()",
+}
+
+
+def run_python(code: str, cwd: str, *flags: str) -> subprocess.CompletedProcess:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_times(code: str, cwd: str) -> list[tuple[str, int, int]]:
+    """(module, self us, cumulative us) for everything ``code`` imports."""
+    rows = []
+    for line in run_python(code, cwd, "-X", "importtime").stderr.splitlines():
+        if line.startswith("import time:") and "self [us]" not in line:
+            own, cumulative, name = line[len("import time:") :].split("|")
+            rows.append((name.strip(), int(own), int(cumulative)))
+    return rows
+
+
+def startup(args):
+    own_packages = ("app", "sql_app")
+    for case, code in STARTUP_CASES.items():
+        if case.startswith("sql_app") and importlib.util.find_spec("sql_app") is None:
+            print(f"{case}: skipped, sql_app isn't importable from here\n")
+            continue
+        with tempfile.TemporaryDirectory() as tmp:
+            # Fresh interpreters, the database (if any) in a temp directory.
+            timer = f"import time\nstart = time.perf_counter()\n{code}\n"
+            timer += "print(time.perf_counter() - start)"
+            wall = min(
+                float(run_python(timer, tmp).stdout.split()[-1]) for _ in range(args.rounds)
+            )
+            rows = import_times(code, tmp)
+        by_package = {}
+        for name, own, _ in rows:
+            package = name.split(".")[0]
+            by_package[package] = by_package.get(package, 0) + own
+        print(f"{case:<28} {wall * 1e3:8.1f} ms  (best of {args.rounds})")
+        top = sorted(by_package.items(), key=lambda item: -item[1])[:6]
+        print("  slowest packages, self time of their modules:")
+        for package, own in top:
+            print(f"    {package:<32} {own / 1e3:8.1f} ms")
+        print("  this repository's modules:")
+        for name, own, cumulative in rows:
+            if name.split(".")[0] in own_packages:
+                print(f"    {name:<32} {own / 1e3:8.1f} ms self {cumulative / 1e3:8.1f} ms total")
+        print()
+
+
+def openapi_app(routes: int) -> FastAPI:
+    """``routes`` routes with tags, summaries, models and extra responses."""
+    from pydantic import BaseModel
+
+    openapi_app = FastAPI(title="Bench", version="1.0.0")
+    models = []
+    for n in range(max(1, routes // 10)):
+        image = type(f"Image{n}", (BaseModel,), {"__annotations__": {"url": str, "name": str}})
+        annotations = {"name": str, "price": float, "tax": float | None, "images": list[image]}
+        models.append(
+            type(f"Item{n}", (BaseModel,), {"__annotations__": annotations, "tax": None})
+        )
+
+    for n in range(routes):
+        model = models[n % len(models)]
+
+        async def endpoint(item_id: int, item: model, q: str | None = None) -> model:
+            return item
+
+        openapi_app.put(
+            f"/group{n % 20}/items{n}/{{item_id}}",
+            tags=[f"group{n % 20}"],
+            summary=f"Update item {n}",
+            responses={418: {"description": "I'm a teapot"}},
+            deprecated=n % 7 == 0,
+        )(endpoint)
+    return openapi_app
+
+
+async def get(app, path: str, headers: dict | None = None) -> tuple[float, int, bytes]:
+    """Seconds, status and body of one GET ``path``."""
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(k.encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    elapsed = time.perf_counter() - start
+    return elapsed, messages[0]["status"], b"".join(m.get("body", b"") for m in messages[1:])
+
+
+async def longest_stall(until) -> float:
+    """Longest the event loop couldn't run anything else until ``until`` is done.
+
+    That's how long a request arriving meanwhile, to any route, waits.
+    """
+    longest = 0.0
+    while not until.done():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        longest = max(longest, time.perf_counter() - start - 0.001)
+    return longest
+
+
+async def bench_openapi(args):
+    gzip_header = {"accept-encoding": "gzip"}
+    rows = []
+
+    # FastAPI's own: built on the first request, on the event loop.
+    stock = openapi_app(args.routes)
+    first = asyncio.ensure_future(get(stock, "/openapi.json"))
+    stall = await longest_stall(first)
+    elapsed, _, body = await first
+    warm = min([(await get(stock, "/openapi.json"))[0] for _ in range(20)])
+    rows.append(("FastAPI, first request", elapsed, stall, len(body)))
+    rows.append(("FastAPI, later requests", warm, None, len(body)))
+
+    # Cached: built on a thread from startup, first request right away.
+    cached = openapi_app(args.routes)
+    cache = cache_openapi(cached)
+    start = time.perf_counter()
+    await cached.router.startup()
+    ready = asyncio.wrap_future(cache.start())
+    first = asyncio.ensure_future(get(cached, "/openapi.json", gzip_header))
+    stall = await longest_stall(ready)
+    elapsed, _, gzipped = await first
+    rows.append(("cached, request at startup", elapsed, stall, len(gzipped)))
+    rows.append(("cached, ready after startup", time.perf_counter() - start, None, None))
+    cached = openapi_app(args.routes)
+    cache = cache_openapi(cached)
+    cache.start().result()
+    elapsed, _, gzipped = await get(cached, "/openapi.json", gzip_header)
+    rows.append(("cached, first request once ready", elapsed, None, len(gzipped)))
+    elapsed, _, body = await get(cached, "/openapi.json")
+    rows.append(("cached, not gzipped", elapsed, None, len(body)))
+    etag = {"if-none-match": cache.etag, **gzip_header}
+    elapsed, status, _ = await get(cached, "/openapi.json", etag)
+    assert status == 304
+    rows.append(("cached, If-None-Match: 304", elapsed, None, 0))
+
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "openapi.json.gz")
+        cache_openapi(openapi_app(args.routes), path=path).start().result()
+        # Same code again, like the next worker or deployment.
+        same = openapi_app(args.routes)
+        start = time.perf_counter()
+        cache_openapi(same, path=path).start().result()
+        rows.append(("cached, read from file", time.perf_counter() - start, None, None))
+
+    print(f"{args.routes} routes, GET /openapi.json")
+    for case, elapsed, stall, size in rows:
+        line = f"{case:<34} {elapsed * 1e3:9.2f} ms"
+        if size is not None:
+            line += f" {size / 1024:8.1f} KiB"
+        if stall is not None:
+            line += f"   event loop blocked up to {stall * 1e3:.2f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "benchmark", choices=("requests", "startup", "openapi"), nargs="?", default="requests"
+    )
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--delay", type=float, default=0.005)
+    parser.add_argument("--routes", type=int, default=500)
+    args = parser.parse_args()
+    if args.benchmark == "startup":
+        startup(args)
+    elif args.benchmark == "openapi":
+        asyncio.run(bench_openapi(args))
+    else:
+        asyncio.run(main(args))
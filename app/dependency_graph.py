@@ -0,0 +1,681 @@
+# Dependencies resolved from a plan compiled when the route is set up.
+
+# FastAPI's solve_dependencies walks a route's dependency tree recursively on
+# every request: for each dependency it looks up the overrides, reads all
+# four parameter locations and merges the results into dicts, and two uses
+# of the same callable only share a result when their security scopes match
+# too, even if the callable never looks at them (get_token_header added at
+# router level and again at include time, under Security(...) somewhere).
+#
+# GraphRoute flattens the tree once into a Plan: one Node per distinct
+# dependency, in topological order and grouped into stages, each stage only
+# needing the results of earlier ones. A request runs the stages in order.
+# Calls that can't wait on anything (an async def without await) run right
+# away, one after the other, the ones that can (await, threadpool) run
+# concurrently. As with FastAPI, a dependency with invalid parameters is
+# skipped, with whatever depends on it, the others still run, so one raising
+# HTTPException (a token check) wins over the 422, which is raised at the
+# end with all the errors, the body's included: FastAPI only reads the body,
+# the plan validates it after the dependencies, as solve_dependencies does.
+# route.plan.describe() shows the stages.
+#
+# ConcurrentRoute enters the yield dependencies of a stage concurrently as
+# well. Their exit code still runs in the reverse of plan order, dependants
+# before what they depend on, whichever finished entering first.
+
+import asyncio
+import dis
+import time
+from contextlib import asynccontextmanager, contextmanager
+from copy import copy
+from dataclasses import dataclass
+from typing import Any
+
+import anyio
+from fastapi import BackgroundTasks, Response, params
+from fastapi.dependencies.models import Dependant
+from fastapi.dependencies.utils import (
+    is_async_gen_callable,
+    is_coroutine_callable,
+    is_gen_callable,
+    request_body_to_args,
+    request_params_to_args,
+    solve_generator,
+)
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from fastapi.security import SecurityScopes
+from fastapi.utils import create_response_field
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+# Dependant attribute -> the Request attribute those parameters are read from.
+LOCATIONS = (
+    ("path_params", "path_params"),
+    ("query_params", "query_params"),
+    ("header_params", "headers"),
+    ("cookie_params", "cookies"),
+)
+
+
+@dataclass(eq=False)
+class Node:
+    """One call of a plan, a dependency or, last, the endpoint."""
+
+    dependant: Dependant
+    index: int
+    stage: int
+    # "async", "sync" (run in the threadpool) or "generator" (yield).
+    kind: str
+    # (parameter name, index of the node whose result it gets)
+    arguments: tuple
+    # Indexes of all the nodes it depends on, named or not.
+    requires: tuple
+    # Whether calling it can suspend, False for an async def without await.
+    waits: bool
+    # (fields, Request attribute to read them from), only the locations used.
+    params: tuple
+
+    @property
+    def name(self) -> str:
+        call = self.dependant.call
+        return getattr(call, "__name__", type(call).__name__)
+
+
+def reads_scopes(dependant: Dependant) -> bool:
+    """Whether security scopes can change anything in this dependency's tree."""
+    return bool(dependant.security_scopes_param_name) or any(
+        reads_scopes(sub) for sub in dependant.dependencies
+    )
+
+
+# Opcodes of await, async for and async with.
+AWAIT_OPCODES = {"GET_AWAITABLE", "GET_AITER", "GET_ANEXT", "BEFORE_ASYNC_WITH"}
+
+
+def can_wait(call) -> bool:
+    """Whether calling the coroutine function ``call`` can suspend."""
+    code = getattr(call, "__code__", None)
+    if code is None:
+        code = getattr(getattr(call, "__call__", None), "__code__", None)
+    if code is None:
+        return True
+    return any(instruction.opname in AWAIT_OPCODES for instruction in dis.get_instructions(code))
+
+
+def kind_of(call) -> str:
+    if is_gen_callable(call) or is_async_gen_callable(call):
+        return "generator"
+    return "async" if is_coroutine_callable(call) else "sync"
+
+
+@dataclass
+class Plan:
+    nodes: list[Node]
+    # The dependency nodes by stage, the endpoint (nodes[-1]) isn't in one.
+    stages: list[tuple[Node, ...]]
+    # False if a dependency reads the request body, those routes are
+    # resolved by FastAPI as usual.
+    compilable: bool
+    needs_response: bool
+    needs_background: bool
+    # Enter the yield dependencies of a stage concurrently too.
+    concurrent_generators: bool = False
+
+    @property
+    def endpoint(self) -> Node:
+        return self.nodes[-1]
+
+    def describe(self) -> list[list[str]]:
+        """Names of the calls, stage by stage, with the endpoint last."""
+        return [[node.name for node in stage] for stage in self.stages] + [[self.endpoint.name]]
+
+    async def run(
+        self,
+        request: Request,
+        response: Response | None = None,
+        background_tasks: BackgroundTasks | None = None,
+        body: Any = None,
+    ) -> dict[str, Any]:
+        """Run the dependencies, returns the endpoint's keyword arguments.
+
+        ``body`` is the request body as FastAPI read it (JSON, form or
+        bytes), the endpoint's body parameters are validated from it once
+        the dependencies have run.
+        """
+        errors = []
+        values = []
+        # Nodes with invalid parameters, or depending on one, aren't called.
+        failed = [False] * len(self.nodes)
+        for node in self.nodes:
+            node_values = {}
+            for fields, source in node.params:
+                found, found_errors = request_params_to_args(fields, getattr(request, source))
+                node_values.update(found)
+                if found_errors:
+                    errors += found_errors
+                    failed[node.index] = True
+            dependant = node.dependant
+            if dependant.request_param_name:
+                node_values[dependant.request_param_name] = request
+            if dependant.http_connection_param_name:
+                node_values[dependant.http_connection_param_name] = request
+            if dependant.response_param_name:
+                node_values[dependant.response_param_name] = response
+            if dependant.background_tasks_param_name:
+                node_values[dependant.background_tasks_param_name] = background_tasks
+            if dependant.security_scopes_param_name:
+                node_values[dependant.security_scopes_param_name] = SecurityScopes(
+                    scopes=dependant.security_scopes
+                )
+            values.append(node_values)
+
+        results = [None] * len(self.nodes)
+        stack = request.scope.get("fastapi_astack")
+        for stage in self.stages:
+            calls = []
+            for node in stage:
+                if failed[node.index] or any(failed[index] for index in node.requires):
+                    failed[node.index] = True
+                    continue
+                arguments = values[node.index]
+                for name, index in node.arguments:
+                    arguments[name] = results[index]
+                if node.kind == "generator" and not self.concurrent_generators:
+                    # Entered one at a time, so they are closed in the
+                    # reverse of plan order.
+                    results[node.index] = await solve_generator(
+                        call=node.dependant.call, stack=stack, sub_values=arguments
+                    )
+                elif not node.waits:
+                    # Runs to completion right here, a task would only cost.
+                    results[node.index] = await node.dependant.call(**arguments)
+                else:
+                    calls.append(node)
+            if not calls:
+                continue
+            entered = {}
+            try:
+                if len(calls) == 1:
+                    solved = [await call_node(calls[0], values[calls[0].index], entered)]
+                else:
+                    solved = await gather(
+                        [call_node(node, values[node.index], entered) for node in calls]
+                    )
+            finally:
+                # Closed with the request, failed or not, in the reverse of
+                # plan order rather than of the order they were entered in.
+                for node in calls:
+                    if node in entered:
+                        stack.push_async_exit(entered[node])
+            for node, result in zip(calls, solved):
+                results[node.index] = result
+
+        endpoint = self.endpoint
+        arguments = values[endpoint.index]
+        if endpoint.dependant.body_params:
+            found, body_errors = await request_body_to_args(endpoint.dependant.body_params, body)
+            arguments.update(found)
+            errors += body_errors
+        if errors:
+            raise RequestValidationError(errors, body=body)
+        for name, index in endpoint.arguments:
+            arguments[name] = results[index]
+        return arguments
+
+
+def call_node(node: Node, values: dict, entered: dict):
+    if node.kind == "generator":
+        return enter(node, values, entered)
+    if node.kind == "async":
+        return node.dependant.call(**values)
+    return run_in_threadpool(node.dependant.call, **values)
+
+
+class ThreadExit:
+    """__aexit__ for a sync context manager entered on a worker thread."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        # Its own limiter, so exiting never waits for a free thread.
+        self.limiter = anyio.CapacityLimiter(1)
+
+    async def __aexit__(self, *exc_info):
+        return bool(
+            await anyio.to_thread.run_sync(self.manager.__exit__, *exc_info, limiter=self.limiter)
+        )
+
+
+async def enter(node: Node, values: dict, entered: dict):
+    """Enter a yield dependency, leaving its exit to the caller."""
+    call = node.dependant.call
+    if is_gen_callable(call):
+        manager = contextmanager(call)(**values)
+
+        def enter_in_thread():
+            result = manager.__enter__()
+            entered[node] = ThreadExit(manager)
+            return result
+
+        # Cancelling the task doesn't stop the thread: wait for it to be
+        # done entering, so the caller can exit what it entered.
+        future = asyncio.ensure_future(run_in_threadpool(enter_in_thread))
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            await asyncio.gather(future, return_exceptions=True)
+            raise
+    manager = asynccontextmanager(call)(**values)
+    result = await manager.__aenter__()
+    entered[node] = manager
+    return result
+
+
+async def gather(coroutines: list) -> list:
+    """Run ``coroutines`` concurrently, the first one in the current task.
+
+    A task costs more than a dependency that doesn't wait on anything, so
+    one of them goes without. The others are cancelled if one fails, and
+    waited for: a dependency entering on a worker thread finishes doing so
+    regardless, and whatever got entered has to be exited.
+    """
+    first, *rest = coroutines
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in rest]
+    try:
+        results = [await first]
+        for task in tasks:
+            results.append(await task)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        # Their exceptions are retrieved, so none is logged as unhandled.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    return results
+
+
+def compile_plan(dependant: Dependant, concurrent_generators: bool = False) -> Plan:
+    """Flatten the dependency tree of a route's ``dependant`` into a Plan.
+
+    Dependencies with use_cache (the default) are shared by callable, and
+    by security scopes only where something in their tree reads them.
+    """
+    nodes: list[Node] = []
+    shared: dict = {}
+
+    def visit(dependant: Dependant, endpoint: bool = False) -> Node:
+        key = None
+        if not endpoint and dependant.use_cache:
+            key = dependant.cache_key if reads_scopes(dependant) else (dependant.call, ())
+            if key in shared:
+                return shared[key]
+        children = [(sub.name, visit(sub)) for sub in dependant.dependencies]
+        kind = "endpoint" if endpoint else kind_of(dependant.call)
+        node = Node(
+            dependant=dependant,
+            index=len(nodes),
+            stage=max((child.stage + 1 for _, child in children), default=0),
+            kind=kind,
+            arguments=tuple((name, child.index) for name, child in children if name),
+            requires=tuple(child.index for _, child in children),
+            waits=kind != "async" or can_wait(dependant.call),
+            params=tuple(
+                (getattr(dependant, attribute), source)
+                for attribute, source in LOCATIONS
+                if getattr(dependant, attribute)
+            ),
+        )
+        nodes.append(node)
+        if key is not None:
+            shared[key] = node
+        return node
+
+    visit(dependant, endpoint=True)
+    dependencies = nodes[:-1]
+    stages = [
+        tuple(node for node in dependencies if node.stage == stage)
+        for stage in range(max((node.stage for node in dependencies), default=-1) + 1)
+    ]
+    return Plan(
+        nodes=nodes,
+        stages=stages,
+        compilable=not any(node.dependant.body_params for node in dependencies),
+        needs_response=any(node.dependant.response_param_name for node in nodes),
+        needs_background=any(node.dependant.background_tasks_param_name for node in nodes),
+        concurrent_generators=concurrent_generators,
+    )
+
+
+class GraphRoute(APIRoute):
+    """APIRoute that resolves its dependencies from a compiled Plan.
+
+    Errors come out as with FastAPI: dependencies with valid parameters
+    run, an HTTPException one raises is the response, otherwise the 422
+    lists all the parameter errors. Requests made while
+    app.dependency_overrides is set, and routes with dependencies that
+    read the body, are resolved by FastAPI as usual.
+    """
+
+    concurrent_generators = False
+
+    def get_route_handler(self):
+        self.plan = compile_plan(self.dependant, self.concurrent_generators)
+        stock = super().get_route_handler()
+        if not self.plan.compilable:
+            return stock
+        plan = self.plan
+        endpoint = self.dependant.call
+        is_coroutine = asyncio.iscoroutinefunction(endpoint)
+
+        async def call(
+            _graph_request, _graph_response=None, _graph_background=None, _graph_body=None
+        ):
+            values = await plan.run(_graph_request, _graph_response, _graph_background, _graph_body)
+            if is_coroutine:
+                return await endpoint(**values)
+            return await run_in_threadpool(endpoint, **values)
+
+        # FastAPI still reads the body and builds the response, the plan
+        # does the rest. The body reaches it unvalidated through one
+        # parameter of type Any, so its errors come after the dependencies'.
+        route = copy(self)
+        raw_body = create_response_field(
+            name="_graph_body", type_=Any, required=False, field_info=params.Body(None)
+        )
+        route.dependant = Dependant(
+            call=call,
+            body_params=[raw_body] if self.dependant.body_params else [],
+            request_param_name="_graph_request",
+            response_param_name="_graph_response" if plan.needs_response else None,
+            background_tasks_param_name="_graph_background" if plan.needs_background else None,
+            name=self.dependant.name,
+            path=self.dependant.path,
+        )
+        graph = APIRoute.get_route_handler(route)
+        overrides = self.dependency_overrides_provider
+
+        async def app(request):
+            if overrides is not None and overrides.dependency_overrides:
+                return await stock(request)
+            return await graph(request)
+
+        return app
+
+
+class ConcurrentRoute(GraphRoute):
+    """GraphRoute that also enters independent yield dependencies concurrently.
+
+    Opt in where those dependencies wait on I/O before their yield (opening
+    a session, checking out a connection) and don't rely on running in the
+    request's own task: all but one of them are entered in a task of their
+    own, so context variables they set before the yield aren't seen by the
+    endpoint, and their exit code runs in another task than their entry.
+    """
+
+    concurrent_generators = True
+
+
+def plans(app) -> dict[str, list[list[str]]]:
+    """route.plan.describe() for every GraphRoute of ``app``, by "METHOD /path"."""
+    return {
+        f"{method} {route.path}": route.plan.describe()
+        for route in app.routes
+        if isinstance(route, GraphRoute)
+        for method in sorted(route.methods)
+    }
+
+
+def test_graph_route():
+    from typing import Annotated
+
+    from fastapi import Depends, FastAPI, Header, Security
+    from fastapi.testclient import TestClient
+
+    calls = []
+    both_started = asyncio.Event()
+    started = []
+
+    async def shared(x_token: Annotated[str, Header()]):
+        calls.append("shared")
+        return x_token
+
+    async def left(token: Annotated[str, Depends(shared)]):
+        started.append("left")
+        if len(started) == 2:
+            both_started.set()
+        # Only finishes if right() runs at the same time.
+        await asyncio.wait_for(both_started.wait(), 1)
+        return "left:" + token
+
+    async def right(token: Annotated[str, Security(shared, scopes=["items"])]):
+        started.append("right")
+        if len(started) == 2:
+            both_started.set()
+        await asyncio.wait_for(both_started.wait(), 1)
+        return "right:" + token
+
+    def sync_dep(q: int = 0):
+        return q * 2
+
+    def session():
+        calls.append("open")
+        yield "session"
+        calls.append("close")
+
+    app = FastAPI()
+    app.router.route_class = GraphRoute
+
+    @app.get("/items/{item_id}", dependencies=[Depends(shared)])
+    async def read_item(
+        item_id: int,
+        response: Response,
+        left: Annotated[str, Depends(left)],
+        right: Annotated[str, Depends(right)],
+        double: Annotated[int, Depends(sync_dep)],
+        db: Annotated[str, Depends(session)],
+    ):
+        response.headers["X-Item"] = str(item_id)
+        return {"item_id": item_id, "left": left, "right": right, "double": double, "db": db}
+
+    # One client for the whole test, so the requests share an event loop.
+    with TestClient(app) as client:
+        check_graph_route(app, client, calls, started, both_started, sync_dep, left, right)
+
+
+def check_graph_route(app, client, calls, started, both_started, sync_dep, left, right):
+    response = client.get("/items/3?q=4", headers={"X-Token": "t"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "item_id": 3, "left": "left:t", "right": "right:t", "double": 8, "db": "session"
+    }
+    assert response.headers["X-Item"] == "3"
+    # shared() ran once, for Depends and Security alike.
+    assert sorted(calls) == ["close", "open", "shared"]
+    route = next(route for route in app.routes if getattr(route, "path", "") == "/items/{item_id}")
+    assert route.plan.describe() == [
+        ["shared", "sync_dep", "session"], ["left", "right"], ["read_item"]
+    ]
+
+    # All parameter errors at once. As with FastAPI, what doesn't depend on
+    # an invalid parameter still runs, the 422 is thrown into the generator.
+    calls.clear()
+    response = client.get("/items/x?q=y")
+    assert response.status_code == 422
+    assert {error["loc"][-1] for error in response.json()["detail"]} == {"item_id", "q", "x-token"}
+    assert calls == ["open"]
+    # shared() has no await, it runs without a task.
+    assert [node.waits for node in route.plan.stages[0]] == [False, True, True]
+
+    # Overrides go through FastAPI's own resolution.
+    app.dependency_overrides.update({sync_dep: lambda: -1, left: lambda: "", right: lambda: ""})
+    assert client.get("/items/3", headers={"X-Token": "t"}).json()["double"] == -1
+    app.dependency_overrides.clear()
+
+
+def test_body_route():
+    from typing import Annotated
+
+    from fastapi import Depends, FastAPI, Header, HTTPException
+    from fastapi.testclient import TestClient
+    from pydantic import BaseModel
+
+    class Item(BaseModel):
+        name: str
+        price: float = 0
+
+    async def verify(x_token: Annotated[str, Header()] = ""):
+        if x_token != "secret":
+            raise HTTPException(status_code=401)
+
+    def make_app(route_class):
+        app = FastAPI()
+        app.router.route_class = route_class
+
+        @app.post("/items/{n}", dependencies=[Depends(verify)])
+        async def create_item(n: int, item: Item, q: int = 0):
+            return {"n": n, "q": q, "item": item}
+
+        return TestClient(app)
+
+    stock, graph = make_app(APIRoute), make_app(GraphRoute)
+    cases = [
+        ("/items/1?q=2", {"name": "Foo"}, "secret"),
+        # The token check wins over a bad body, as with APIRoute.
+        ("/items/1", {"price": "x"}, "wrong"),
+        # All the errors, the body's last.
+        ("/items/x?q=y", {"price": 1}, "secret"),
+        ("/items/1", None, "secret"),
+    ]
+    for path, body, token in cases:
+        expected = stock.post(path, json=body, headers={"X-Token": token})
+        response = graph.post(path, json=body, headers={"X-Token": token})
+        assert (response.status_code, response.json()) == (
+            expected.status_code, expected.json()
+        ), path
+    response = graph.post("/items/x?q=y", json={}, headers={"X-Token": "secret"})
+    assert [error["loc"] for error in response.json()["detail"]] == [
+        ["path", "n"], ["query", "q"], ["body", "name"]
+    ]
+    assert graph.post("/items/1", json={}, headers={"X-Token": "no"}).status_code == 401
+
+
+def test_concurrent_route():
+    from typing import Annotated
+
+    from fastapi import Depends, FastAPI, HTTPException
+    from fastapi.testclient import TestClient
+
+    events = []
+    started = []
+    both_started = asyncio.Event()
+
+    async def wait_for_both(name):
+        started.append(name)
+        if len(started) == 2:
+            both_started.set()
+        # Only returns if the other dependency is being entered meanwhile.
+        await asyncio.wait_for(both_started.wait(), 1)
+
+    async def session():
+        await wait_for_both("session")
+        # Done entering after cache(), but first in plan order.
+        await asyncio.sleep(0.01)
+        events.append("enter session")
+        try:
+            yield "session"
+        finally:
+            events.append("exit session")
+
+    async def cache():
+        await wait_for_both("cache")
+        events.append("enter cache")
+        try:
+            yield "cache"
+        finally:
+            events.append("exit cache")
+
+    async def repository(
+        session: Annotated[str, Depends(session)],
+        cache: Annotated[str, Depends(cache)],
+        fail: bool = False,
+    ):
+        if fail:
+            raise HTTPException(status_code=409)
+        yield f"{session}+{cache}"
+        events.append("exit repository")
+
+    app = FastAPI()
+    app.router.route_class = ConcurrentRoute
+
+    @app.get("/")
+    async def read(repository: Annotated[str, Depends(repository)]):
+        return repository
+
+    with TestClient(app) as client:
+        assert client.get("/").json() == "session+cache"
+        assert events == [
+            "enter cache",
+            "enter session",
+            "exit repository",
+            "exit cache",
+            "exit session",
+        ]
+        events.clear()
+        started.clear()
+        both_started.clear()
+        assert client.get("/?fail=true").status_code == 409
+        assert events == ["enter cache", "enter session", "exit cache", "exit session"]
+
+    # A sync yield dependency still entering on its thread when a sibling
+    # fails is exited all the same.
+    def sync_session():
+        time.sleep(0.05)
+        events.append("enter sync session")
+        try:
+            yield "session"
+        finally:
+            events.append("exit sync session")
+
+    async def broken():
+        await asyncio.sleep(0.01)
+        raise HTTPException(status_code=503)
+        yield
+
+    @app.get("/broken")
+    async def read_broken(
+        failure: Annotated[None, Depends(broken)],
+        session: Annotated[str, Depends(sync_session)],
+    ):
+        return session
+
+    events.clear()
+    with TestClient(app) as client:
+        assert client.get("/broken").status_code == 503
+    assert events == ["enter sync session", "exit sync session"]
+
+
+def test_bigger_application():
+    from fastapi.testclient import TestClient
+
+    from .main import app
+
+    client = TestClient(app)
+    token, header = "?token=jessica", {"X-Token": "fake-super-secret-token"}
+    assert client.get("/" + token).json() == {"message": "Hello Bigger Applications!"}
+    assert client.get("/").status_code == 422
+    assert client.get("/users/rick" + token).json() == {"username": "rick"}
+    assert client.get("/items/plumbus" + token, headers=header).json() == {
+        "name": "Plumbus",
+        "item_id": "plumbus",
+    }
+    assert client.get("/items/plumbus?token=rick", headers=header).status_code == 400
+    # The token check wins over the missing query token, as with APIRoute.
+    assert client.get("/items/plumbus", headers={"X-Token": "x"}).status_code == 400
+    assert client.get("/items/plumbus" + token, headers={"X-Token": "x"}).status_code == 400
+    assert client.get("/items/gun" + token).status_code == 422
+    assert client.put("/items/gun" + token, headers=header).status_code == 403
+    assert client.post("/admin/" + token, headers=header).status_code == 200
+    assert plans(app)["PUT /items/{item_id}"] == [
+        ["get_query_token", "get_token_header"],
+        ["update_item"],
+    ]
@@ -0,0 +1,174 @@
+# Routers imported on the first request that needs them.
+
+# app.include_router() needs the router, so every router module, with its
+# endpoints, schemas and whatever they import, is imported when main.py is,
+# in every worker, before the first request. include_lazy_router() puts a
+# LazyRouter in the route table instead, matching everything under the
+# router's path. The first request there imports the module, includes the
+# router as app.include_router() would and puts its routes where the
+# LazyRouter was, so the order of the routes stays the same, then routes
+# the request again. Building the OpenAPI schema loads them all first, and
+# so can load_all() in a lifespan to have them ready before serving.
+
+import importlib
+import threading
+
+from fastapi import FastAPI
+from starlette.routing import BaseRoute, Match, NoMatchFound
+
+
+class LazyRouter(BaseRoute):
+    def __init__(
+        self,
+        app: FastAPI,
+        module: str,
+        path: str,
+        package: str | None = None,
+        attribute: str = "router",
+        options: dict | None = None,
+    ):
+        self.app = app
+        self.module = module
+        self.package = package
+        self.attribute = attribute
+        self.options = options or {}
+        self.path = path.rstrip("/")
+        self.routes = None
+        self.lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.routes is not None else "not loaded"
+        return f"LazyRouter(path={self.path!r}, module={self.module!r}, {state})"
+
+    def load(self) -> list[BaseRoute]:
+        """Import the router and put its routes in place of this one."""
+        with self.lock:
+            if self.routes is not None:
+                return self.routes
+            module = importlib.import_module(self.module, self.package)
+            router = getattr(module, self.attribute)
+            routes = self.app.router.routes
+            start = len(routes)
+            self.app.include_router(router, **self.options)
+            added = routes[start:]
+            del routes[start:]
+            index = next(n for n, route in enumerate(routes) if route is self)
+            routes[index : index + 1] = added
+            self.routes = added
+            return added
+
+    def matches(self, scope):
+        if scope["type"] in ("http", "websocket"):
+            path = scope["path"]
+            if path == self.path or path.startswith(self.path + "/"):
+                return Match.FULL, {}
+        return Match.NONE, {}
+
+    async def handle(self, scope, receive, send):
+        self.load()
+        await self.app.router(scope, receive, send)
+
+    def url_path_for(self, name: str, **path_params):
+        for route in self.load():
+            try:
+                return route.url_path_for(name, **path_params)
+            except NoMatchFound:
+                pass
+        raise NoMatchFound(name, path_params)
+
+
+def load_all(app: FastAPI):
+    """Load every lazy router of ``app`` now."""
+    for route in list(app.router.routes):
+        if isinstance(route, LazyRouter):
+            route.load()
+
+
+def include_lazy_router(
+    app: FastAPI,
+    module: str,
+    *,
+    path: str | None = None,
+    package: str | None = None,
+    attribute: str = "router",
+    **options,
+) -> LazyRouter:
+    """app.include_router(module.router, **options), imported on first use.
+
+    ``path`` is where the router's routes are, "/users" for one with
+    routes /users/ and /users/{username}. It defaults to the ``prefix``
+    option. ``module`` can be relative to ``package``, like for
+    importlib.import_module().
+    """
+    path = path if path is not None else options.get("prefix")
+    if not path:
+        raise ValueError(f"include_lazy_router({module!r}) needs the path its routes are under")
+    route = LazyRouter(app, module, path, package, attribute, options)
+    app.router.routes.append(route)
+    if not getattr(app, "has_lazy_routers", False):
+        app.has_lazy_routers = True
+        openapi = app.openapi
+
+        def openapi_with_lazy_routers():
+            load_all(app)
+            return openapi()
+
+        app.openapi = openapi_with_lazy_routers
+    return route
+
+
+def test_lazy_router():
+    import os
+    import sys
+    import tempfile
+
+    from fastapi.testclient import TestClient
+
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "lazy_reports.py"), "w") as f:
+            f.write(
+                "from fastapi import APIRouter\n"
+                "router = APIRouter(prefix='/reports')\n"
+                "@router.get('/')\n"
+                "async def list_reports():\n"
+                "    return ['q1']\n"
+                "@router.get('/{report_id}')\n"
+                "async def read_report(report_id: int):\n"
+                "    return {'report_id': report_id}\n"
+            )
+        sys.path.insert(0, tmp)
+        try:
+            app = FastAPI()
+            route = include_lazy_router(app, "lazy_reports", tags=["reports"], path="/reports")
+
+            @app.get("/reports/{name}/raw")
+            async def shadowed(name: str):
+                return "not reached"
+
+            @app.get("/")
+            async def root():
+                return "root"
+
+            client = TestClient(app)
+            assert client.get("/").json() == "root"
+            assert "lazy_reports" not in sys.modules
+            assert client.get("/reports/7").json() == {"report_id": 7}
+            assert "lazy_reports" in sys.modules
+            # In the LazyRouter's place, before the routes added after it.
+            paths = [getattr(r, "path", None) for r in app.routes]
+            assert paths.index("/reports/{report_id}") < paths.index("/reports/{name}/raw")
+            assert route not in app.routes
+            assert client.get("/reports/").json() == ["q1"]
+            assert client.get("/reports/x/raw").json() == "not reached"
+            assert client.get("/nothing").status_code == 404
+
+            # OpenAPI and url_path_for load what's still missing.
+            app = FastAPI()
+            include_lazy_router(app, "lazy_reports", prefix="/v2")
+            assert "/v2/reports/{report_id}" in TestClient(app).get("/openapi.json").json()["paths"]
+            app = FastAPI()
+            include_lazy_router(app, "lazy_reports", prefix="/v3")
+            assert app.url_path_for("read_report", report_id=1) == "/v3/reports/1"
+        finally:
+            sys.path.remove(tmp)
+            sys.modules.pop("lazy_reports", None)
@@ -1,16 +1,26 @@
+import os
+
 from fastapi import Depends, FastAPI
 
 from .dependencies import get_query_token, get_token_header
-from .internal import admin
-from .routers import items, users
+from .dependency_graph import GraphRoute
+from .lazy import include_lazy_router
+from .openapi_cache import cache_openapi
 
 app = FastAPI(dependencies=[Depends(get_query_token)])
+# Dependencies are resolved from plans compiled at startup, see
+# dependency_graph.py. Included routers keep their own route_class.
+app.router.route_class = GraphRoute
 
 
-app.include_router(users.router)
-app.include_router(items.router)
-app.include_router(
-    admin.router,
+# The routers are imported on the first request under their path, or when
+# the OpenAPI schema is built, see lazy.py.
+include_lazy_router(app, ".routers.users", package=__package__, path="/users")
+include_lazy_router(app, ".routers.items", package=__package__, path="/items")
+include_lazy_router(
+    app,
+    ".internal.admin",
+    package=__package__,
     prefix="/admin",
     tags=["admin"],
     dependencies=[Depends(get_token_header)],
@@ -20,4 +30,11 @@ app.include_router(
 
 @app.get("/")
 async def root():
-    return {"message": "Hello Bigger Applications!"}
\ No newline at end of file
+    return {"message": "Hello Bigger Applications!"}
+
+
+# Built on a thread on the first GET /openapi.json, after the routes above,
+# and kept in OPENAPI_CACHE if that's set, see openapi_cache.py. Not at
+# startup: building it loads the lazy routers, which would all be imported
+# before the first request.
+cache_openapi(app, path=os.environ.get("OPENAPI_CACHE"), at_startup=False)
@@ -0,0 +1,380 @@
+# The OpenAPI schema, built in the background at startup and served as bytes.
+
+# FastAPI builds the schema on the first GET /openapi.json, on the event loop,
+# so that request, and every other one in the worker meanwhile, waits for all
+# the routes and models to be turned into JSON Schema. After that each request
+# json.dumps the same dict again. cache_openapi(app) instead builds it on a
+# thread when the app starts and keeps it as bytes, gzipped too, with an ETag:
+# a client sending If-None-Match with it gets a 304. A request coming before
+# it's ready waits for that build rather than starting another one.
+#
+# With path=..., the schema is also written to that file, under a fingerprint
+# of the routes and of the source of the modules they come from. The next
+# start of the same code, another worker or another instance of the same
+# deployment, reads it back instead of building it again.
+#
+# Behind a proxy, a request's root_path is added to the servers as FastAPI's
+# own route does (unless root_path_in_servers=False), from a copy of the
+# schema made once per root_path.
+#
+# Call it once the routes are set up, include_lazy_router() included: the
+# schema is built by app.openapi() as it is then. Lazy routers are loaded
+# when it starts, on the event loop, so the thread doesn't change the routes
+# under requests being routed and the fingerprint covers the models and
+# dependencies they import. Starting at startup loads them all before the
+# first request, which undoes the lazy imports: with at_startup=False it
+# starts on the first request for the schema instead. With a lifespan of
+# your own the startup handler isn't run, call cache.start() in the lifespan.
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import Future
+
+import fastapi
+from fastapi import FastAPI
+from fastapi.openapi.utils import get_flat_models_from_routes
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+
+from .lazy import load_all
+
+
+def dumps(schema: dict) -> bytes:
+    # The bytes FastAPI's own JSONResponse would send.
+    return json.dumps(
+        schema, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    ).encode("utf-8")
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def with_server(schema: dict, url: str) -> dict:
+    """``schema`` with ``url`` first in its servers, where get_openapi() puts them."""
+    servers = [{"url": url}, *schema.get("servers", [])]
+    copy = {}
+    for key, value in schema.items():
+        if key != "servers":
+            copy[key] = value
+        if key == "info":
+            copy["servers"] = servers
+    return copy
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    return any(tag.strip() in ("*", etag, "W/" + etag) for tag in if_none_match.split(","))
+
+
+def source_modules(route) -> set[str]:
+    """Modules whose code shapes the schema of ``route``."""
+    if not isinstance(route, APIRoute):
+        return set()
+    modules = set()
+    dependants = [route.dependant]
+    while dependants:
+        dependant = dependants.pop()
+        modules.add(getattr(dependant.call, "__module__", None))
+        dependants.extend(dependant.dependencies)
+    return modules
+
+
+def fingerprint(app: FastAPI) -> str:
+    """Hash of what the schema is built from.
+
+    The app's OpenAPI settings, its routes, and the source files of the
+    modules defining their endpoints, dependencies and models, so editing
+    any of those changes it. Lazy routers are loaded first, to see theirs.
+    """
+    load_all(app)
+    digest = hashlib.sha256()
+    settings = (
+        fastapi.__version__,
+        app.title,
+        app.version,
+        app.openapi_version,
+        app.summary,
+        app.description,
+        app.terms_of_service,
+        app.contact,
+        app.license_info,
+        app.openapi_tags,
+        app.servers,
+    )
+    digest.update(repr(settings).encode())
+    modules = set()
+    for route in app.routes:
+        digest.update(repr(route).encode())
+        modules |= source_modules(route)
+    api_routes = [route for route in app.routes if isinstance(route, APIRoute)]
+    modules |= {model.__module__ for model in get_flat_models_from_routes(api_routes)}
+    for name in sorted(filter(None, modules)):
+        filename = getattr(sys.modules.get(name), "__file__", None)
+        if filename and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+class OpenAPICache:
+    """The schema of ``app`` as bytes, gzipped bytes and an ETag."""
+
+    def __init__(self, app: FastAPI, path: str | None = None):
+        self.app = app
+        self.path = path
+        self.generate = app.openapi
+        self.lock = threading.Lock()
+        self.future: Future | None = None
+        self.body: bytes | None = None
+        self.gzipped: bytes | None = None
+        self.etag: str | None = None
+        self.schema_dict: dict | None = None
+        # root_path -> (body, gzipped, etag) with it in the servers
+        self.variants: dict[str, tuple[bytes, bytes, str]] = {}
+        self.server_urls = {server.get("url") for server in app.servers} - {None}
+
+    def start(self) -> Future:
+        """Build the schema on a thread, unless it's built or being built."""
+        with self.lock:
+            if self.future is not None:
+                return self.future
+            future = self.future = Future()
+        try:
+            # Here, on the event loop at startup, not on the thread.
+            load_all(self.app)
+            key = fingerprint(self.app) if self.path else None
+        except BaseException as exc:
+            self.fail(future, exc)
+            return future
+        threading.Thread(
+            target=self.run, args=(future, key), name="openapi-cache", daemon=True
+        ).start()
+        return future
+
+    def run(self, future: Future, key: str | None):
+        try:
+            self.build(key)
+        except BaseException as exc:
+            self.fail(future, exc)
+            return
+        future.set_result(self)
+
+    def fail(self, future: Future, exc: BaseException):
+        with self.lock:
+            # The waiting requests fail, the next one tries again.
+            self.future = None
+        future.set_exception(exc)
+
+    def build(self, key: str | None = None):
+        gzipped = self.read(key) if key else None
+        if gzipped is None:
+            body = dumps(self.generate())
+            gzipped = gzip.compress(body, mtime=0)
+            if key:
+                self.write(key, gzipped)
+        else:
+            body = gzip.decompress(gzipped)
+        self.etag = make_etag(body)
+        self.gzipped = gzipped
+        self.body = body
+
+    def read(self, key: str) -> bytes | None:
+        try:
+            with open(self.path, "rb") as f:
+                stored, _, gzipped = f.read().partition(b"\n")
+        except OSError:
+            return None
+        return gzipped if stored == key.encode() else None
+
+    def write(self, key: str, gzipped: bytes):
+        # Other workers may be writing the same file, each replaces it whole.
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(key.encode() + b"\n" + gzipped)
+        os.replace(tmp, self.path)
+
+    def schema(self) -> dict:
+        """What app.openapi() returns, waiting for the build if needed."""
+        if self.schema_dict is None:
+            self.start().result()
+            self.schema_dict = json.loads(self.body)
+        return self.schema_dict
+
+    def variant(self, root_path: str) -> tuple[bytes, bytes, str]:
+        """The schema with ``root_path`` in its servers."""
+        variant = self.variants.get(root_path)
+        if variant is None:
+            body = dumps(with_server(json.loads(self.body), root_path))
+            variant = (body, gzip.compress(body, mtime=0), make_etag(body))
+            self.variants[root_path] = variant
+        return variant
+
+    async def endpoint(self, request: Request) -> Response:
+        if self.body is None:
+            await asyncio.wrap_future(self.start())
+        body, gzipped, etag = self.body, self.gzipped, self.etag
+        root_path = request.scope.get("root_path", "").rstrip("/")
+        if root_path and self.app.root_path_in_servers and root_path not in self.server_urls:
+            body, gzipped, etag = self.variants.get(root_path) or await run_in_threadpool(
+                self.variant, root_path
+            )
+        headers = {"etag": etag, "cache-control": "no-cache", "vary": "Accept-Encoding"}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["content-encoding"] = "gzip"
+            return Response(gzipped, media_type="application/json", headers=headers)
+        return Response(body, media_type="application/json", headers=headers)
+
+
+def cache_openapi(
+    app: FastAPI, *, path: str | None = None, at_startup: bool = True
+) -> OpenAPICache:
+    """Serve app.openapi_url from an OpenAPICache built at startup.
+
+    ``path`` is a file to keep the schema in between starts. With
+    ``at_startup=False`` it's built on the first request for it.
+    """
+    if not app.openapi_url:
+        raise ValueError("the app has no openapi_url to serve the schema on")
+    cache = OpenAPICache(app, path)
+    app.state.openapi_cache = cache
+    app.openapi = cache.schema
+    routes = app.router.routes
+    for index, route in enumerate(routes):
+        if isinstance(route, Route) and route.path == app.openapi_url:
+            routes[index] = Route(app.openapi_url, cache.endpoint, include_in_schema=False)
+    if at_startup:
+        app.router.on_startup.append(cache.start)
+    return cache
+
+
+def test_openapi_cache():
+    import tempfile
+
+    from fastapi.testclient import TestClient
+    from pydantic import BaseModel
+
+    class Item(BaseModel):
+        name: str
+        price: float
+
+    def make_app(extra_route=False, servers=None):
+        app = FastAPI(title="ChimichangApp", version="0.0.1", servers=servers)
+
+        @app.post("/items/", response_model=Item, tags=["items"], summary="Create an item")
+        async def create_item(item: Item):
+            return item
+
+        @app.get("/elements/", tags=["items"], deprecated=True)
+        async def read_elements():
+            return [{"item_id": "Foo"}]
+
+        @app.get("/teapot/", responses={418: {"description": "I'm a teapot"}})
+        async def teapot():
+            return "ñ"
+
+        if extra_route:
+
+            @app.get("/users/")
+            async def read_users():
+                return []
+
+        return app
+
+    expected = TestClient(make_app()).get("/openapi.json")
+    app = make_app()
+    cache = cache_openapi(app)
+    with TestClient(app) as client:
+        assert cache.start().result(timeout=10) is cache
+        response = client.get("/openapi.json")
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.content == expected.content
+        assert response.json()["paths"]["/elements/"]["get"]["deprecated"] is True
+        etag = response.headers["etag"]
+        plain = client.get("/openapi.json", headers={"accept-encoding": "identity"})
+        assert "content-encoding" not in plain.headers and plain.content == expected.content
+        not_modified = client.get("/openapi.json", headers={"if-none-match": f'W/"x", {etag}'})
+        assert not_modified.status_code == 304 and not_modified.content == b""
+        assert not_modified.headers["etag"] == etag
+        assert client.get("/openapi.json", headers={"if-none-match": '"x"'}).status_code == 200
+    assert app.openapi() == expected.json()
+
+    # Behind a proxy: the root_path in the servers, as FastAPI does it.
+    for servers in (None, [{"url": "/api"}], [{"url": "https://example.com"}]):
+        app = make_app(servers=servers)
+        cache_openapi(app)
+        for root_path in ("", "/api"):
+            stock = TestClient(make_app(servers=servers), root_path=root_path)
+            response = TestClient(app, root_path=root_path).get("/openapi.json")
+            assert response.content == stock.get("/openapi.json").content
+            assert response.headers["etag"] == make_etag(response.content)
+
+    # Without the startup handler, the first request builds it.
+    app = make_app()
+    cache_openapi(app)
+    assert TestClient(app).get("/openapi.json").content == expected.content
+    app = make_app()
+    cache = cache_openapi(app, at_startup=False)
+    with TestClient(app) as client:
+        assert cache.future is None
+        assert client.get("/openapi.json").content == expected.content
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "openapi.json.gz")
+        cache_openapi(make_app(), path=path).start().result(timeout=10)
+        # Same code, read back from the file instead of built.
+        cache = cache_openapi(make_app(), path=path)
+        cache.generate = None
+        cache.start().result(timeout=10)
+        assert cache.body == expected.content
+        # Another route, another fingerprint: built again.
+        app = make_app(extra_route=True)
+        assert "/users/" in cache_openapi(app, path=path).schema()["paths"]
+
+        # A model a lazy router imports changes: built again.
+        from .lazy import include_lazy_router
+
+        package = os.path.join(tmp, "cached_pkg")
+        os.mkdir(package)
+        with open(os.path.join(package, "__init__.py"), "w") as f:
+            f.write("")
+        with open(os.path.join(package, "routes.py"), "w") as f:
+            f.write(
+                "from fastapi import APIRouter\n"
+                "from .models import Report\n"
+                "router = APIRouter()\n"
+                "@router.get('/reports/')\n"
+                "async def read_reports() -> list[Report]:\n"
+                "    return []\n"
+            )
+        sys.path.insert(0, tmp)
+        try:
+            for fields in (["title"], ["title", "author"]):
+                with open(os.path.join(package, "models.py"), "w") as f:
+                    f.write("from pydantic import BaseModel\nclass Report(BaseModel):\n")
+                    f.writelines(f"    {field}: str\n" for field in fields)
+                for name in ("cached_pkg", "cached_pkg.models", "cached_pkg.routes"):
+                    sys.modules.pop(name, None)
+                app = FastAPI()
+                include_lazy_router(app, "cached_pkg.routes", path="/reports")
+                cache_openapi(app, path=path, at_startup=False)
+                with TestClient(app) as client:
+                    # Not loaded by the startup, by the first schema request.
+                    assert "cached_pkg.routes" not in sys.modules
+                    schema = client.get("/openapi.json").json()
+                assert list(schema["components"]["schemas"]["Report"]["properties"]) == fields
+        finally:
+            sys.path.remove(tmp)
+            for name in ("cached_pkg", "cached_pkg.models", "cached_pkg.routes"):
+                sys.modules.pop(name, None)
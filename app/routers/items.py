@@ -1,12 +1,14 @@
 from fastapi import APIRouter, Depends, HTTPException
 
 from ..dependencies import get_token_header
+from ..dependency_graph import GraphRoute
 
 router = APIRouter(
     prefix="/items",
     tags=["items"],
     dependencies=[Depends(get_token_header)],
-    responses={404: {"description": "Not found"}}
+    responses={404: {"description": "Not found"}},
+    route_class=GraphRoute,
 )
 
 
@@ -1,6 +1,8 @@
 from fastapi import APIRouter
 
-router = APIRouter()
+from ..dependency_graph import GraphRoute
+
+router = APIRouter(route_class=GraphRoute)
 
 
 @router.get("/users/", tags=["users"])
@@ -0,0 +1,409 @@
+# Dependencies built once and shared, instead of once per request.
+
+# FastAPI calls a dependency for every request that needs it. That's right for
+# anything holding request data (CommonQueryParams, a DB session), but an HTTP
+# client pool, a set of compiled patterns or a loaded model then gets built
+# and thrown away per request too. Depends(dependency, scope=...) from here is
+# fastapi.Depends with a lifetime:
+#
+#   "request"  the default, FastAPI's own behaviour.
+#   "worker"   one instance per worker process. One built before a fork
+#              (gunicorn --preload, multiprocessing) isn't handed out in the
+#              child, which builds its own: for sockets and connection pools.
+#   "app"      one instance per application, kept across forks: for
+#              read-only things like compiled patterns or a model.
+#
+# Instances are built on first use, or all at startup with
+# FastAPI(lifespan=scoped_lifespan), and dependencies with yield are closed
+# on shutdown. Those are refused outside of scoped_lifespan (or between
+# start_scoped() and close_scoped()), where nothing would ever close them.
+# Concurrent first uses, from the event loop or from threads, wait for a
+# single build. A scoped dependency can only depend on other
+# scoped dependencies that live at least as long; request data (parameters,
+# Request, Response) isn't available to it.
+
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+from inspect import Parameter
+from typing import Any, Callable
+
+from fastapi import params
+from fastapi.concurrency import contextmanager_in_threadpool
+from fastapi.dependencies.utils import (
+    get_dependant,
+    get_typed_signature,
+    is_async_gen_callable,
+    is_coroutine_callable,
+    is_gen_callable,
+)
+from fastapi.exceptions import FastAPIError
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import HTTPConnection
+
+from .lazy import load_all
+
+# How long each scope lives, a dependency can't use a shorter-lived one.
+LIFETIMES = {"request": 0, "worker": 1, "app": 2}
+
+
+class ScopedStore:
+    """The scoped instances of one application."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.instances: dict = {}
+        # key -> Future of an instance being built
+        self.building: dict = {}
+        # (pid, context manager) of dependencies with yield, in build order.
+        self.exits: list = []
+        # Between start_scoped() and close_scoped(), when those get closed.
+        self.started = False
+
+
+store_lock = threading.Lock()
+
+
+def scoped_store(app) -> ScopedStore:
+    store = getattr(app.state, "scoped_dependencies", None)
+    if store is None:
+        with store_lock:
+            store = getattr(app.state, "scoped_dependencies", None)
+            if store is None:
+                store = app.state.scoped_dependencies = ScopedStore()
+    return store
+
+
+class ScopedDependency:
+    """Calls ``dependency`` once per app, or per worker process, for FastAPI.
+
+    Has the signature of ``dependency`` so FastAPI resolves its
+    sub-dependencies as usual, plus the connection to find the app by.
+    """
+
+    def __init__(self, dependency: Callable[..., Any], scope: str):
+        self.dependency = dependency
+        self.scope = scope
+        self.__name__ = getattr(dependency, "__name__", type(dependency).__name__)
+        dependant = get_dependant(path="", call=dependency)
+        request_data = [
+            field.alias
+            for fields in (
+                dependant.path_params,
+                dependant.query_params,
+                dependant.header_params,
+                dependant.cookie_params,
+                dependant.body_params,
+            )
+            for field in fields
+        ] + [
+            name
+            for name in (
+                dependant.request_param_name,
+                dependant.websocket_param_name,
+                dependant.http_connection_param_name,
+                dependant.response_param_name,
+                dependant.background_tasks_param_name,
+                dependant.security_scopes_param_name,
+            )
+            if name
+        ]
+        if request_data:
+            raise FastAPIError(
+                f"{self.__name__} has scope {scope!r} but reads request data: "
+                + ", ".join(request_data)
+            )
+        for sub in dependant.dependencies:
+            if isinstance(sub.call, ScopedDependency):
+                sub_name, sub_scope = sub.call.__name__, sub.call.scope
+            else:
+                sub_name, sub_scope = getattr(sub.call, "__name__", sub.name), "request"
+            if LIFETIMES[sub_scope] < LIFETIMES[scope]:
+                raise FastAPIError(
+                    f"{self.__name__} has scope {scope!r} but depends on {sub_name} "
+                    f"with scope {sub_scope!r}"
+                )
+        self.subs = [(sub.name, sub.call) for sub in dependant.dependencies]
+        signature = get_typed_signature(dependency)
+        self.__signature__ = signature.replace(
+            parameters=[
+                *signature.parameters.values(),
+                Parameter(
+                    "_scoped_connection", Parameter.KEYWORD_ONLY, annotation=HTTPConnection
+                ),
+            ]
+        )
+
+    def __repr__(self) -> str:
+        return f"<{self.__name__}, scope={self.scope!r}>"
+
+    def key(self):
+        return self if self.scope == "app" else (self, os.getpid())
+
+    async def __call__(self, _scoped_connection: HTTPConnection, **values):
+        return await self.get(_scoped_connection.app, values)
+
+    async def get(self, app, values: dict | None = None):
+        """The instance for ``app``, built with ``values`` if there's none yet.
+
+        Without ``values`` the sub-dependencies are resolved here, as for
+        building it at startup.
+        """
+        store = scoped_store(app)
+        key = self.key()
+        instance = store.instances.get(key, store)
+        if instance is not store:
+            return instance
+        with store.lock:
+            instance = store.instances.get(key, store)
+            if instance is not store:
+                return instance
+            future = store.building.get(key)
+            building = future is None
+            if building:
+                future = store.building[key] = Future()
+        if not building:
+            # Built by another request, maybe on another thread's loop.
+            return await asyncio.wrap_future(future)
+        try:
+            if values is None:
+                values = {name: await call.get(app) for name, call in self.subs}
+            instance = await self.build(store, values)
+        except BaseException as exc:
+            with store.lock:
+                del store.building[key]
+            # The waiting requests fail too, the next one tries again.
+            future.set_exception(exc)
+            raise
+        with store.lock:
+            store.instances[key] = instance
+            del store.building[key]
+        future.set_result(instance)
+        return instance
+
+    async def build(self, store: ScopedStore, values: dict):
+        call = self.dependency
+        if (is_gen_callable(call) or is_async_gen_callable(call)) and not store.started:
+            raise FastAPIError(
+                f"{self.__name__} has scope {self.scope!r} and yield, it's only closed "
+                "with FastAPI(lifespan=scoped_lifespan)"
+            )
+        if is_gen_callable(call):
+            manager = contextmanager_in_threadpool(contextmanager(call)(**values))
+        elif is_async_gen_callable(call):
+            manager = asynccontextmanager(call)(**values)
+        elif is_coroutine_callable(call):
+            return await call(**values)
+        else:
+            return await run_in_threadpool(call, **values)
+        instance = await manager.__aenter__()
+        with store.lock:
+            store.exits.append((os.getpid(), manager))
+        return instance
+
+
+wrappers: dict[tuple, ScopedDependency] = {}
+
+
+def scoped_dependency(dependency: Callable[..., Any], scope: str) -> ScopedDependency:
+    """The ScopedDependency FastAPI sees for ``dependency``, also the key to
+    use in app.dependency_overrides."""
+    key = (dependency, scope)
+    wrapper = wrappers.get(key)
+    if wrapper is None:
+        wrapper = wrappers[key] = ScopedDependency(dependency, scope)
+    return wrapper
+
+
+def Depends(  # noqa: N802
+    dependency: Callable[..., Any] | None = None, *, use_cache: bool = True, scope: str = "request"
+) -> Any:
+    """fastapi.Depends with a ``scope``: "request", "worker" or "app"."""
+    if scope not in LIFETIMES:
+        raise ValueError(f"scope must be one of {', '.join(LIFETIMES)}, not {scope!r}")
+    if scope == "request":
+        return params.Depends(dependency=dependency, use_cache=use_cache)
+    if dependency is None:
+        raise FastAPIError(f"Depends(scope={scope!r}) needs the dependency passed explicitly")
+    return params.Depends(dependency=scoped_dependency(dependency, scope), use_cache=use_cache)
+
+
+def scoped_dependencies(app) -> list[ScopedDependency]:
+    """The scoped dependencies the routes of ``app`` use, dependencies first."""
+    found = {}
+
+    def visit(dependant):
+        for sub in dependant.dependencies:
+            visit(sub)
+        if isinstance(dependant.call, ScopedDependency):
+            found.setdefault(dependant.call, None)
+
+    for route in app.routes:
+        dependant = getattr(route, "dependant", None)
+        if dependant is not None:
+            visit(dependant)
+    return list(found)
+
+
+async def start_scoped(app):
+    """Build every scoped dependency the routes of ``app`` use.
+
+    Lazy routers are loaded first, so the ones their routes use are built
+    too, and the routers are ready before serving.
+    """
+    scoped_store(app).started = True
+    load_all(app)
+    for dependency in scoped_dependencies(app):
+        await dependency.get(app)
+
+
+async def close_scoped(app):
+    """Close the scoped dependencies with yield this process built, newest first.
+
+    All of them are closed, the first error is raised after that.
+    """
+    store = scoped_store(app)
+    with store.lock:
+        exits = [manager for pid, manager in store.exits if pid == os.getpid()]
+        store.exits = [entry for entry in store.exits if entry[0] != os.getpid()]
+        store.instances.clear()
+        store.started = False
+    error = None
+    for manager in reversed(exits):
+        try:
+            await manager.__aexit__(None, None, None)
+        except Exception as exc:
+            error = error or exc
+    if error is not None:
+        raise error
+
+
+@asynccontextmanager
+async def scoped_lifespan(app):
+    """Lifespan building the scoped dependencies at startup, closing them on shutdown."""
+    await start_scoped(app)
+    try:
+        yield
+    finally:
+        await close_scoped(app)
+
+
+def test_scoped_dependencies():
+    from typing import Annotated
+
+    from fastapi import FastAPI, Request
+    from fastapi.testclient import TestClient
+
+    from .lazy import include_lazy_router
+
+    events = []
+
+    class Patterns:
+        def __init__(self):
+            events.append("patterns")
+
+    async def client_pool():
+        events.append("open pool")
+        yield "pool"
+        events.append("close pool")
+
+    def api(
+        pool: Annotated[str, Depends(client_pool, scope="worker")],
+        patterns: Annotated[Patterns, Depends(Patterns, scope="app")],
+    ):
+        events.append("api")
+        return (pool, patterns)
+
+    app = FastAPI(lifespan=scoped_lifespan)
+
+    @app.get("/")
+    async def read(
+        api: Annotated[tuple, Depends(api, scope="worker")],
+        patterns: Annotated[Patterns, Depends(Patterns, scope="app")],
+        q: int = 0,
+    ):
+        return {"pool": api[0], "same": api[1] is patterns, "q": q}
+
+    # Including those of lazy routers.
+    lazy_router = include_lazy_router(app, "app.routers.users", path="/users")
+
+    with TestClient(app) as client:
+        # Built at startup, dependencies first.
+        assert lazy_router.routes is not None
+        assert events == ["open pool", "patterns", "api"]
+        for q in range(3):
+            assert client.get(f"/?q={q}").json() == {"pool": "pool", "same": True, "q": q}
+        assert events == ["open pool", "patterns", "api"]
+    assert events[-1] == "close pool"
+
+    # Lazily, without the lifespan: once, however many threads ask at once.
+    lazy_app = FastAPI()
+    wrapper = scoped_dependency(Patterns, "app")
+    events.clear()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(asyncio.run(wrapper.get(lazy_app))))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert events == ["patterns"]
+    assert len({id(result) for result in results}) == 1
+
+    # Dependencies with yield would never be closed without the lifespan.
+    worker = scoped_dependency(client_pool, "worker")
+    try:
+        asyncio.run(worker.get(lazy_app))
+    except FastAPIError as exc:
+        assert "lifespan=scoped_lifespan" in str(exc)
+    else:
+        raise AssertionError("client_pool can't be built without the lifespan")
+
+    # A forked worker builds its own worker-scoped instances, not app ones.
+    asyncio.run(start_scoped(lazy_app))
+    events.clear()
+    asyncio.run(worker.get(lazy_app))
+    getpid = os.getpid
+    os.getpid = lambda: getpid() + 1
+    try:
+        asyncio.run(worker.get(lazy_app))
+        asyncio.run(wrapper.get(lazy_app))
+    finally:
+        os.getpid = getpid
+    assert events == ["open pool", "open pool"]
+
+    # One failing to close doesn't keep the others open.
+    def broken():
+        yield "broken"
+        raise RuntimeError("close failed")
+
+    async def start_and_close(app):
+        await start_scoped(app)
+        await scoped_dependency(client_pool, "app").get(app)
+        await scoped_dependency(broken, "app").get(app)
+        events.clear()
+        await close_scoped(app)
+
+    try:
+        asyncio.run(start_and_close(FastAPI()))
+    except RuntimeError as exc:
+        assert str(exc) == "close failed"
+    else:
+        raise AssertionError("close_scoped() should raise the error")
+    assert events == ["close pool"]
+
+    def per_user(request: Request):
+        return request.client
+
+    assert type(Depends(Patterns)) is params.Depends
+    for dependency, error in ((api, "depends on client_pool"), (per_user, "request data")):
+        try:
+            Depends(dependency, scope="app")
+        except FastAPIError as exc:
+            assert error in str(exc)
+        else:
+            raise AssertionError(f"{dependency.__name__} can't have scope 'app'")
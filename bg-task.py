@@ -1,26 +1,327 @@
+import asyncio
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager
 from typing import Annotated
 
-from fastapi import BackgroundTasks, Depends, FastAPI
+from fastapi import Depends, FastAPI, HTTPException, Request
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
 
 
-def write_log(message: str):
-    with open("log.txt", mode="a") as log:
-        log.write(message)
-        
-        
-def get_query(background_tasks: BackgroundTasks, q: str | None = None):
+class BufferedLog:
+    """A log file opened once and kept open, written through a large buffer.
+
+    Writes only reach the disk when the buffer fills or on flush(), which
+    the executor below calls every ``flush_interval`` seconds.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0, buffer_size: int = 64 * 1024):
+        self.file = open(path, mode="a", buffering=buffer_size)
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+
+    def write(self, message: str):
+        with self.lock:
+            self.file.write(message)
+
+    def flush(self, force: bool = True):
+        with self.lock:
+            if force or time.monotonic() - self.last_flush >= self.flush_interval:
+                self.file.flush()
+                self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class BackgroundExecutor:
+    """Runs tasks on ``workers`` long-lived threads fed by a bounded queue.
+
+    When the queue already holds ``maxsize`` tasks, ``policy`` decides:
+    "drop" discards the new task (counted in ``dropped``) and "reject"
+    raises queue.Full. Neither waits, since tasks are submitted from the
+    event loop. Workers take up to ``batch_size`` tasks at a time and call
+    every ``flush_hooks`` function between batches and whenever the queue
+    goes idle.
+    """
+
+    def __init__(
+        self,
+        workers: int = 1,
+        maxsize: int = 10_000,
+        policy: str = "drop",
+        batch_size: int = 256,
+        idle_interval: float = 1.0,
+        flush_hooks=(),
+    ):
+        if policy not in ("drop", "reject"):
+            raise ValueError(f"unknown policy: {policy!r}")
+        self.queue = queue.Queue(maxsize)
+        self.policy = policy
+        self.batch_size = batch_size
+        self.idle_interval = idle_interval
+        self.flush_hooks = list(flush_hooks)
+        self.submitted = self.completed = self.failed = self.dropped = 0
+        self.counts_lock = threading.Lock()
+        # Held while checking ``stopped`` and queueing, so no task can get
+        # behind the stop markers, where no worker would ever run it.
+        self.submit_lock = threading.Lock()
+        self.stopped = False
+        self.threads = [
+            threading.Thread(target=self._work, name=f"background-{n}", daemon=True)
+            for n in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        task = (func, args, kwargs)
+        with self.submit_lock:
+            if self.stopped:
+                raise RuntimeError("executor is shut down")
+            try:
+                self.queue.put_nowait(task)
+            except queue.Full:
+                if self.policy != "drop":
+                    raise
+                self.count("dropped")
+                return
+        self.count("submitted")
+
+    def count(self, counter: str, n: int = 1):
+        with self.counts_lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def _flush(self, force: bool):
+        for hook in self.flush_hooks:
+            try:
+                hook(force)
+            except Exception:
+                logger.exception("background flush hook failed")
+
+    def _work(self):
+        while True:
+            try:
+                batch = [self.queue.get(timeout=self.idle_interval)]
+            except queue.Empty:
+                self._flush(force=True)
+                continue
+            # A stop marker ends the batch: the ones behind it are for the
+            # other workers.
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for task in batch:
+                if task is None:
+                    self._flush(force=True)
+                    return
+                func, args, kwargs = task
+                try:
+                    func(*args, **kwargs)
+                    self.count("completed")
+                except Exception:
+                    self.count("failed")
+                    logger.exception("background task %r failed", func)
+            self._flush(force=False)
+
+    def shutdown(self, drain: bool = True, timeout: float | None = None):
+        """Stop the workers, after running what is queued if ``drain``.
+
+        Tasks submitted from then on raise RuntimeError.
+        """
+        with self.submit_lock:
+            self.stopped = True
+        if not drain:
+            try:
+                while True:
+                    self.queue.get_nowait()
+                    self.count("dropped")
+            except queue.Empty:
+                pass
+        # One stop marker per worker, behind everything already queued.
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+
+
+class ExecutorTasks:
+    """Drop-in for BackgroundTasks that hands each task to ``executor``.
+
+    The task starts as soon as a worker is free instead of after the
+    response, and doesn't take the request's threadpool slot.
+    """
+
+    def __init__(self, executor: BackgroundExecutor):
+        self.executor = executor
+
+    def add_task(self, func, *args, **kwargs):
+        try:
+            self.executor.submit(func, *args, **kwargs)
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Too many pending background tasks")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Per lifespan, so the app can be started again after a shutdown.
+    log = app.state.log = BufferedLog("log.txt")
+    executor = app.state.executor = BackgroundExecutor(flush_hooks=[log.flush])
+    try:
+        yield
+    finally:
+        # Run everything still queued and flush it before the process exits.
+        await asyncio.to_thread(executor.shutdown)
+        log.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def write_log(log: BufferedLog, message: str):
+    log.write(message)
+
+
+def get_log(request: Request) -> BufferedLog:
+    return request.app.state.log
+
+
+def get_background_tasks(request: Request):
+    return ExecutorTasks(request.app.state.executor)
+
+
+def get_query(
+    background_tasks: Annotated[ExecutorTasks, Depends(get_background_tasks)],
+    log: Annotated[BufferedLog, Depends(get_log)],
+    q: str | None = None,
+):
     if q:
         message = f"found query: {q}\n"
-        background_tasks.add_task(write_log, message)
+        background_tasks.add_task(write_log, log, message)
     return q
 
 
 @app.post("/send-notification/{email}")
 async def send_notification(
-    email: str, background_tasks: BackgroundTasks, q: Annotated[str, Depends(get_query)]
+    email: str,
+    background_tasks: Annotated[ExecutorTasks, Depends(get_background_tasks)],
+    log: Annotated[BufferedLog, Depends(get_log)],
+    q: Annotated[str, Depends(get_query)],
 ):
     message = f"message to {email}\n"
-    background_tasks.add_task(write_log, message)
-    return {"message": "Message sent"}
\ No newline at end of file
+    background_tasks.add_task(write_log, log, message)
+    return {"message": "Message sent"}
+
+
+class Gate:
+    """A task that blocks its worker until opened, for the tests."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.opened = threading.Event()
+
+    def __call__(self):
+        self.started.set()
+        assert self.opened.wait(5)
+
+
+def test_batches_and_flush():
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        check_batches_and_flush(os.path.join(directory, "log.txt"))
+
+
+def check_batches_and_flush(path: str):
+    log = BufferedLog(path)
+    flushes = []
+
+    def hook(force):
+        flushes.append((force, log.file.tell()))
+        log.flush(force)
+
+    executor = BackgroundExecutor(batch_size=3, idle_interval=60, flush_hooks=[hook])
+    gate = Gate()
+    executor.submit(gate)
+    assert gate.started.wait(5)
+    for n in range(7):
+        executor.submit(write_log, log, f"{n}\n")
+    # Buffered, nothing written yet.
+    assert os.path.getsize(path) == 0
+    gate.opened.set()
+    while executor.completed < 8:
+        time.sleep(0.001)
+    executor.shutdown()
+    log.close()
+    # A flush after the gate, then after each batch of up to 3, then at the stop.
+    assert [size for force, size in flushes if not force] == [0, 6, 12, 14]
+    assert flushes[-1][0] is True
+    with open(path) as f:
+        assert f.read() == "".join(f"{n}\n" for n in range(7))
+
+
+def test_queue_full_policies():
+    for policy in ("drop", "reject"):
+        executor = BackgroundExecutor(maxsize=1, policy=policy, idle_interval=60)
+        gate = Gate()
+        executor.submit(gate)
+        assert gate.started.wait(5)
+        executor.submit(print)
+        if policy == "drop":
+            executor.submit(print)
+            assert executor.dropped == 1
+        else:
+            try:
+                executor.submit(print)
+            except queue.Full:
+                pass
+            else:
+                raise AssertionError("a full queue should reject the task")
+            # Which the endpoints answer with 503.
+            try:
+                ExecutorTasks(executor).add_task(print)
+            except HTTPException as exc:
+                assert exc.status_code == 503
+            else:
+                raise AssertionError("add_task() should raise 503")
+        gate.opened.set()
+        executor.shutdown()
+        assert executor.submitted == 2
+
+
+def test_shutdown():
+    done = []
+    for drain in (True, False):
+        done.clear()
+        executor = BackgroundExecutor(idle_interval=60)
+        gate = Gate()
+        executor.submit(gate)
+        assert gate.started.wait(5)
+        for n in range(5):
+            executor.submit(done.append, n)
+        stopping = threading.Thread(target=executor.shutdown, args=(drain,))
+        stopping.start()
+        while not executor.stopped:
+            time.sleep(0.001)
+        # Nothing gets in once shutdown() has started.
+        try:
+            executor.submit(done.append, "late")
+        except RuntimeError:
+            pass
+        else:
+            raise AssertionError("submit() after shutdown() should raise")
+        gate.opened.set()
+        stopping.join(5)
+        assert not any(thread.is_alive() for thread in executor.threads)
+        if drain:
+            assert sorted(done) == [0, 1, 2, 3, 4]
+        else:
+            assert done == [] and executor.dropped == 5
@@ -0,0 +1,614 @@
+# Compiled jsonable_encoder for Pydantic models.
+
+# jsonable_encoder(model) calls model.dict(), then walks the result again and
+# goes through a chain of isinstance checks for every single value. For a
+# given model class the work is always the same, so fast_jsonable_encoder
+# writes it out once as the source of a plain function, one expression per
+# field, reading the values straight out of the model's __dict__ (Pydantic v1
+# has no native JSON-mode dump, this is the stand-in for one). str, int,
+# float and bool values are copied as they are, datetime, date and time go
+# through isoformat(), lists, sets and tuples become list comprehensions,
+# nested models call their own compiled function, and anything else still
+# goes through jsonable_encoder. As in model.dict(), only the outer model's
+# Config counts: nested models are encoded as plain data, their own
+# json_encoders don't apply.
+#
+# The "declared" encoders are for values already known to be valid, e.g. the
+# return value of a path operation: they only read the fields the declared
+# model has, which filters out whatever a subclass adds (a password), and
+# raise NotDeclaredType for values of any other class.
+
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from inspect import isclass
+from typing import Any, Callable
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from pydantic.fields import (
+    SHAPE_DEQUE,
+    SHAPE_DICT,
+    SHAPE_FROZENSET,
+    SHAPE_LIST,
+    SHAPE_MAPPING,
+    SHAPE_SEQUENCE,
+    SHAPE_SET,
+    SHAPE_SINGLETON,
+    SHAPE_TUPLE_ELLIPSIS,
+    ModelField,
+)
+
+SEQUENCE_SHAPES = {
+    SHAPE_LIST,
+    SHAPE_SET,
+    SHAPE_FROZENSET,
+    SHAPE_TUPLE_ELLIPSIS,
+    SHAPE_SEQUENCE,
+    SHAPE_DEQUE,
+}
+MAPPING_SHAPES = {SHAPE_DICT, SHAPE_MAPPING}
+NATIVE_TYPES = (str, int, float, bool, type(None))
+ISO_TYPES = (datetime, date, time)
+
+# Model class -> its compiled encoder.
+encoders: dict[type, Callable[[BaseModel], Any]] = {}
+# Model class -> its compiled encoder inside another model, Config ignored.
+nested_encoders: dict[type, Callable[[BaseModel], Any]] = {}
+# Model class -> its encoder for the declared fields only.
+declared_encoders: dict[type, Callable[[BaseModel], Any]] = {}
+# (class, declared model) -> whether the class's values can be encoded as it.
+compatible: dict[tuple[type, type], bool] = {}
+
+
+class NotDeclaredType(TypeError):
+    """A value isn't an instance of its declared model or a compatible subclass."""
+
+
+def not_declared(obj):
+    # The declared encoder of models that can't be encoded field by field.
+    raise NotDeclaredType(type(obj))
+
+
+def encode_model(obj: BaseModel):
+    encoder = encoders.get(type(obj))
+    if encoder is None:
+        encoder = compiled_encoder(type(obj))
+    return encoder(obj)
+
+
+def encode_nested(obj: BaseModel):
+    encoder = nested_encoders.get(type(obj))
+    if encoder is None:
+        encoder = compiled_encoder(type(obj), nested=True)
+    return encoder(obj)
+
+
+def plain(value: Any) -> Any:
+    # What model.dict() makes of a field's value: models anywhere in it
+    # become dicts, so jsonable_encoder doesn't apply their json_encoders.
+    return BaseModel._get_value(value, True, True, None, None, False, False, False)
+
+
+def encode_plain(value: Any) -> Any:
+    return jsonable_encoder(plain(value))
+
+
+def compilable(model: type[BaseModel], nested: bool = False) -> bool:
+    """Whether the defaults of jsonable_encoder reduce to reading the fields.
+
+    A ``nested`` model's json_encoders don't matter, the outer model's do.
+    """
+    config = model.__config__
+    return (
+        "__root__" not in model.__fields__
+        and (nested or not config.json_encoders)
+        and config.extra != "allow"
+        and not any(
+            field.field_info.exclude or field.field_info.include
+            for field in model.__fields__.values()
+        )
+    )
+
+
+@dataclass(frozen=True)
+class FieldPlan:
+    """Which fields the declared encoders read, and under which keys.
+
+    Built once from a route's response_model_include, response_model_exclude,
+    response_model_by_alias and response_model_exclude_unset. ``include``
+    and ``exclude`` are frozen into sorted (name, sub-selection) pairs so
+    plans can be cache keys, a sub-selection of None means the whole field.
+    """
+
+    include: tuple | None = None
+    exclude: tuple | None = None
+    by_alias: bool = True
+    exclude_unset: bool = False
+
+    @classmethod
+    def build(cls, include=None, exclude=None, by_alias=True, exclude_unset=False):
+        return cls(freeze(include), freeze(exclude), by_alias, exclude_unset)
+
+    def child(self, include, exclude) -> "FieldPlan":
+        return FieldPlan(include, exclude, self.by_alias, self.exclude_unset)
+
+    def items(self) -> "FieldPlan":
+        """The plan for the items of a list or dict field."""
+        selections = [dict(s) for s in (self.include, self.exclude) if s is not None]
+        if any(set(selection) != {"__all__"} for selection in selections):
+            # Selecting items by index isn't compiled.
+            raise UnsupportedPlan(self)
+        include, exclude = (
+            None if s is None else dict(s)["__all__"] for s in (self.include, self.exclude)
+        )
+        return self.child(include, exclude)
+
+    @property
+    def selects(self) -> bool:
+        return self.include is not None or self.exclude is not None
+
+
+DEFAULT_PLAN = FieldPlan()
+
+
+class UnsupportedPlan(ValueError):
+    """The include / exclude selection can't be compiled into a plan."""
+
+
+def freeze(selection):
+    """Sets and dicts of include / exclude as sorted tuples of (name, sub-selection)."""
+    if selection is None:
+        return None
+    if isinstance(selection, dict):
+        pairs = (
+            (name, None if sub is True or sub is ... else freeze(sub))
+            for name, sub in selection.items()
+            if sub is not False
+        )
+    else:
+        pairs = ((name, None) for name in selection)
+    return tuple(sorted(pairs, key=lambda pair: repr(pair[0])))
+
+
+def mentions_model(field: ModelField) -> bool:
+    if isclass(field.type_) and issubclass(field.type_, BaseModel):
+        return True
+    fields = [*(field.sub_fields or ()), *([field.key_field] if field.key_field else [])]
+    return any(mentions_model(sub_field) for sub_field in fields)
+
+
+def may_hold_model(field: ModelField) -> bool:
+    tp = field.type_
+    # Any is a class on Python 3.11+.
+    if tp is Any or not isclass(tp) or issubclass(tp, BaseModel):
+        return True
+    if tp in (object, dict, list, tuple, set):
+        return True
+    fields = [*(field.sub_fields or ()), *([field.key_field] if field.key_field else [])]
+    return any(may_hold_model(sub_field) for sub_field in fields)
+
+
+def fallback_expression(
+    field: ModelField, var: str, models: dict | None, plan: FieldPlan
+) -> str:
+    if plan.selects:
+        raise UnsupportedPlan(field)
+    if models is not None and mentions_model(field):
+        # jsonable_encoder would encode the actual classes, subclass fields
+        # and all.
+        raise NotDeclaredType(field)
+    if may_hold_model(field):
+        return f"encode_plain({var})"
+    return f"jsonable_encoder({var})"
+
+
+def value_expression(
+    field: ModelField,
+    var: str,
+    depth: int = 0,
+    models: dict | None = None,
+    plan: FieldPlan = DEFAULT_PLAN,
+) -> str:
+    """Python source converting ``var``, a value of ``field``, to JSON data.
+
+    With ``models``, nested models are encoded as their declared class
+    rather than their actual one, following ``plan``, and the classes and
+    plans are added to ``models`` under the names the source uses for them.
+    """
+    if field.shape == SHAPE_SINGLETON and not field.sub_fields:
+        tp = field.type_
+        if isclass(tp) and issubclass(tp, BaseModel):
+            if models is None:
+                expression = f"encode_nested({var})"
+            else:
+                name = f"model{len(models)}"
+                models[name] = tp
+                models[f"{name}_plan"] = plan
+                expression = f"encode_as({name}, {var}, {name}_plan)"
+        elif plan.selects:
+            raise UnsupportedPlan(field)
+        elif tp in NATIVE_TYPES:
+            expression = var
+        elif tp in ISO_TYPES:
+            expression = f"{var}.isoformat()"
+        else:
+            return fallback_expression(field, var, models, plan)
+    elif field.shape in SEQUENCE_SHAPES and field.sub_fields:
+        item = f"x{depth}"
+        source = var
+        if field.shape in (SHAPE_SET, SHAPE_FROZENSET):
+            # model.dict() rebuilds sets one element at a time, which can
+            # change their order, do the same so the lists come out equal.
+            source = f"set(iter({var}))"
+        item_plan = plan.items() if plan.selects else plan
+        element = value_expression(field.sub_fields[0], item, depth + 1, models, item_plan)
+        expression = f"[{element} for {item} in {source}]"
+    elif (
+        field.shape in MAPPING_SHAPES
+        and field.sub_fields
+        and field.key_field is not None
+        and field.key_field.type_ is str
+        and not field.key_field.sub_fields
+    ):
+        key, item = f"k{depth}", f"x{depth}"
+        item_plan = plan.items() if plan.selects else plan
+        element = value_expression(field.sub_fields[0], item, depth + 1, models, item_plan)
+        expression = f"{{{key}: {element} for {key}, {item} in {var}.items()}}"
+    else:
+        return fallback_expression(field, var, models, plan)
+    if field.allow_none and expression != var:
+        expression = f"(None if {var} is None else {expression})"
+    return expression
+
+
+def selected_fields(model: type[BaseModel], plan: FieldPlan):
+    """(name, field, plan for its value) for each field ``plan`` keeps."""
+    include = None if plan.include is None else dict(plan.include)
+    exclude = None if plan.exclude is None else dict(plan.exclude)
+    for name, field in model.__fields__.items():
+        sub_include = sub_exclude = None
+        if include is not None:
+            if name not in include:
+                continue
+            sub_include = include[name]
+        if exclude is not None and name in exclude:
+            if exclude[name] is None:
+                continue
+            sub_exclude = exclude[name]
+        yield name, field, plan.child(sub_include, sub_exclude)
+
+
+# (model, plan) pairs whose declared encoder is being generated right now.
+compiling: set = set()
+
+
+def compiled_encoder(
+    model: type[BaseModel],
+    declared: bool = False,
+    plan: FieldPlan = DEFAULT_PLAN,
+    nested: bool = False,
+) -> Callable[[BaseModel], Any]:
+    """The encoder for ``model``, generated on first use and then cached.
+
+    It returns the same data as jsonable_encoder(instance) for an instance
+    of exactly ``model``. The ``declared`` variant reads only the fields
+    ``model`` declares, from an instance of it or of a field-compatible
+    subclass, and encodes nested models as their declared classes too, so
+    whatever a subclass adds is left out. It raises NotDeclaredType for
+    anything it can't encode that way. It also follows ``plan``, like
+    model.dict(include=..., exclude=..., by_alias=..., exclude_unset=...)
+    would, and raises UnsupportedPlan right away if the plan can't be
+    compiled. The ``nested`` variant encodes ``model`` as a field of another
+    model, as plain data.
+    """
+    if declared:
+        cache, key = declared_encoders, (model, plan)
+    else:
+        cache, key = (nested_encoders if nested else encoders), model
+    encoder = cache.get(key)
+    if encoder is not None:
+        return encoder
+    if not compilable(model, nested):
+        if declared and plan.selects:
+            raise UnsupportedPlan(model)
+        encoder = not_declared if declared else encode_plain if nested else jsonable_encoder
+    else:
+        models = {} if declared else None
+        fields = list(selected_fields(model, plan))
+        try:
+            expressions = [
+                value_expression(field, f"v{n}", 0, models, field_plan)
+                for n, (_, field, field_plan) in enumerate(fields)
+            ]
+        except NotDeclaredType:
+            expressions = None
+        if expressions is None:
+            encoder = not_declared
+        else:
+            keys = [field.alias if plan.by_alias else name for name, field, _ in fields]
+            if plan.exclude_unset:
+                lines = [
+                    "def encode(obj):",
+                    "    values = obj.__dict__",
+                    "    fields_set = obj.__fields_set__",
+                    "    result = {}",
+                ]
+                for n, ((name, _, _), k, expression) in enumerate(
+                    zip(fields, keys, expressions)
+                ):
+                    lines += [
+                        f"    if {name!r} in fields_set:",
+                        f"        v{n} = values[{name!r}]",
+                        f"        result[{k!r}] = {expression}",
+                    ]
+                lines.append("    return result")
+            else:
+                lines = [
+                    "def encode(obj):",
+                    "    values = obj.__dict__",
+                    *(f"    v{n} = values[{name!r}]" for n, (name, _, _) in enumerate(fields)),
+                    "    return {",
+                    *(f"        {k!r}: {e}," for k, e in zip(keys, expressions)),
+                    "    }",
+                ]
+            source = "\n".join(lines)
+            namespace = {
+                "encode_nested": encode_nested,
+                "encode_as": encode_as,
+                "encode_plain": encode_plain,
+                "jsonable_encoder": jsonable_encoder,
+                **(models or {}),
+            }
+            exec(compile(source, f"<encoder for {model.__qualname__}>", "exec"), namespace)
+            encoder = namespace["encode"]
+            encoder.source = source
+            if declared:
+                # Nested plans are compiled now, so an UnsupportedPlan
+                # shows up here rather than in the middle of a response.
+                compiling.add(key)
+                try:
+                    for name, nested in models.items():
+                        if name.endswith("_plan"):
+                            continue
+                        nested_plan = models[f"{name}_plan"]
+                        if (nested, nested_plan) not in compiling:
+                            compiled_encoder(nested, True, nested_plan)
+                finally:
+                    compiling.discard(key)
+    cache[key] = encoder
+    return encoder
+
+
+def field_compatible(cls: type, model: type[BaseModel]) -> bool:
+    """Whether ``cls`` is ``model`` or a subclass keeping all its fields as they are."""
+    key = (cls, model)
+    result = compatible.get(key)
+    if result is None:
+        result = cls is model or (
+            isclass(cls)
+            and issubclass(cls, model)
+            and all(
+                name in cls.__fields__
+                and cls.__fields__[name].outer_type_ == field.outer_type_
+                and cls.__fields__[name].alias == field.alias
+                for name, field in model.__fields__.items()
+            )
+        )
+        compatible[key] = result
+    return result
+
+
+def encode_as(model: type[BaseModel], obj: Any, plan: FieldPlan = DEFAULT_PLAN):
+    if type(obj) is not model and not field_compatible(type(obj), model):
+        raise NotDeclaredType(type(obj), model)
+    encoder = declared_encoders.get((model, plan))
+    if encoder is None:
+        encoder = compiled_encoder(model, True, plan)
+    return encoder(obj)
+
+
+def declared_field_encoder(
+    field: ModelField, plan: FieldPlan = DEFAULT_PLAN
+) -> Callable[[Any], Any] | None:
+    """Encoder for values of ``field`` holding its declared models, or None.
+
+    Only for a model, a list/sequence of models or a dict of them, the
+    values are trusted to be valid and only their classes are checked.
+    ``plan`` applies to each model, the way FastAPI applies
+    response_model_include and the like to a list response; it can't
+    select anything on a dict response, where FastAPI would pick dict keys.
+    """
+    if field.shape == SHAPE_SINGLETON and not field.sub_fields:
+        item, container = field, None
+    elif field.shape in SEQUENCE_SHAPES - {SHAPE_SET, SHAPE_FROZENSET} and field.sub_fields:
+        item, container = field.sub_fields[0], "(list, tuple)"
+    elif (
+        field.shape in MAPPING_SHAPES
+        and field.sub_fields
+        and field.key_field is not None
+        and field.key_field.type_ is str
+        and not plan.selects
+    ):
+        item, container = field.sub_fields[0], "dict"
+    else:
+        return None
+    if (
+        item.shape != SHAPE_SINGLETON
+        or item.sub_fields
+        or (container and item.allow_none)
+        or not (isclass(item.type_) and issubclass(item.type_, BaseModel))
+    ):
+        return None
+    compiled_encoder(item.type_, True, plan)
+    namespace = {"encode_as": encode_as, "NotDeclaredType": NotDeclaredType}
+    namespace.update(model=item.type_, plan=plan)
+    lines = ["def encode(value):"]
+    if field.allow_none:
+        lines += ["    if value is None:", "        return None"]
+    if container:
+        lines += [
+            f"    if not isinstance(value, {container}):",
+            "        raise NotDeclaredType(type(value))",
+        ]
+    if container == "dict":
+        lines.append("    return {k: encode_as(model, x, plan) for k, x in value.items()}")
+    elif container:
+        lines.append("    return [encode_as(model, x, plan) for x in value]")
+    else:
+        lines.append("    return encode_as(model, value, plan)")
+    exec(compile("\n".join(lines), f"<encoder for {field.name}>", "exec"), namespace)
+    return namespace["encode"]
+
+
+def fast_jsonable_encoder(obj: Any) -> Any:
+    """jsonable_encoder(obj) with a compiled fast path for Pydantic models."""
+    if isinstance(obj, BaseModel):
+        return encode_model(obj)
+    return jsonable_encoder(obj)
+
+
+def test_matches_jsonable_encoder():
+    from enum import Enum
+    from pydantic import Field, HttpUrl
+
+    class Color(str, Enum):
+        red = "red"
+
+    class Image(BaseModel):
+        url: HttpUrl
+        name: str
+
+    class Item(BaseModel):
+        name: str
+        price: float
+        tax: float | None = None
+        tags: set[str] = set()
+        images: list[Image] | None = None
+        seen: dict[str, list[datetime]] = {}
+        when: datetime | None = None
+        color: Color = Color.red
+        matrix: list[list[int | None]] = []
+        internal_id: int = Field(0, alias="internalId")
+        extra: Any = None
+
+    class Tree(BaseModel):
+        name: str
+        children: list["Tree"] = []
+
+    class Encoded(BaseModel):
+        when: datetime
+
+        class Config:
+            json_encoders = {datetime: lambda value: value.timestamp()}
+
+    class Parent(BaseModel):
+        # Only the outer model's json_encoders apply, not the child's.
+        child: Encoded
+        children: list[Encoded] = []
+        anything: Any = None
+
+    items = [
+        Item(name="plain", price=1),
+        Item(
+            name="full",
+            price=2.5,
+            tax=0.5,
+            tags={"a", "b"},
+            images=[{"url": "http://example.com/a.jpg", "name": "a"}],
+            seen={"k": [datetime(2024, 1, 2, 3, 4, 5)]},
+            when=datetime(2024, 1, 2),
+            matrix=[[1, None], []],
+            internalId=7,
+            extra={"nested": date(2024, 1, 1)},
+        ),
+        Tree(name="root", children=[{"name": "leaf", "children": [{"name": "deeper"}]}]),
+        Encoded(when=datetime(2024, 1, 1)),
+        Parent(
+            child=Encoded(when=datetime(2020, 1, 1)),
+            children=[{"when": datetime(2021, 1, 1)}],
+            anything={"deep": [Encoded(when=datetime(2022, 1, 1))]},
+        ),
+    ]
+    for item in items:
+        assert fast_jsonable_encoder(item) == jsonable_encoder(item)
+    # Built once per class, json_encoders fall back to jsonable_encoder.
+    assert compiled_encoder(Item) is compiled_encoder(Item)
+    assert compiled_encoder(Encoded) is jsonable_encoder
+    assert fast_jsonable_encoder(items[-1])["child"] == {"when": "2020-01-01T00:00:00"}
+
+
+def bench(args):
+    """jsonable_encoder vs fast_jsonable_encoder on body-nested-models.py's Offer."""
+    import timeit
+
+    from pydantic import HttpUrl
+
+    class Image(BaseModel):
+        url: HttpUrl
+        name: str
+
+    class Item(BaseModel):
+        name: str
+        description: str | None = None
+        price: float
+        tax: float | None = None
+        tags: set[str] = set()
+        images: list[Image] | None = None
+
+    class Offer(BaseModel):
+        name: str
+        description: str | None = None
+        price: float
+        items: list[Item]
+
+    class Timestamped(BaseModel):
+        # json-compatible-encoder.py's Item.
+        title: str
+        timestamp: datetime
+        desciption: str | None = None
+
+    def offer(items: int, images: int) -> Offer:
+        return Offer(
+            name="Offer",
+            price=42.0,
+            items=[
+                {
+                    "name": f"Item {n}",
+                    "description": "The pretender",
+                    "price": 42.0,
+                    "tax": 3.2,
+                    "tags": ["rock", "metal", "bar"],
+                    "images": [
+                        {"url": f"http://example.com/{n}/{m}.jpg", "name": f"Image {m}"}
+                        for m in range(images)
+                    ],
+                }
+                for n in range(items)
+            ],
+        )
+
+    payloads = {
+        "Timestamped": Timestamped(title="Foo", timestamp=datetime.now()),
+        "Offer, 1 item": offer(1, 0),
+        "Offer, 10 items x 3 images": offer(10, 3),
+        "Offer, 200 items x 10 images": offer(200, 10),
+    }
+    for name, payload in payloads.items():
+        assert fast_jsonable_encoder(payload) == jsonable_encoder(payload)
+        number = max(1, args.number // (1 + len(jsonable_encoder(payload).get("items", ()))))
+        before = min(timeit.repeat(lambda: jsonable_encoder(payload), number=number, repeat=5))
+        after = min(
+            timeit.repeat(lambda: fast_jsonable_encoder(payload), number=number, repeat=5)
+        )
+        print(
+            f"{name:<30} jsonable_encoder {before / number * 1e6:10.1f} us"
+            f"  compiled {after / number * 1e6:9.1f} us  ({before / after:5.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmarks for this module.")
+    parser.add_argument("--number", type=int, default=20000)
+    bench(parser.parse_args())
@@ -0,0 +1,35 @@
+# The sql_app package lives in a directory named sql_app.py, which Python
+# can't import as a package, so pytest can't import its modules to collect
+# their tests. Register that directory as the sql_app package and collect
+# each of its modules as sql_app.<name>, the way the app imports them.
+
+import importlib
+import importlib.util
+import sys
+from pathlib import Path
+
+import pytest
+
+SQL_APP = Path(__file__).parent / "sql_app.py"
+
+
+def import_sql_app():
+    if "sql_app" not in sys.modules:
+        spec = importlib.util.spec_from_file_location(
+            "sql_app", SQL_APP / "__init__.py", submodule_search_locations=[str(SQL_APP)]
+        )
+        package = importlib.util.module_from_spec(spec)
+        sys.modules["sql_app"] = package
+        spec.loader.exec_module(package)
+    return sys.modules["sql_app"]
+
+
+class SQLAppModule(pytest.Module):
+    def _getobj(self):
+        import_sql_app()
+        return importlib.import_module(f"sql_app.{self.path.stem}")
+
+
+def pytest_pycollect_makemodule(module_path, parent):
+    if module_path.parent == SQL_APP and module_path.name != "__init__.py":
+        return SQLAppModule.from_parent(parent, path=module_path)
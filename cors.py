@@ -6,7 +6,10 @@
 
 
 from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
+
+# Same arguments as fastapi.middleware.cors.CORSMiddleware, with the origin
+# checks and preflight headers precomputed, see middleware/cors.py.
+from middleware.cors import CORSMetrics, FastCORSMiddleware
 
 app = FastAPI()
 
@@ -17,18 +20,29 @@ origins = [
     "http://localhost:8080",
 ]
 
+cors_metrics = CORSMetrics()
+
 app.add_middleware(
-    CORSMiddleware,
+    FastCORSMiddleware,
     allow_origins=origins,
     allow_credentials=True,
     allow_methods=['*'],
     allow_headers=["*"],
+    # Browsers may cache a preflight this long (Chromium caps it at 2 hours),
+    # each SPA client then sends one per endpoint every 2 hours at most.
+    max_age=7200,
+    metrics=cors_metrics,
 )
 
 @app.get("/")
 async def main():
     return {"message": "Hello World"}
 
+
+@app.get("/cors/stats")
+async def cors_stats():
+    return cors_metrics.snapshot()
+
 # The middleware responds to two particular types of HTTP request...
 
 # CORS preflight requests ¶
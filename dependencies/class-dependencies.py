@@ -20,9 +20,13 @@
 
 from typing import Annotated
 
-from fastapi import Depends, FastAPI
+from fastapi import Depends, FastAPI, HTTPException
 
-app = FastAPI()
+# fastapi.Depends plus a scope, see "Dependencies built once" below.
+from app.scopes import Depends as ScopedDepends
+from app.scopes import scoped_lifespan
+
+app = FastAPI(lifespan=scoped_lifespan)
 
 fake_items_db = [{"item_name": "Foo"}, {"item_name": "Bar"}, {"item_name": "Baz"}]
 
@@ -41,4 +45,27 @@ async def read_items(commons: Annotated[CommonQueryParams, Depends(CommonQueryPa
     items = fake_items_db[commons.skip : commons.skip + commons.limit]
     response.update({"items": items})
     return response
-    
\ No newline at end of file
+
+
+# Dependencies built once
+
+# CommonQueryParams holds the query parameters of one request, so it has to be
+# built for every request. A dependency that doesn't read the request, like an
+# index over fake_items_db, an HTTP client or a loaded model, can be built once
+# and shared by all requests with scope="app" (or "worker", one per worker
+# process, see app/scopes.py). With lifespan=scoped_lifespan it's built at
+# startup instead of on first use.
+
+class ItemIndex:
+    def __init__(self):
+        self.by_name = {item["item_name"].lower(): item for item in fake_items_db}
+
+
+@app.get("/items/{item_name}")
+async def read_item(
+    item_name: str, index: Annotated[ItemIndex, ScopedDepends(ItemIndex, scope="app")]
+):
+    item = index.by_name.get(item_name.lower())
+    if item is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    return item
@@ -8,6 +8,8 @@
 from fastapi import Depends, FastAPI, Header, HTTPException
 from typing_extensions import Annotated
 
+from app.dependency_graph import GraphRoute
+
 
 async def verify_token(x_token: Annotated[str, Header()]):
     if x_token != "fake-super-secret-token":
@@ -21,6 +23,11 @@ async def verify_key(x_key: Annotated[str, Header()]):
 
 
 app = FastAPI(dependencies=[Depends(verify_token), Depends(verify_key)])
+# verify_token and verify_key are resolved from a plan compiled once at
+# startup instead of walking the dependency tree on every request, see
+# app/dependency_graph.py. They have no yield, so ConcurrentRoute would
+# change nothing here.
+app.router.route_class = GraphRoute
 
 @app.get("/items/")
 async def read_items():
@@ -97,9 +97,26 @@ async def get_db():
     with MySuperContextManager() as db:
         yield db
         
+# get_db opens a new session for every request, which is what a session is
+# for. Things a request only borrows, like an HTTP client with its connection
+# pool, can be opened once: Depends(get_client, scope="worker") from
+# app/scopes.py runs the code before the yield once per worker process, and
+# the code after it on shutdown.
+
 # Another way to create a context manager is with:
 
     # @contextlib.contextmanager or
     # @contextlib.asynccontextmanager
 
-# using them to decorate a function with a single yield.
\ No newline at end of file
+# using them to decorate a function with a single yield.
+
+
+# Entering independent dependencies with yield at the same time
+
+# dependency_a, dependency_b and dependency_c above form a chain, each one
+# needs the one before, so they can only be entered one after the other. But
+# two dependencies with yield that don't depend on each other, say a DB
+# session and a cache connection, can be: with
+# app.router.route_class = ConcurrentRoute (app/dependency_graph.py) both
+# are entered at the same time, and their exit code still runs in a fixed
+# order, dependants first.
@@ -0,0 +1,579 @@
+# Fast JSON responses.
+
+# A normal path operation goes through three passes over the response data:
+# validation against the response_model, jsonable_encoder, then json.dumps in
+# JSONResponse. FastJSONResponse dumps with orjson, and models it finds on the
+# way go through their compiled encoder from compiled_encoder.py, so anything
+# handed to it is serialized in one pass. FastJSONRoute goes one step further
+# and sends the validated response model straight to FastJSONResponse,
+# skipping jsonable_encoder.
+#
+# App-wide:
+#
+#     app = FastAPI(default_response_class=FastJSONResponse)
+#     app.router.route_class = FastJSONRoute
+#
+# or per router / per route:
+#
+#     router = APIRouter(route_class=FastJSONRoute)
+#     @router.get("/items/", response_class=FastJSONResponse)
+
+import asyncio
+from copy import copy
+from typing import Any
+
+from fastapi import Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from fastapi.routing import APIRoute, _prepare_response_content
+from fastapi.utils import is_body_allowed_for_status_code
+from pydantic import BaseModel, ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+
+from compiled_encoder import (
+    DEFAULT_PLAN,
+    FieldPlan,
+    NotDeclaredType,
+    UnsupportedPlan,
+    declared_field_encoder,
+    encode_model,
+)
+
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None  # type: ignore
+
+
+def default(obj: Any) -> Any:
+    # Called by orjson for the types it doesn't know itself.
+    if isinstance(obj, BaseModel):
+        return encode_model(obj)
+    return jsonable_encoder(obj)
+
+
+def dumps(content: Any) -> bytes:
+    assert orjson is not None, "orjson must be installed to use FastJSONResponse"
+    return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(ORJSONResponse):
+    """ORJSONResponse that also takes models, and bytes as JSON already encoded."""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+class FastJSONRoute(APIRoute):
+    """Route that serializes the validated response model straight to bytes.
+
+    Used for routes whose response class is a FastJSONResponse, other
+    routes are handled as usual. response_model_include, _exclude,
+    _by_alias and _exclude_unset are compiled into a FieldPlan when the
+    route is set up, and the validated value is encoded following it in the
+    same pass; selections the plan can't express (list items by index,
+    include on a dict response) and exclude_defaults / exclude_none use the
+    stock handler. The endpoint still
+    runs through the normal request handler (dependencies, validation
+    errors, background tasks), wrapped so that it returns the finished
+    response, with the status code, headers and cookies set on a
+    ``Response`` parameter copied over.
+    """
+
+    def field_plan(self) -> FieldPlan:
+        return FieldPlan.build(
+            self.response_model_include,
+            self.response_model_exclude,
+            self.response_model_by_alias,
+            self.response_model_exclude_unset,
+        )
+
+    def fast_path(self) -> bool:
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        if not (
+            issubclass(response_class, FastJSONResponse)
+            and not self.response_model_exclude_defaults
+            and not self.response_model_exclude_none
+        ):
+            return False
+        self.validated_encoder = None
+        field = self.secure_cloned_response_field
+        if field is None or self.field_plan() == DEFAULT_PLAN:
+            return True
+        try:
+            self.validated_encoder = declared_field_encoder(field, self.field_plan())
+        except UnsupportedPlan:
+            return False
+        return self.validated_encoder is not None
+
+    def serialize(self, content: Any) -> bytes:
+        field = self.secure_cloned_response_field
+        if field is None:
+            return dumps(content)
+        content = _prepare_response_content(
+            content, exclude_unset=self.response_model_exclude_unset
+        )
+        value, errors = field.validate(content, {}, loc=("response",))
+        if isinstance(errors, ErrorWrapper):
+            errors = [errors]
+        if errors:
+            raise ValidationError(errors, field.type_)
+        if self.validated_encoder is None:
+            return dumps(value)
+        try:
+            return dumps(self.validated_encoder(value))
+        except NotDeclaredType:
+            # Fields of types the plan leaves to jsonable_encoder.
+            return dumps(
+                jsonable_encoder(
+                    value,
+                    include=self.response_model_include,
+                    exclude=self.response_model_exclude,
+                    by_alias=self.response_model_by_alias,
+                    exclude_unset=self.response_model_exclude_unset,
+                )
+            )
+
+    def get_route_handler(self):
+        if not self.fast_path():
+            return super().get_route_handler()
+        response_class = self.response_class
+        if isinstance(response_class, DefaultPlaceholder):
+            response_class = response_class.value
+        # A copy, route.dependant stays as it is for OpenAPI and the like.
+        dependant = copy(self.dependant)
+        endpoint = dependant.call
+        is_coroutine = asyncio.iscoroutinefunction(endpoint)
+        # Have the shared sub-response passed in even when only the
+        # dependencies declare it, so their headers and cookies aren't lost.
+        response_param = dependant.response_param_name
+        if response_param is None:
+            dependant.response_param_name = "_fast_json_sub_response"
+        status_code = self.status_code
+
+        async def call(**values):
+            sub_response = (
+                values[response_param]
+                if response_param
+                else values.pop(dependant.response_param_name)
+            )
+            if is_coroutine:
+                content = await endpoint(**values)
+                body = self.serialize(content) if not isinstance(content, Response) else None
+            else:
+                content = await run_in_threadpool(endpoint, **values)
+                body = (
+                    await run_in_threadpool(self.serialize, content)
+                    if not isinstance(content, Response)
+                    else None
+                )
+            if body is None:
+                return content
+            response_args = {}
+            if sub_response.status_code or status_code:
+                response_args["status_code"] = sub_response.status_code or status_code
+            response = response_class(body, **response_args)
+            if not is_body_allowed_for_status_code(response.status_code):
+                response.body = b""
+            response.headers.raw.extend(sub_response.headers.raw)
+            return response
+
+        dependant.call = call
+        route = copy(self)
+        route.dependant = dependant
+        return APIRoute.get_route_handler(route)
+
+
+class TrustedJSONRoute(FastJSONRoute):
+    """FastJSONRoute that trusts return values of the response model's class.
+
+    When the response model is a model or a list of models and the endpoint
+    returns instances of exactly that class, or of a subclass that keeps
+    its fields unchanged (UserIn for BaseUser), the values are not
+    validated again: only the fields the response model declares are read
+    and encoded, nested models included, so the filtering is the same.
+    Anything else (dicts, ORM objects, other classes) is validated as
+    usual. Opt in only where returned models aren't mutated into invalid
+    states after they are created, e.g. without validate_assignment.
+    """
+
+    def serialize(self, content: Any) -> bytes:
+        if self.trusted_encoder is not None:
+            try:
+                return dumps(self.trusted_encoder(content))
+            except NotDeclaredType:
+                pass
+        return super().serialize(content)
+
+    def get_route_handler(self):
+        self.trusted_encoder = None
+        if self.response_field is not None:
+            try:
+                self.trusted_encoder = declared_field_encoder(
+                    self.response_field, self.field_plan()
+                )
+            except UnsupportedPlan:
+                pass
+        return super().get_route_handler()
+
+
+def test_fast_json_route():
+    from datetime import datetime
+
+    from fastapi import APIRouter, Depends, FastAPI
+    from fastapi.testclient import TestClient
+    from pydantic import Field
+
+    class Item(BaseModel):
+        name: str
+        price: float
+        tags: set[str] = set()
+        created: datetime = datetime(2024, 1, 1)
+        internal_id: int = Field(0, alias="internalId")
+
+    class ItemIn(Item):
+        secret: str = "hidden"
+
+    def set_cookie(response: Response):
+        response.set_cookie("seen", "yes")
+
+    def routes(router: APIRouter):
+        @router.get("/items/", response_model=list[Item])
+        async def list_items():
+            return [ItemIn(name="a", price=1, tags={"x"}), {"name": "b", "price": 2}]
+
+        @router.get("/item/", dependencies=[Depends(set_cookie)])
+        def sync_item(response: Response) -> Item:
+            response.headers["X-Sync"] = "1"
+            response.status_code = 201
+            return ItemIn(name="c", price=3)
+
+        @router.get("/raw")
+        async def raw():
+            return {1: "int key", "when": datetime(2024, 1, 1)}
+
+        @router.delete("/item/", status_code=204)
+        async def delete_item():
+            return None
+
+        @router.get("/invalid/", response_model=Item)
+        async def invalid():
+            return {"name": "no price"}
+
+    apps = {}
+    for name, route_class in (("stock", APIRoute), ("fast", FastJSONRoute)):
+        router = APIRouter(route_class=route_class)
+        routes(router)
+        app = FastAPI(default_response_class=FastJSONResponse)
+        app.include_router(router)
+        apps[name] = TestClient(app, raise_server_exceptions=False)
+
+    requests = [("GET", "/items/"), ("GET", "/item/"), ("GET", "/raw"), ("DELETE", "/item/")]
+    for method, path in requests:
+        expected = apps["stock"].request(method, path)
+        response = apps["fast"].request(method, path)
+        assert response.status_code == expected.status_code
+        assert response.content == expected.content
+        for header in ("content-type", "x-sync", "set-cookie"):
+            assert response.headers.get(header) == expected.headers.get(header)
+    assert apps["fast"].get("/items/").json()[0] == {
+        "name": "a",
+        "price": 1.0,
+        "tags": ["x"],
+        "created": "2024-01-01T00:00:00",
+        "internalId": 0,
+    }
+    assert apps["fast"].get("/invalid/").status_code == 500
+
+
+def test_trusted_json_route():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    class Image(BaseModel):
+        url: str
+
+    class PrivateImage(Image):
+        signed_url: str
+
+    class BaseUser(BaseModel):
+        username: str
+        avatar: Image | None = None
+        tags: list[str] = []
+
+    class UserIn(BaseUser):
+        password: str
+
+    class Renamed(BaseUser):
+        # Same name, different type: not field-compatible.
+        username: int
+
+    app = FastAPI(default_response_class=FastJSONResponse)
+    app.router.route_class = TrustedJSONRoute
+    returned = {}
+
+    @app.get("/user")
+    async def user() -> BaseUser:
+        return returned["value"]
+
+    @app.get("/users")
+    async def users() -> list[BaseUser]:
+        return returned["value"]
+
+    client = TestClient(app, raise_server_exceptions=False)
+    image = PrivateImage(url="http://a/1.png", signed_url="secret")
+    user_in = UserIn(username="alice", password="secret", avatar=image, tags=["x"])
+    expected = {"username": "alice", "avatar": {"url": "http://a/1.png"}, "tags": ["x"]}
+    route = next(route for route in app.routes if getattr(route, "path", None) == "/users")
+
+    returned["value"] = user_in
+    assert client.get("/user").json() == expected
+    returned["value"] = [user_in, BaseUser(username="bob")]
+    assert client.get("/users").json() == [
+        expected,
+        {"username": "bob", "avatar": None, "tags": []},
+    ]
+    # Not trusted, so validated: dicts, incompatible subclasses, invalid data.
+    returned["value"] = [{"username": "carol", "password": "secret"}]
+    assert client.get("/users").json() == [{"username": "carol", "avatar": None, "tags": []}]
+    returned["value"] = Renamed(username=1)
+    assert client.get("/user").json() == {"username": "1", "avatar": None, "tags": []}
+    returned["value"] = [{"username": None}]
+    assert client.get("/users").status_code == 500
+    assert route.trusted_encoder([user_in]) == [expected]
+
+
+def test_field_plans():
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+    from pydantic import Field
+
+    class Image(BaseModel):
+        url: str
+        name: str | None = None
+
+    class Item(BaseModel):
+        name: str
+        description: str | None = None
+        price: float = Field(alias="cost")
+        tax: float | None = None
+        images: list[Image] = []
+
+    options = {
+        "include": {"response_model_include": {"name", "description"}},
+        "exclude": {"response_model_exclude": {"tax": ..., "images": {"__all__": {"url"}}}},
+        "unset": {"response_model_exclude_unset": True},
+        "no_alias": {"response_model_by_alias": False},
+        # List items by index: not compiled, the stock handler is used.
+        "index": {"response_model_exclude": {"images": {0}}},
+    }
+    returned = {}
+    clients = {}
+    routes = {}
+    for route_class in (APIRoute, FastJSONRoute, TrustedJSONRoute):
+        app = FastAPI(default_response_class=FastJSONResponse)
+        app.router.route_class = route_class
+        for name, kwargs in options.items():
+
+            @app.get(f"/item/{name}", response_model=Item, **kwargs)
+            async def item():
+                return returned["value"]
+
+            @app.get(f"/items/{name}", response_model=list[Item], **kwargs)
+            async def items():
+                return [returned["value"]] * 2
+
+        @app.get("/table", response_model=dict[str, Item], response_model_exclude_unset=True)
+        async def table():
+            return {"a": returned["value"], "b": {"name": "b", "cost": 1}}
+
+        clients[route_class] = TestClient(app)
+        routes[route_class] = {route.path: route for route in app.routes}
+
+    image = Image(url="http://a/1.png")
+    for value in (
+        Item(name="a", cost=1.5, images=[image, {"url": "u", "name": "n"}]),
+        {"name": "a", "cost": 2, "tax": None, "images": [{"url": "u"}]},
+    ):
+        returned["value"] = value
+        for path in [f"/{kind}/{name}" for kind in ("item", "items") for name in options] + [
+            "/table"
+        ]:
+            expected = clients[APIRoute].get(path).json()
+            assert clients[FastJSONRoute].get(path).json() == expected, path
+            assert clients[TrustedJSONRoute].get(path).json() == expected, path
+    # Encoders are compiled when routes are set up, not per response.
+    from compiled_encoder import declared_encoders
+
+    compiled = len(declared_encoders)
+    clients[FastJSONRoute].get("/items/unset")
+    clients[TrustedJSONRoute].get("/table")
+    assert len(declared_encoders) == compiled
+    route = routes[FastJSONRoute]
+    assert route["/items/include"].validated_encoder is not None
+    assert route["/items/index"].validated_encoder is None
+    assert not route["/items/index"].fast_path()
+
+
+async def bench(args):
+    """Response time for list[Item] responses with each response and route class."""
+    from fastapi import APIRouter, FastAPI
+    from fastapi.responses import JSONResponse
+
+    class Image(BaseModel):
+        url: str
+        name: str
+
+    class Item(BaseModel):
+        name: str
+        description: str | None = None
+        price: float
+        tax: float | None = None
+        tags: list[str] = []
+        images: list[Image] = []
+
+    sizes = {"small": 10, "medium": 100, "large": 1000, "10k": 10_000}
+    items = {
+        size: [
+            Item(
+                name=f"Item {n}",
+                description="The pretender",
+                price=42.0,
+                tax=3.2,
+                tags=["rock", "metal"],
+                images=[{"url": f"http://example.com/{n}.jpg", "name": "cover"}],
+            )
+            for n in range(count)
+        ]
+        for size, count in sizes.items()
+    }
+    variants = {
+        "JSONResponse": (JSONResponse, APIRoute),
+        "FastJSONResponse": (FastJSONResponse, APIRoute),
+        "FastJSONRoute": (FastJSONResponse, FastJSONRoute),
+        "TrustedJSONRoute": (FastJSONResponse, TrustedJSONRoute),
+    }
+    apps = {}
+    for name, (response_class, route_class) in variants.items():
+        router = APIRouter(route_class=route_class)
+        for size in sizes:
+
+            async def endpoint(size=size) -> list[Item]:
+                return items[size]
+
+            router.add_api_route(f"/{size}", endpoint, response_model=list[Item])
+        apps[name] = FastAPI(default_response_class=response_class)
+        apps[name].include_router(router)
+
+    for size, count in sizes.items():
+        requests = max(5, args.requests // count)
+        bodies = {}
+        for name, app in apps.items():
+            elapsed, bodies[name] = await timed(app, f"/{size}", requests)
+            print(f"{size:<6} {count:>5} items  {name:<18} {elapsed * 1e6:10.1f} us/request")
+        assert len({orjson.dumps(orjson.loads(body)) for body in bodies.values()}) == 1
+
+
+async def timed(app, path: str, requests: int) -> tuple[float, bytes]:
+    """Seconds per GET request to ``path`` and the last response body."""
+    import time
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    for _ in range(10):
+        await app(dict(scope), receive, send)
+    start = time.perf_counter()
+    for _ in range(requests):
+        messages.clear()
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - start) / requests, messages[-1]["body"]
+
+
+async def bench_plans(args):
+    """Response time for items-style dicts with include / exclude_unset."""
+    from fastapi import APIRouter, FastAPI
+
+    class Item(BaseModel):
+        name: str
+        description: str | None = None
+        price: float
+        tax: float | None = None
+        tags: list[str] = []
+
+    sizes = {"1k": 1000, "10k": 10_000}
+    items = {
+        size: [
+            {"name": f"Item {n}", "price": 50.2, "tags": ["rock"]}
+            if n % 2
+            else {"name": f"Item {n}", "description": "The bartenders", "price": 62, "tax": 20.2}
+            for n in range(count)
+        ]
+        for size, count in sizes.items()
+    }
+    plans = {
+        "include": ({"response_model_include": {"name", "description"}}, list[Item]),
+        "exclude_unset": ({"response_model_exclude_unset": True}, list[Item]),
+        "dict exclude_unset": ({"response_model_exclude_unset": True}, dict[str, Item]),
+    }
+    apps = {}
+    for route_class in (APIRoute, FastJSONRoute, TrustedJSONRoute):
+        router = APIRouter(route_class=route_class)
+        for plan, (kwargs, response_model) in plans.items():
+            for size in sizes:
+
+                async def endpoint(size=size, mapping=response_model.__origin__ is dict):
+                    if mapping:
+                        return {item["name"]: item for item in items[size]}
+                    return items[size]
+
+                router.add_api_route(
+                    f"/{plan}/{size}", endpoint, response_model=response_model, **kwargs
+                )
+        apps[route_class.__name__] = FastAPI(default_response_class=FastJSONResponse)
+        apps[route_class.__name__].include_router(router)
+
+    for plan in plans:
+        for size, count in sizes.items():
+            requests = max(5, args.requests // count)
+            bodies = {}
+            for name, app in apps.items():
+                elapsed, bodies[name] = await timed(app, f"/{plan}/{size}", requests)
+                print(f"{plan:<18} {count:>5} items  {name:<16} {elapsed * 1e3:8.2f} ms/request")
+            assert len({orjson.dumps(orjson.loads(body)) for body in bodies.values()}) == 1
+
+
+if __name__ == "__main__":
+    import argparse
+
+    benchmarks = {"responses": bench, "plans": bench_plans}
+    parser = argparse.ArgumentParser(description="Benchmarks for this module.")
+    parser.add_argument("benchmark", choices=benchmarks, nargs="?", default="responses")
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+    asyncio.run(benchmarks[args.benchmark](args))
@@ -6,9 +6,10 @@
 from datetime import datetime
 
 from fastapi import FastAPI
-from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 
+from compiled_encoder import fast_jsonable_encoder
+
 fake_db = {}
 
 
@@ -22,7 +23,9 @@ app = FastAPI()
 
 @app.put("/items/{id}")
 def update_item(id: str, item: Item):
-    json_compatible_item_data = jsonable_encoder(item)
+    # Same result as jsonable_encoder(item), from a function generated once
+    # for Item, see compiled_encoder.py.
+    json_compatible_item_data = fast_jsonable_encoder(item)
     fake_db[id] = json_compatible_item_data
     
 
@@ -2,6 +2,8 @@
 
 from fastapi import FastAPI
 
+from app.openapi_cache import cache_openapi
+
 description = """
 ChimichangApp API helps you do awesome stuff. 🚀
 
@@ -37,3 +39,8 @@ app = FastAPI(
 @app.get("/items/")
 async def read_items():
     return [{"name": "Katana"}]
+
+
+# All this metadata ends up in the OpenAPI schema, built at startup in the
+# background and served pre-serialized with an ETag, see app/openapi_cache.py.
+cache_openapi(app)
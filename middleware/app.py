@@ -1,64 +1,25 @@
 # /app.py
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from fastapi import FastAPI
 from fastapi.testclient import TestClient
-from datetime import datetime, timedelta
-
-class RateLimitingMiddleware(BaseHTTPMiddleware):
-    # Rate limiting configurations
-    RATE_LIMIT_DURATION = timedelta(minutes=1)
-    RATE_LIMIT_REQUESTS = 3
-
-    def __init__(self, app):
-        super().__init__(app)
-        # Dictionary to store request counts for each IP
-        self.request_counts = {}
-
-    async def dispatch(self, request, call_next):
-        # Get the client's IP address
-        client_ip = request.client.host
-
-        # Check if IP is already present in request_counts
-        request_count, last_request = self.request_counts.get(client_ip, (0, datetime.min))
-
-        # Calculate the time elapsed since the last request
-        elapsed_time = datetime.now() - last_request
-
-        if elapsed_time > self.RATE_LIMIT_DURATION:
-            # If the elapsed time is greater than the rate limit duration, reset the count
-            request_count = 1
-        else:
-            if request_count >= self.RATE_LIMIT_REQUESTS:
-                # If the request count exceeds the rate limit, return a JSON response with an error message
-                return JSONResponse(
-                    status_code=429,
-                    content={"message": "Rate limit exceeded. Please try again later."}
-                )
-            request_count += 1
-
-        # Update the request count and last request timestamp for the IP
-        self.request_counts[client_ip] = (request_count, datetime.now())
-
-        # Proceed with the request
-        response = await call_next(request)
-        return response
 
+from .cors import CORSMetrics, FastCORSMiddleware
+from .ratelimit import Limit, MemoryStore, RateLimitingMiddleware
+from .rewrite import PathRewriteMiddleware
 
 app = FastAPI()
 
-app.add_middleware(RateLimitingMiddleware)
+# 3 requests per minute per client IP, see ratelimit.py for per-route limits,
+# other client keys and sharing the limits between workers.
+app.add_middleware(RateLimitingMiddleware, default=Limit(requests=3, period=60))
 
-@app.middleware("http")
-async def modify_request_response_middleware(request: Request, call_next):
-    # Intercept and modify the incoming request
-    request.scope["path"] = str(request.url.path).replace("api", "apiv2")
-    # Process the modified request
-    response = await call_next(request)
-    # Transform the outgoing response
-    if isinstance(response, StreamingResponse):
-        response.headers["X-Custom-Header"] = "Modified"
-    return response
+# Rewrites /api/... to /apiv2/... and tags every response, see rewrite.py.
+# Added last so it is the outermost middleware, the rate limiter sees the
+# rewritten path.
+app.add_middleware(
+    PathRewriteMiddleware,
+    prefixes={"/api": "/apiv2"},
+    headers={"X-Custom-Header": "Modified"},
+)
 
 
 @app.get("/info")
@@ -80,4 +41,137 @@ def test_modify_request_response_middleware():
     # Assert the middleware has been applied
     assert response.headers.get("X-Custom-Header") == "Modified"
     # Assert the response content
-    assert response.json() == {"message": "Hello, World!"}
\ No newline at end of file
+    assert response.json() == {"message": "Hello, World!"}
+
+
+def test_path_rewrite_middleware():
+    rewrite_app = FastAPI()
+    rewrite_app.add_middleware(
+        PathRewriteMiddleware,
+        prefixes={"/api": "/apiv2"},
+        headers={"X-Custom-Header": "Modified"},
+    )
+
+    @rewrite_app.get("/apiv2/info")
+    async def rewritten():
+        return {"message": "Hello, World from V2"}
+
+    rewrite_client = TestClient(rewrite_app)
+    response = rewrite_client.get("/api/info")
+    assert response.json() == {"message": "Hello, World from V2"}
+    assert response.headers["X-Custom-Header"] == "Modified"
+    # Only whole segments are rewritten, and error responses get the header too.
+    response = rewrite_client.get("/apiary/info")
+    assert response.status_code == 404
+    assert response.headers["X-Custom-Header"] == "Modified"
+
+
+def test_rate_limiting_middleware():
+    limited_app = FastAPI()
+    limited_app.add_middleware(
+        RateLimitingMiddleware,
+        default=Limit(requests=2, period=60),
+        routes={"/health": Limit(requests=100, period=1)},
+    )
+
+    @limited_app.get("/info")
+    async def limited_hello():
+        return {"message": "Hello, World!"}
+
+    @limited_app.get("/health")
+    async def health():
+        return {"status": "ok"}
+
+    @limited_app.get("/healthz")
+    async def healthz():
+        return {"status": "ok"}
+
+    limited_client = TestClient(limited_app)
+    assert [limited_client.get("/info").status_code for _ in range(3)] == [200, 200, 429]
+    assert limited_client.get("/info").headers["Retry-After"] == "30"
+    # Its own bucket, for whole segments only: /healthz shares the default
+    # one /info used up.
+    assert limited_client.get("/health").status_code == 200
+    assert limited_client.get("/healthz").status_code == 429
+
+    # Idle buckets are dropped once full again, and there are never more
+    # than max_keys of them.
+    store = MemoryStore(max_keys=10)
+    limit = Limit(requests=2, period=60)
+    for n in range(50):
+        store.consume(f"client-{n}", limit, now=0.0)
+    assert len(store.buckets) == 10
+    store.consume("late-client", limit, now=31.0)
+    assert list(store.buckets) == ["late-client"]
+
+
+def test_fast_cors_middleware():
+    from fastapi.middleware.cors import CORSMiddleware
+
+    def cors_client(middleware, **options):
+        cors_app = FastAPI()
+        cors_app.add_middleware(middleware, **options)
+
+        @cors_app.get("/")
+        async def root():
+            return {"message": "Hello World"}
+
+        return TestClient(cors_app)
+
+    requests = [
+        ("GET", {}),
+        ("GET", {"Origin": "http://localhost:8080"}),
+        ("GET", {"Origin": "https://evil.example"}),
+        ("GET", {"Origin": "https://evil.example", "Cookie": "a=b"}),
+        ("OPTIONS", {"Origin": "http://localhost", "Access-Control-Request-Method": "GET"}),
+        ("OPTIONS", {"Origin": "https://evil.example", "Access-Control-Request-Method": "GET"}),
+        ("OPTIONS", {"Origin": "http://localhost", "Access-Control-Request-Method": "TRACE"}),
+        (
+            "OPTIONS",
+            {
+                "Origin": "http://localhost",
+                "Access-Control-Request-Method": "POST",
+                "Access-Control-Request-Headers": "X-Token, Content-Type",
+            },
+        ),
+    ]
+    configurations = [
+        {"allow_origins": ["http://localhost", "http://localhost:8080"]},
+        {"allow_origins": ["http://localhost"], "allow_headers": ["*"], "allow_methods": ["*"]},
+        {"allow_origins": ["*"], "allow_credentials": True, "expose_headers": ["X-Total"]},
+        {"allow_origins": ["*"], "allow_headers": ["X-Token"], "max_age": 7200},
+        {"allow_origin_regex": r"http://localhost(:\d+)?", "allow_credentials": True},
+    ]
+    for options in configurations:
+        stock = cors_client(CORSMiddleware, **options)
+        fast = cors_client(FastCORSMiddleware, **options)
+        for method, headers in requests:
+            expected = stock.request(method, "/", headers=headers)
+            response = fast.request(method, "/", headers=headers)
+            assert response.status_code == expected.status_code, (options, method, headers)
+            assert response.content == expected.content
+            for name in set(expected.headers) | set(response.headers):
+                if name.startswith("access-control-") or name == "vary":
+                    assert response.headers.get(name) == expected.headers.get(name), name
+
+    # Wildcard origins, and preflights for them are built once then reused.
+    metrics = CORSMetrics()
+    wildcard = cors_client(
+        FastCORSMiddleware, allow_origins=["https://*.example.com"], metrics=metrics
+    )
+    preflight = {"Access-Control-Request-Method": "GET"}
+    for origin, allowed in [
+        ("https://app.example.com", True),
+        ("https://app.example.com", True),
+        ("https://example.com", False),
+        ("https://evil.com/.example.com", False),
+    ]:
+        response = wildcard.options("/", headers={"Origin": origin, **preflight})
+        assert (response.status_code == 200) is allowed
+    assert metrics.snapshot() == {
+        "preflights": 4,
+        "preflight_hits": 1,
+        "preflight_hit_rate": 0.25,
+        "preflight_rejected": 2,
+        "simple": 0,
+    }
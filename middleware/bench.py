@@ -0,0 +1,219 @@
+"""Per-request overhead of the middlewares in this package.
+
+Run from the repository root:
+
+    python -m middleware.bench --requests 20000
+
+Each case wraps the same bare ASGI endpoint and is driven directly through
+the ASGI interface, so the numbers are the middleware's own cost without
+a server or client in the way.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.cors import CORSMiddleware
+
+from .cors import FastCORSMiddleware
+from .ratelimit import Limit, MemoryStore, RateLimitingMiddleware, SQLiteStore
+from .rewrite import PathRewriteMiddleware
+
+
+async def endpoint(scope, receive, send):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"application/json")],
+        }
+    )
+    await send({"type": "http.response.body", "body": b'{"message":"Hello, World!"}'})
+
+
+async def passthrough(request, call_next):
+    return await call_next(request)
+
+
+async def legacy_rewrite(request: Request, call_next):
+    # app.py's modify_request_response_middleware before PathRewriteMiddleware.
+    request.scope["path"] = str(request.url.path).replace("api", "apiv2")
+    response = await call_next(request)
+    if isinstance(response, StreamingResponse):
+        response.headers["X-Custom-Header"] = "Modified"
+    return response
+
+
+def http_scope(path: str, client: str, method: str = "GET", headers: dict | None = None):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"host", b"bench"),
+            *((k.lower().encode(), v.encode()) for k, v in (headers or {}).items()),
+        ],
+        "client": (client, 50000),
+        "server": ("bench", 80),
+    }
+
+
+async def drive(
+    app,
+    requests: int,
+    clients: int,
+    path: str = "/info",
+    method: str = "GET",
+    headers: dict | None = None,
+):
+    scopes = [
+        http_scope(path, f"10.0.{n // 256}.{n % 256}", method, headers) for n in range(clients)
+    ]
+
+    def receiver():
+        # The request body once, then the client disconnects.
+        messages = iter([{"type": "http.request", "body": b"", "more_body": False}])
+
+        async def receive():
+            return next(messages, {"type": "http.disconnect"})
+
+        return receive
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for n in range(requests):
+        await app(dict(scopes[n % clients]), receiver(), send)
+    return (time.perf_counter() - start) / requests
+
+
+def cases(tmp: str):
+    unlimited = Limit(requests=10**9, period=1)
+    return {
+        "bare endpoint": endpoint,
+        "BaseHTTPMiddleware no-op": BaseHTTPMiddleware(endpoint, dispatch=passthrough),
+        "rate limit, memory": RateLimitingMiddleware(
+            endpoint, default=unlimited, store=MemoryStore()
+        ),
+        "rate limit, sqlite": RateLimitingMiddleware(
+            endpoint, default=unlimited, store=SQLiteStore(os.path.join(tmp, "limits.db"))
+        ),
+        "rewrite, @app.middleware": BaseHTTPMiddleware(endpoint, dispatch=legacy_rewrite),
+        "rewrite, PathRewriteMiddleware": PathRewriteMiddleware(
+            endpoint, prefixes={"/api": "/apiv2"}, headers={"X-Custom-Header": "Modified"}
+        ),
+    }
+
+
+def cors_cases():
+    options = {
+        "allow_origins": [
+            "http://localhost.tiangolo.com",
+            "https://localhost.tiangolo.com",
+            "http://localhost",
+            "http://localhost:8080",
+            "https://*.example.com",
+        ],
+        "allow_credentials": True,
+        "allow_methods": ["*"],
+        "allow_headers": ["*"],
+    }
+    preflight = {
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "content-type, authorization",
+    }
+    # The stock middleware has no wildcard origins, give it the same regex.
+    stock = CORSMiddleware(
+        endpoint,
+        **{**options, "allow_origins": options["allow_origins"][:-1]},
+        allow_origin_regex=r"https://[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*\.example\.com",
+    )
+    fast = FastCORSMiddleware(endpoint, **options)
+    requests = {
+        "preflight, listed origin": (
+            "OPTIONS",
+            {"Origin": "http://localhost:8080", **preflight},
+        ),
+        "preflight, wildcard origin": (
+            "OPTIONS",
+            {"Origin": "https://app.example.com", **preflight},
+        ),
+        "preflight, rejected origin": ("OPTIONS", {"Origin": "https://evil.test", **preflight}),
+        "simple GET, listed origin": ("GET", {"Origin": "http://localhost:8080"}),
+    }
+    return {"CORSMiddleware": stock, "FastCORSMiddleware": fast}, requests
+
+
+def latency_through_testclient(requests: int):
+    """Mean latency of app.py's test request, client.get("/info"), per rewrite."""
+    results = {}
+    for name in ("@app.middleware", "PathRewriteMiddleware"):
+        app = FastAPI()
+        if name == "@app.middleware":
+            app.middleware("http")(legacy_rewrite)
+        else:
+            app.add_middleware(
+                PathRewriteMiddleware,
+                prefixes={"/api": "/apiv2"},
+                headers={"X-Custom-Header": "Modified"},
+            )
+
+        @app.get("/info")
+        async def hello():
+            return {"message": "Hello, World!"}
+
+        with TestClient(app) as client:
+            for _ in range(100):
+                client.get("/info")
+            start = time.perf_counter()
+            for _ in range(requests):
+                response = client.get("/info")
+            results[name] = (time.perf_counter() - start) / requests
+            assert response.headers["X-Custom-Header"] == "Modified"
+    return results
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        baseline = None
+        for name, app in cases(tmp).items():
+            await drive(app, min(1000, args.requests), args.clients)
+            per_request = await drive(app, args.requests, args.clients)
+            baseline = per_request if baseline is None else baseline
+            print(
+                f"{name:<32} {per_request * 1e6:8.2f} us/request"
+                f"  (+{(per_request - baseline) * 1e6:.2f} us)"
+            )
+    print("\nCORS")
+    middlewares, requests = cors_cases()
+    for case, (method, headers) in requests.items():
+        for name, app in middlewares.items():
+            await drive(app, min(1000, args.requests), 1, method=method, headers=headers)
+            per_request = await drive(app, args.requests, 1, method=method, headers=headers)
+            print(
+                f"{case:<28} {name:<20} {per_request * 1e6:8.2f} us/request"
+                f"  ({1 / per_request:9.0f} req/s)"
+            )
+    print("\nTestClient round trip, GET /info")
+    for name, latency in latency_through_testclient(args.requests // 10).items():
+        print(f"{name:<32} {latency * 1e6:8.2f} us/request")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=10000)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,251 @@
+# CORS as a plain ASGI middleware, with the origin checks and header blocks
+# worked out ahead of time.
+
+# Starlette's CORSMiddleware checks the origin against a list and a regex and
+# builds a new header dict and response for every preflight. Here exact
+# origins live in a frozenset, wildcard origins ("https://*.example.com") and
+# allow_origin_regex are compiled into one regex whose alternatives share
+# their common prefixes, and the complete raw header block of a preflight is
+# built once per allowed origin and reused.
+
+import re
+from dataclasses import dataclass
+
+ALL_METHODS = ("DELETE", "GET", "HEAD", "OPTIONS", "PATCH", "POST", "PUT")
+SAFELISTED_HEADERS = {"Accept", "Accept-Language", "Content-Language", "Content-Type"}
+
+
+def origin_pattern(origins) -> str | None:
+    """One regex for wildcard origins, as a trie so shared prefixes match once.
+
+    "*" stands for one or more DNS labels, so "https://*.example.com"
+    matches "https://app.example.com" and "https://a.b.example.com" but
+    not "https://example.com" or "https://evil.com/.example.com".
+    """
+    end = object()
+    trie = {}
+    for origin in origins:
+        node = trie
+        for char in origin:
+            token = r"[a-zA-Z0-9-]+(?:\.[a-zA-Z0-9-]+)*" if char == "*" else re.escape(char)
+            node = node.setdefault(token, {})
+        node[end] = {}
+    if not trie:
+        return None
+
+    def emit(node) -> str:
+        optional = end in node
+        branches = [token + emit(child) for token, child in node.items() if token is not end]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not optional:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")" + ("?" if optional else "")
+
+    return emit(trie)
+
+
+@dataclass
+class CORSMetrics:
+    preflights: int = 0
+    # Preflights answered from a header block built earlier.
+    preflight_hits: int = 0
+    preflight_rejected: int = 0
+    simple: int = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "preflights": self.preflights,
+            "preflight_hits": self.preflight_hits,
+            "preflight_hit_rate": self.preflight_hits / self.preflights if self.preflights else 0.0,
+            "preflight_rejected": self.preflight_rejected,
+            "simple": self.simple,
+        }
+
+
+class FastCORSMiddleware:
+    """Drop-in for CORSMiddleware with the same arguments and responses.
+
+    ``allow_origins`` may also hold wildcard origins like
+    "https://*.example.com". Header blocks for origins that only match a
+    wildcard or ``allow_origin_regex`` are built on first use and kept for
+    up to ``max_cached_origins`` origins. Pass a CORSMetrics as ``metrics``
+    to read the counters from outside the middleware.
+    """
+
+    def __init__(
+        self,
+        app,
+        allow_origins=(),
+        allow_methods=("GET",),
+        allow_headers=(),
+        allow_credentials: bool = False,
+        allow_origin_regex: str | None = None,
+        expose_headers=(),
+        max_age: int = 600,
+        max_cached_origins: int = 10_000,
+        metrics: CORSMetrics | None = None,
+    ):
+        self.app = app
+        if "*" in allow_methods:
+            allow_methods = ALL_METHODS
+        self.allow_methods = frozenset(allow_methods)
+        self.allow_all_origins = "*" in allow_origins
+        self.allow_all_headers = "*" in allow_headers
+        self.allow_headers = frozenset(
+            header.lower() for header in SAFELISTED_HEADERS | set(allow_headers)
+        )
+        self.allow_credentials = allow_credentials
+        self.explicit_origin = not self.allow_all_origins or allow_credentials
+        self.exact_origins = frozenset(origin for origin in allow_origins if "*" not in origin)
+        wildcards = [origin for origin in allow_origins if "*" in origin and origin != "*"]
+        patterns = [p for p in (origin_pattern(wildcards), allow_origin_regex) if p]
+        self.origin_regex = re.compile("|".join(f"(?:{p})" for p in patterns)) if patterns else None
+        self.max_cached_origins = max_cached_origins
+        self.metrics = metrics or CORSMetrics()
+
+        self.simple_headers = []
+        if self.allow_all_origins:
+            self.simple_headers.append((b"access-control-allow-origin", b"*"))
+        if allow_credentials:
+            self.simple_headers.append((b"access-control-allow-credentials", b"true"))
+        if expose_headers:
+            self.simple_headers.append(
+                (b"access-control-expose-headers", ", ".join(expose_headers).encode())
+            )
+
+        self.preflight_headers = []
+        if self.explicit_origin:
+            self.preflight_headers.append((b"vary", b"Origin"))
+        else:
+            self.preflight_headers.append((b"access-control-allow-origin", b"*"))
+        self.preflight_headers += [
+            (b"access-control-allow-methods", ", ".join(allow_methods).encode()),
+            (b"access-control-max-age", str(max_age).encode()),
+        ]
+        if not self.allow_all_headers:
+            self.preflight_headers.append(
+                (
+                    b"access-control-allow-headers",
+                    ", ".join(sorted(SAFELISTED_HEADERS | set(allow_headers))).encode(),
+                )
+            )
+        if allow_credentials:
+            self.preflight_headers.append((b"access-control-allow-credentials", b"true"))
+
+        # origin -> (preflight header block, simple response headers), only
+        # for allowed origins.
+        self.blocks = {
+            origin: self.build_blocks(origin.encode("latin-1")) for origin in self.exact_origins
+        }
+
+    def build_blocks(self, origin: bytes):
+        preflight = list(self.preflight_headers)
+        simple = list(self.simple_headers)
+        if self.explicit_origin:
+            preflight.append((b"access-control-allow-origin", origin))
+        if not self.allow_all_origins:
+            simple += [(b"access-control-allow-origin", origin), (b"vary", b"Origin")]
+        return preflight, simple
+
+    def lookup(self, origin: str):
+        """The header blocks for ``origin``, None if it isn't allowed."""
+        blocks = self.blocks.get(origin)
+        if blocks is not None:
+            return blocks
+        if not (
+            self.allow_all_origins
+            or (self.origin_regex is not None and self.origin_regex.fullmatch(origin))
+        ):
+            return None
+        if len(self.blocks) >= self.max_cached_origins + len(self.exact_origins):
+            self.blocks = {o: self.blocks[o] for o in self.exact_origins}
+        blocks = self.blocks[origin] = self.build_blocks(origin.encode("latin-1"))
+        return blocks
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        origin = request_method = request_headers = None
+        has_cookie = False
+        for name, value in scope["headers"]:
+            if name == b"origin":
+                origin = value.decode("latin-1")
+            elif name == b"access-control-request-method":
+                request_method = value.decode("latin-1")
+            elif name == b"access-control-request-headers":
+                request_headers = value
+            elif name == b"cookie":
+                has_cookie = True
+        if origin is None:
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] == "OPTIONS" and request_method is not None:
+            await self.preflight(send, origin, request_method, request_headers)
+            return
+        await self.simple(scope, receive, send, origin, has_cookie)
+
+    async def preflight(self, send, origin: str, method: str, requested_headers: bytes | None):
+        metrics = self.metrics
+        metrics.preflights += 1
+        hit = origin in self.blocks
+        blocks = self.lookup(origin)
+        failures = []
+        if blocks is None:
+            failures.append("origin")
+            headers = self.preflight_headers
+        else:
+            headers = blocks[0]
+            metrics.preflight_hits += hit
+        if method not in self.allow_methods:
+            failures.append("method")
+        if requested_headers is not None:
+            if self.allow_all_headers:
+                headers = [*headers, (b"access-control-allow-headers", requested_headers)]
+            elif any(
+                header.strip() not in self.allow_headers
+                for header in requested_headers.decode("latin-1").lower().split(",")
+            ):
+                failures.append("headers")
+        if failures:
+            metrics.preflight_rejected += 1
+            body = ("Disallowed CORS " + ", ".join(failures)).encode()
+            status = 400
+        else:
+            body, status = b"OK", 200
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    *headers,
+                    (b"content-length", str(len(body)).encode()),
+                    (b"content-type", b"text/plain; charset=utf-8"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def simple(self, scope, receive, send, origin: str, has_cookie: bool):
+        self.metrics.simple += 1
+        if self.allow_all_origins and has_cookie:
+            # A credentialed request can't be answered with "*".
+            extra = [
+                *(h for h in self.simple_headers if h[0] != b"access-control-allow-origin"),
+                (b"access-control-allow-origin", origin.encode("latin-1")),
+                (b"vary", b"Origin"),
+            ]
+        else:
+            blocks = self.lookup(origin)
+            extra = blocks[1] if blocks is not None else self.simple_headers
+        if not extra:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), *extra]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
@@ -0,0 +1,200 @@
+# Rate limiting as a plain ASGI middleware.
+
+# Token bucket: every key gets a bucket of ``requests`` tokens that refills at
+# ``requests / period`` tokens per second, and each request takes one. A bucket
+# that has been idle long enough to be full again is the same as no bucket, so
+# stores can drop it, that is what keeps memory bounded.
+
+import json
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable
+
+from starlette.concurrency import run_in_threadpool
+
+
+def client_ip(scope) -> str:
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def header_key(name: str) -> Callable:
+    """Key requests by the value of header ``name``, falling back to the IP."""
+    raw_name = name.lower().encode("latin-1")
+
+    def key(scope) -> str:
+        for header, value in scope["headers"]:
+            if header == raw_name:
+                return f"{name}:{value.decode('latin-1')}"
+        return client_ip(scope)
+
+    return key
+
+
+def bearer_token(scope) -> str:
+    """Key requests by their bearer token, falling back to the IP."""
+    for header, value in scope["headers"]:
+        if header == b"authorization" and value[:7].lower() == b"bearer ":
+            return f"token:{value[7:].decode('latin-1')}"
+    return client_ip(scope)
+
+
+@dataclass(frozen=True)
+class Limit:
+    requests: int
+    period: float
+    key: Callable = client_ip
+
+    @property
+    def rate(self) -> float:
+        return self.requests / self.period
+
+
+class MemoryStore:
+    """Buckets for a single process, at most ``max_keys`` of them."""
+
+    # consume() never waits on I/O, it can run on the event loop.
+    blocking = False
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated, idle_after), least recently used first.
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, limit: Limit, now: float | None = None):
+        """Take a token for ``key``, returns (allowed, seconds until next token)."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            tokens, updated, _ = self.buckets.pop(key, (limit.requests, now, 0.0))
+            tokens = min(limit.requests, tokens + (now - updated) * limit.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            full_again = now + (limit.requests - tokens) / limit.rate
+            self.buckets[key] = (tokens, now, full_again)
+            self.evict(now)
+        return allowed, 0.0 if allowed else (1 - tokens) / limit.rate
+
+    def evict(self, now: float):
+        while self.buckets:
+            oldest = next(iter(self.buckets))
+            if len(self.buckets) <= self.max_keys and self.buckets[oldest][2] > now:
+                break
+            del self.buckets[oldest]
+
+
+class SQLiteStore:
+    """Buckets in a SQLite file, shared by every worker process on the host.
+
+    Each consume is one short write transaction, so this is for a few
+    workers on one machine. Point several hosts at a networked store
+    (e.g. Redis running the same arithmetic in a Lua script) instead.
+    """
+
+    # consume() can wait up to the busy timeout for another worker's write
+    # transaction, the middleware runs it in the threadpool.
+    blocking = True
+
+    def __init__(self, path: str, evict_every: float = 60.0):
+        self.path = path
+        self.evict_every = evict_every
+        self.next_eviction = 0.0
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                " key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_again REAL)"
+            )
+
+    def connect(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def consume(self, key: str, limit: Limit, now: float | None = None):
+        # Wall clock, not monotonic: it has to agree across processes.
+        now = time.time() if now is None else now
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE key = ?", (key,)
+            ).fetchone()
+            tokens, updated = row if row else (limit.requests, now)
+            tokens = min(limit.requests, tokens + max(0.0, now - updated) * limit.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            full_again = now + (limit.requests - tokens) / limit.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                (key, tokens, now, full_again),
+            )
+            if now >= self.next_eviction:
+                conn.execute("DELETE FROM buckets WHERE full_again <= ?", (now,))
+                self.next_eviction = now + self.evict_every
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed, 0.0 if allowed else (1 - tokens) / limit.rate
+
+
+class RateLimitingMiddleware:
+    """Token-bucket rate limiting, per client key and per route.
+
+    ``routes`` maps path prefixes to their own Limit, the longest matching
+    prefix wins and anything else gets ``default``. A prefix matches whole
+    path segments: "/health" covers /health and /health/live, not /healthz. Each Limit carries the
+    key function that tells clients apart (client_ip, bearer_token,
+    header_key(...)). Pass a SQLiteStore as ``store`` to share the limits
+    between workers.
+    """
+
+    def __init__(self, app, default: Limit, routes: dict | None = None, store=None):
+        self.app = app
+        self.default = default
+        self.routes = sorted((routes or {}).items(), key=lambda rule: -len(rule[0]))
+        self.store = store or MemoryStore()
+
+    def limit_for(self, path: str):
+        for prefix, limit in self.routes:
+            if path == prefix or path.startswith(prefix.rstrip("/") + "/"):
+                return prefix, limit
+        return "", self.default
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        prefix, limit = self.limit_for(scope["path"])
+        key = f"{prefix}|{limit.key(scope)}"
+        if getattr(self.store, "blocking", True):
+            allowed, retry_after = await run_in_threadpool(self.store.consume, key, limit)
+        else:
+            allowed, retry_after = self.store.consume(key, limit)
+        if allowed:
+            await self.app(scope, receive, send)
+            return
+        body = json.dumps({"message": "Rate limit exceeded. Please try again later."}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(math.ceil(retry_after)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
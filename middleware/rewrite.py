@@ -0,0 +1,65 @@
+# Path rewriting and response headers as a plain ASGI middleware.
+
+import re
+
+
+class PathRewriteMiddleware:
+    """Rewrite request path prefixes and add headers to every response.
+
+    ``prefixes`` maps an old prefix to its replacement, e.g.
+    ``{"/api": "/apiv2"}``. A prefix only matches whole path segments, so
+    "/api" and "/api/info" are rewritten but "/apiary" and "/v1/api" are
+    not. All the prefixes are compiled into one regex up front, longest
+    first, and the rewrite works on the scope directly without building a
+    Request or URL.
+
+    ``headers`` are appended to the ``http.response.start`` message, so they
+    end up on every response type (plain, JSON, streaming, files, errors).
+    """
+
+    def __init__(self, app, prefixes: dict | None = None, headers: dict | None = None):
+        self.app = app
+        self.prefixes = {
+            prefix.rstrip("/"): replacement.rstrip("/")
+            for prefix, replacement in (prefixes or {}).items()
+        }
+        alternatives = sorted(self.prefixes, key=len, reverse=True)
+        self.pattern = (
+            re.compile("|".join(map(re.escape, alternatives)) + "(?=/|$)")
+            if alternatives
+            else None
+        )
+        self.headers = [
+            (name.lower().encode("latin-1"), value.encode("latin-1"))
+            for name, value in (headers or {}).items()
+        ]
+
+    def rewrite(self, scope):
+        match = self.pattern.match(scope["path"])
+        if match is None:
+            return scope
+        prefix = match.group()
+        replacement = self.prefixes[prefix]
+        scope = dict(scope)
+        scope["path"] = replacement + scope["path"][len(prefix) :]
+        raw_path = scope.get("raw_path")
+        if raw_path is not None and raw_path.startswith(prefix.encode()):
+            scope["raw_path"] = replacement.encode() + raw_path[len(prefix) :]
+        return scope
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        if self.pattern is not None:
+            scope = self.rewrite(scope)
+        if not self.headers or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                message = {**message, "headers": [*message.get("headers", ()), *self.headers]}
+            await send(message)
+
+        await self.app(scope, receive, send_with_headers)
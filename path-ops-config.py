@@ -8,6 +8,8 @@ from enum import Enum
 from fastapi import FastAPI, status
 from pydantic import BaseModel
 
+from app.openapi_cache import cache_openapi
+
 app = FastAPI()
 
 
@@ -90,4 +92,10 @@ async def create_itemx(item: Item):
 
 @app.get("/elements/", tags=["items"], deprecated=True)
 async def read_elements():
-    return [{"item_id": "Foo"}]
\ No newline at end of file
+    return [{"item_id": "Foo"}]
+
+
+# The OpenAPI schema with all of the above (tags, summaries, descriptions,
+# deprecated) is built at startup in the background instead of on the first
+# /openapi.json request, see app/openapi_cache.py.
+cache_openapi(app)
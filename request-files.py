@@ -2,11 +2,33 @@
 
 # You can define files to be uploaded by the client using File.
 
+import asyncio
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from typing import Annotated
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import HTMLResponse
 
-app = FastAPI()
+from fastapi import Depends, FastAPI, File, HTTPException, Request, UploadFile
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse
+from multipart.multipart import MultipartParser, parse_options_header
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The upload directory and threads exist only while the app runs.
+    pipeline = app.state.upload_pipeline = await run_in_threadpool(UploadPipeline, UPLOAD_DIR)
+    try:
+        yield
+    finally:
+        await run_in_threadpool(pipeline.shutdown)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.post("/filesx")
@@ -63,13 +85,308 @@ async def create_files(
     return {"file_sizes": [len(file) for file in files]}
 
 
+# Processing Uploaded Files
+
+# UploadPipeline hashes and stores every file of a request, ``workers`` files
+# at a time on its own threads, with the same HashSink and DiskSink as the
+# streaming uploads below. Each file is read into one reused buffer and the
+# chunk is passed on as a memoryview slice of it, so hashing and writing
+# never copy the data. hashlib and file writes release the GIL on big chunks,
+# which is what lets the files progress in parallel.
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", os.path.join(tempfile.gettempdir(), "uploads"))
+
+
+class UploadPipeline:
+    """Read, hash and store uploaded files on a bounded pool of threads.
+
+    Files are stored content-addressed as ``directory/<sha256>``, so the
+    same upload twice is stored once. results() yields each file's result
+    as soon as that file is done, not in upload order.
+    """
+
+    def __init__(self, directory: str, workers: int = 4, chunk_size: int = 1024**2):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="upload")
+        os.makedirs(directory, exist_ok=True)
+
+    def process(self, file, stored: "StreamedFile") -> dict:
+        """Run the stages for one file object, in a worker thread."""
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        sinks = [HashSink(stored), DiskSink(stored, self.directory)]
+        try:
+            while n := file.readinto(buffer):
+                write_all(sinks, view[:n])
+                stored.size += n
+            close_all(sinks)
+            os.replace(stored.path, os.path.join(self.directory, stored.sha256))
+        except BaseException:
+            if stored.path is None:
+                close_all(sinks, abort=True)
+            else:
+                os.unlink(stored.path)
+            raise
+        return {"size": stored.size, "sha256": stored.sha256}
+
+    async def results(self, files: list[UploadFile]):
+        loop = asyncio.get_running_loop()
+
+        async def run(file: UploadFile):
+            await file.seek(0)
+            stored = StreamedFile(field="files", filename=file.filename)
+            try:
+                result = await loop.run_in_executor(self.executor, self.process, file.file, stored)
+            except OSError as exc:
+                return {"filename": file.filename, "error": str(exc)}
+            return {"filename": file.filename, **result}
+
+        for done in asyncio.as_completed([run(file) for file in files]):
+            yield await done
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def get_upload_pipeline(request: Request) -> UploadPipeline:
+    return request.app.state.upload_pipeline
+
+
 @app.post("/uploadfiles/")
 async def create_upload_files(
     files: Annotated[
         list[UploadFile], File(description="Multiple files as UploadFile")
     ],
+    pipeline: Annotated[UploadPipeline, Depends(get_upload_pipeline)],
+):
+    # One JSON line per file, sent as each one is stored.
+    async def lines():
+        async for result in pipeline.results(files):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# Streaming Uploads
+
+# bytes and list[bytes] hold every upload in memory, and UploadFile still waits
+# for the whole body to be parsed and spooled before the function runs. For big
+# files, parse the multipart body as it arrives and hand each chunk straight to
+# a sink (a hash, a file on disk) so memory stays at about one chunk per upload.
+
+# Sinks are plain blocking objects: StreamedUpload creates and feeds them on
+# the threadpool, so neither the hashing nor the disk I/O runs on the loop.
+
+
+class HashSink:
+    """Keeps a running sha256 of the part."""
+
+    def __init__(self, file: "StreamedFile"):
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes):
+        self.hash.update(data)
+
+    def close(self):
+        self.file.sha256 = self.hash.hexdigest()
+
+    def abort(self):
+        pass
+
+
+class DiskSink:
+    """Writes the part to a new file in ``directory``."""
+
+    def __init__(self, file: "StreamedFile", directory: str):
+        fd, self.path = tempfile.mkstemp(dir=directory, prefix="upload-")
+        self.out = os.fdopen(fd, "wb")
+        self.file = file
+
+    def write(self, data: bytes):
+        self.out.write(data)
+
+    def close(self):
+        self.out.close()
+        self.file.path = self.path
+
+    def abort(self):
+        self.out.close()
+        os.unlink(self.path)
+
+
+def write_all(sinks: list, data: bytes):
+    for sink in sinks:
+        sink.write(data)
+
+
+def close_all(sinks: list, abort: bool = False):
+    for sink in sinks:
+        sink.abort() if abort else sink.close()
+
+
+def decode(value: bytes) -> str:
+    """Decode a part header value: browsers send UTF-8, HTTP's fallback is latin-1."""
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+
+@dataclass
+class StreamedFile:
+    field: str
+    filename: str
+    content_type: str | None = None
+    size: int = 0
+    sha256: str | None = None
+    # Set when the upload was stored with ``directory``, the caller owns it.
+    path: str | None = None
+
+
+class StreamedUpload:
+    """Dependency that streams the multipart body into a list of StreamedFile.
+
+    Every file part is counted and sent through the sinks, a sha256 hash
+    and, with ``directory``, a file on disk. A field (all the parts sent
+    under one name) bigger than its limit, ``field_limits[name]`` or else
+    ``max_field_size``, or a body bigger than ``max_total_size`` is answered
+    with 413 as soon as the limit is crossed, without reading the rest, and
+    whatever was already written to disk is removed. Fields without a
+    filename are skipped, but still count towards the limits.
+    """
+
+    def __init__(
+        self,
+        max_field_size: int = 1024**3,
+        max_total_size: int = 4 * 1024**3,
+        directory: str | None = None,
+        hash: bool = True,
+        field_limits: dict[str, int] | None = None,
+    ):
+        self.max_field_size = max_field_size
+        self.max_total_size = max_total_size
+        self.directory = directory
+        self.hash = hash
+        self.field_limits = field_limits or {}
+
+    def sinks(self, file: StreamedFile):
+        sinks = []
+        if self.hash:
+            sinks.append(HashSink(file))
+        if self.directory is not None:
+            sinks.append(DiskSink(file, self.directory))
+        return sinks
+
+    async def __call__(self, request: Request) -> list[StreamedFile]:
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise HTTPException(status_code=415, detail="Expected multipart/form-data")
+        length = request.headers.get("content-length")
+        if length and length.isdigit() and int(length) > self.max_total_size:
+            raise HTTPException(status_code=413, detail="Request body too large")
+
+        files: list[StreamedFile] = []
+        # The parser callbacks are synchronous, so they only record what
+        # happened and the sinks are awaited after each chunk is parsed.
+        events = []
+        part = {"headers": {}, "field": b"", "value": b"", "file": None, "name": ""}
+        # Bytes received so far per field name.
+        field_sizes: dict[str, int] = {}
+
+        def on_part_begin():
+            part.update(headers={}, file=None, name="")
+
+        def on_header_field(data: bytes, start: int, end: int):
+            part["field"] += data[start:end]
+
+        def on_header_value(data: bytes, start: int, end: int):
+            part["value"] += data[start:end]
+
+        def on_header_end():
+            part["headers"][part["field"].lower()] = part["value"]
+            part.update(field=b"", value=b"")
+
+        def on_headers_finished():
+            _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+            part["name"] = decode(options.get(b"name", b""))
+            if b"filename" not in options:
+                return
+            file = StreamedFile(
+                field=part["name"],
+                filename=decode(options[b"filename"]),
+                content_type=decode(part["headers"].get(b"content-type", b"")) or None,
+            )
+            part["file"] = file
+            events.append(("begin", file, None))
+
+        def on_part_data(data: bytes, start: int, end: int):
+            name = part["name"]
+            size = field_sizes[name] = field_sizes.get(name, 0) + end - start
+            if size > self.field_limits.get(name, self.max_field_size):
+                raise HTTPException(status_code=413, detail=f"Field {name!r} too large")
+            if part["file"] is not None:
+                events.append(("data", part["file"], data[start:end]))
+
+        def on_part_end():
+            if part["file"] is not None:
+                events.append(("end", part["file"], None))
+
+        parser = MultipartParser(
+            params[b"boundary"],
+            {
+                "on_part_begin": on_part_begin,
+                "on_part_data": on_part_data,
+                "on_part_end": on_part_end,
+                "on_header_field": on_header_field,
+                "on_header_value": on_header_value,
+                "on_header_end": on_header_end,
+                "on_headers_finished": on_headers_finished,
+            },
+        )
+        open_sinks = {}
+        received = 0
+        try:
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > self.max_total_size:
+                    raise HTTPException(status_code=413, detail="Request body too large")
+                parser.write(chunk)
+                for event, file, payload in events:
+                    if event == "begin":
+                        open_sinks[id(file)] = await run_in_threadpool(self.sinks, file)
+                        files.append(file)
+                    elif event == "data":
+                        file.size += len(payload)
+                        await run_in_threadpool(write_all, open_sinks[id(file)], payload)
+                    else:
+                        await run_in_threadpool(close_all, open_sinks.pop(id(file)))
+                events.clear()
+            parser.finalize()
+        except BaseException:
+            for sinks in open_sinks.values():
+                await run_in_threadpool(close_all, sinks, abort=True)
+            for file in files:
+                if file.path is not None:
+                    os.unlink(file.path)
+            raise
+        return files
+
+
+stream_files = StreamedUpload()
+
+
+@app.post("/streamfiles/")
+async def create_streamed_files(
+    files: Annotated[list[StreamedFile], Depends(stream_files)],
 ):
-    return {"filenames": [file.filename for file in files]}
+    return {
+        "files": [
+            {"filename": file.filename, "size": file.size, "sha256": file.sha256}
+            for file in files
+        ]
+    }
 
 
 @app.get("/")
@@ -84,6 +401,176 @@ async def main():
 <input name="files" type="file" multiple>
 <input type="submit">
 </form>
+<form action="/streamfiles/" enctype="multipart/form-data" method="post">
+<input name="files" type="file" multiple>
+<input type="submit">
+</form>
 </body>
     """
     return HTMLResponse(content=content)
+
+
+def test_streamed_upload():
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app)
+    files = [("files", ("a.txt", b"hello")), ("files", ("b.bin", b"x" * 100_000))]
+    response = client.post("/streamfiles/", files=files, data={"note": "skipped"})
+    assert response.status_code == 200
+    assert response.json() == {
+        "files": [
+            {"filename": "a.txt", "size": 5, "sha256": hashlib.sha256(b"hello").hexdigest()},
+            {
+                "filename": "b.bin",
+                "size": 100_000,
+                "sha256": hashlib.sha256(b"x" * 100_000).hexdigest(),
+            },
+        ]
+    }
+
+    # Filenames are UTF-8, as browsers send them.
+    response = client.post("/streamfiles/", files=[("files", ("naïve €.txt", b"hi"))])
+    assert response.json()["files"][0]["filename"] == "naïve €.txt"
+
+    with tempfile.TemporaryDirectory() as directory:
+        limited = StreamedUpload(max_field_size=1000, directory=directory, field_limits={"one": 10})
+        app.dependency_overrides[stream_files] = limited
+        try:
+            response = client.post("/streamfiles/", files=[("files", ("big", b"x" * 5000))])
+            assert response.status_code == 413
+            assert os.listdir(directory) == []
+            # The limit is for the whole field, not each part of it.
+            parts = [("files", (f"{n}.bin", b"x" * 600)) for n in range(2)]
+            assert client.post("/streamfiles/", files=parts).status_code == 413
+            assert os.listdir(directory) == []
+            response = client.post("/streamfiles/", files=[("one", ("small", b"x" * 11))])
+            assert response.status_code == 413
+            assert response.json() == {"detail": "Field 'one' too large"}
+            response = client.post("/streamfiles/", files=[("files", ("ok", b"x" * 600))])
+            assert response.status_code == 200
+            os.unlink(os.path.join(directory, os.listdir(directory)[0]))
+        finally:
+            app.dependency_overrides.clear()
+
+
+def test_upload_pipeline():
+    from fastapi.testclient import TestClient
+
+    contents = [b"first", b"second" * 100_000, b"first"]
+    with tempfile.TemporaryDirectory() as directory:
+        pipeline = UploadPipeline(directory, workers=2)
+        app.dependency_overrides[get_upload_pipeline] = lambda: pipeline
+        try:
+            response = TestClient(app).post(
+                "/uploadfiles/",
+                files=[("files", (f"{n}.bin", data)) for n, data in enumerate(contents)],
+            )
+        finally:
+            pipeline.shutdown()
+            app.dependency_overrides.clear()
+        assert response.status_code == 200
+        results = sorted(
+            (json.loads(line) for line in response.text.splitlines()),
+            key=lambda result: result["filename"],
+        )
+        assert results == [
+            {"filename": f"{n}.bin", "size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+            for n, data in enumerate(contents)
+        ]
+        # The duplicate upload is stored once.
+        assert sorted(os.listdir(directory)) == sorted(
+            {hashlib.sha256(data).hexdigest() for data in contents}
+        )
+
+
+BOUNDARY = "bench-boundary"
+
+
+async def multipart_body(size: int, chunk_size: int = 1024**2):
+    yield (
+        f"--{BOUNDARY}\r\n"
+        'Content-Disposition: form-data; name="files"; filename="big.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    chunk = b"x" * chunk_size
+    for _ in range(size // chunk_size):
+        yield chunk
+    yield f"\r\n--{BOUNDARY}--\r\n".encode()
+
+
+async def upload_once(args):
+    """Send one ``--size-mb`` upload to ``--path`` and print the peak RSS growth in KiB."""
+    import resource
+
+    import httpx
+
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+    # ASGITransport doesn't send lifespan events.
+    async with lifespan(app), client:
+        response = await client.post(
+            args.path,
+            content=multipart_body(args.size_mb * 1024**2),
+            headers={"Content-Type": f"multipart/form-data; boundary={BOUNDARY}"},
+            timeout=None,
+        )
+    assert response.status_code == 200, response.text
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before)
+
+
+async def bench_rss(args):
+    """Peak RSS growth for one upload, each endpoint in a fresh process."""
+    import subprocess
+    import sys
+
+    for path in ("/files/", "/uploadfiles/", "/streamfiles/"):
+        output = subprocess.run(
+            [sys.executable, __file__, "upload", "--path", path, "--size-mb", str(args.size_mb)],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        print(f"{path:<16} {args.size_mb} MiB upload  +{int(output) / 1024:8.1f} MiB peak RSS")
+
+
+async def bench_pipeline(args):
+    """Upload pipeline throughput by file count and number of workers."""
+    import time
+
+    cpus = os.cpu_count() or 1
+    print(f"{cpus} CPU(s), {args.size_mb} MiB per file")
+    with tempfile.TemporaryDirectory() as directory:
+        for count in (1, 4, 16):
+            files = []
+            for n in range(count):
+                # Starlette spools uploads to disk past 1 MiB, so do the same.
+                spooled = tempfile.SpooledTemporaryFile(max_size=1024**2)
+                spooled.write(os.urandom(1024) * (args.size_mb * 1024))
+                files.append(UploadFile(spooled, filename=f"{n}.bin"))
+            for workers in sorted({1, 2, 4, cpus}):
+                pipeline = UploadPipeline(directory, workers=workers)
+                start = time.perf_counter()
+                async for _ in pipeline.results(files):
+                    pass
+                elapsed = time.perf_counter() - start
+                pipeline.shutdown()
+                print(
+                    f"{count:>3} files {workers:>2} workers"
+                    f"  {count * args.size_mb / elapsed:8.1f} MiB/s"
+                )
+            for file in files:
+                file.file.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+
+    benchmarks = {"pipeline": bench_pipeline, "rss": bench_rss, "upload": upload_once}
+    parser = argparse.ArgumentParser(description="Benchmarks for this app.")
+    parser.add_argument("benchmark", choices=sorted(benchmarks))
+    parser.add_argument("--path", default="/streamfiles/")
+    parser.add_argument("--size-mb", type=int, default=256)
+    args = parser.parse_args()
+    asyncio.run(benchmarks[args.benchmark](args))
@@ -11,7 +11,14 @@ from fastapi import FastAPI, Response
 from fastapi.responses import JSONResponse, RedirectResponse
 from pydantic import BaseModel, EmailStr
 
-app = FastAPI()
+from fast_response import FastJSONResponse, TrustedJSONRoute
+
+# Validated return values go straight to orjson instead of through
+# jsonable_encoder and json.dumps, and returned instances of the response
+# model (or of a subclass, like UserIn for BaseUser below) are only filtered,
+# not validated again, see fast_response.py.
+app = FastAPI(default_response_class=FastJSONResponse)
+app.router.route_class = TrustedJSONRoute
 
 
 class Item(BaseModel):
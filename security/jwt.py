@@ -1,5 +1,15 @@
 # OAuth2 with Password (and hashing), Bearer with JWT tokens¶
 
+import asyncio
+import heapq
+import os
+import statistics
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Annotated
 
@@ -40,36 +50,197 @@ class User(BaseModel):
     
     
 class UserInDB(User):
-    hash_password: str
+    hashed_password: str
     
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt cost, pick it with `python security/jwt.py calibrate --target-ms 250`.
+# min and max rounds pinned to it make needs_update() flag hashes made at
+# any other cost, so they get rehashed on the next login, whether the cost
+# went up or down.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+
+
+
+def password_context(rounds: int) -> CryptContext:
+    return CryptContext(
+        schemes=["bcrypt"],
+        deprecated="auto",
+        bcrypt__rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+pwd_context = password_context(BCRYPT_ROUNDS)
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="toekn")
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    try:
+        yield
+    finally:
+        # Started again by the next verify, if the app is.
+        await asyncio.to_thread(password_verifier.shutdown)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def verify_and_update_password(plain_password, hashed_password):
+    """(verified, new hash or None), the new hash when the cost changed."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
 def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+def calibrate_bcrypt_rounds(target_ms: float, max_rounds: int = 16, samples: int = 3):
+    """The highest bcrypt cost whose hash takes at most ``target_ms`` here.
+
+    Verifying costs the same as hashing. Returns the rounds and the median
+    time in ms of every cost tried. Each extra round doubles the time, so it
+    stops at the first cost over the target.
+    """
+    timings = {}
+    chosen = 4
+    for rounds in range(4, max_rounds + 1):
+        context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds)
+        durations = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            context.hash("calibration password")
+            durations.append((time.perf_counter() - start) * 1000)
+        timings[rounds] = statistics.median(durations)
+        if timings[rounds] > target_ms:
+            break
+        chosen = rounds
+    return chosen, timings
+
+
+def update_user(db, username: str, **changes):
+    """Change stored fields of ``username``, like ``disabled=True``.
+
+    Tokens cached with the old user are forgotten, so the next request
+    with them sees the change.
+    """
+    db[username].update(changes)
+    token_cache.forget_user(username)
+
+
+def update_password_hash(db, username: str, hashed_password: str):
+    update_user(db, username, hashed_password=hashed_password)
+
+
 def get_user(db, username: str):
     if username in db:
         user_dict = db[username]
         return UserInDB(**user_dict)
     
 
-def authenticate_user(fake_db, username: str, password: str):
+class PasswordVerifier:
+    """Checks passwords on a pool, off the event loop.
+
+    A bcrypt verify at cost 12 takes about 250 ms, run inline in an async
+    endpoint it stalls every other request on the worker. bcrypt releases
+    the GIL, so threads are enough. ``use_processes`` switches to a process
+    pool for hash schemes that don't. At most ``max_concurrency`` checks
+    run at once, the rest wait, and how long they wait is recorded. The
+    pool is started on first use and stopped by shutdown().
+    """
+
+    def __init__(self, max_concurrency: int = 4, use_processes: bool = False):
+        self.max_concurrency = max_concurrency
+        self.use_processes = use_processes
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        # A Semaphore binds to the first event loop that waits on it, so one
+        # per loop, made when that loop first verifies.
+        self.slots: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self.waiting = 0
+        self.verified = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def verify(self, plain_password: str, hashed_password: str):
+        verified, _ = await self.verify_and_update(plain_password, hashed_password)
+        return verified
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str):
+        queued = time.perf_counter()
+        self.waiting += 1
+        try:
+            slots = self.loop_slots()
+            await slots.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            wait = time.perf_counter() - queued
+            self.verified += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.executor(), verify_and_update_password, plain_password, hashed_password
+            )
+        finally:
+            slots.release()
+
+    def executor(self):
+        with self.pool_lock:
+            if self.pool is None:
+                if self.use_processes:
+                    self.pool = ProcessPoolExecutor(max_workers=self.max_concurrency)
+                else:
+                    self.pool = ThreadPoolExecutor(
+                        max_workers=self.max_concurrency, thread_name_prefix="password"
+                    )
+            return self.pool
+
+    def shutdown(self):
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def loop_slots(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        slots = self.slots.get(loop)
+        if slots is None:
+            slots = self.slots[loop] = asyncio.Semaphore(self.max_concurrency)
+        return slots
+
+    def stats(self):
+        return {
+            "verified": self.verified,
+            "waiting": self.waiting,
+            "mean_wait": self.total_wait / self.verified if self.verified else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+password_verifier = PasswordVerifier()
+
+
+async def authenticate_user(fake_db, username: str, password: str):
     user = get_user(fake_db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await password_verifier.verify_and_update(
+        password, user.hashed_password
+    )
+    if not verified:
         return False
+    if new_hash is not None:
+        # Hashed at another cost than BCRYPT_ROUNDS, store the rehash.
+        update_password_hash(fake_db, username, new_hash)
+        user.hashed_password = new_hash
     return user
 
 
@@ -78,18 +249,87 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
-        exipre = datetime.utcnow() + timedelta(minutes=15)
+        expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
 
+class TokenCache:
+    """Verified tokens and the users they resolved to, at most ``maxsize``.
+
+    Clients send the same token for up to ACCESS_TOKEN_EXPIRE_MINUTES, so
+    once a token has been verified its user is kept until the token's own
+    ``exp``, and requests in between skip the HMAC check and the user
+    lookup, so users have to be changed through update_user(). Revoked
+    tokens are remembered until they would have expired anyway, so they
+    can't be verified back into the cache.
+    """
+
+    def __init__(self, maxsize: int = 10_000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()  # token -> (user, exp)
+        self.revoked = {}  # token -> exp
+        # (exp, token) of the revoked tokens, soonest to expire first.
+        self.revoked_by_exp = []
+        self.lock = threading.Lock()
+
+    def get(self, token: str):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None:
+                return None
+            user, exp = entry
+            if exp <= time.time():
+                del self.entries[token]
+                return None
+            self.entries.move_to_end(token)
+            return user
+
+    def set(self, token: str, user: UserInDB, exp: float):
+        with self.lock:
+            self.entries[token] = (user, exp)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def is_revoked(self, token: str):
+        exp = self.revoked.get(token)
+        return exp is not None and exp > time.time()
+
+    def revoke(self, token: str, exp: float):
+        with self.lock:
+            self.entries.pop(token, None)
+            self.revoked[token] = exp
+            heapq.heappush(self.revoked_by_exp, (exp, token))
+            # The ones that have expired since don't need remembering.
+            now = time.time()
+            while self.revoked_by_exp and self.revoked_by_exp[0][0] <= now:
+                _, expired = heapq.heappop(self.revoked_by_exp)
+                if self.revoked.get(expired, now + 1) <= now:
+                    del self.revoked[expired]
+
+    def forget_user(self, username: str):
+        """Drop the cached tokens of ``username``, e.g. after it was disabled."""
+        with self.lock:
+            for token in [t for t, (user, _) in self.entries.items() if user.username == username]:
+                del self.entries[token]
+
+
+token_cache = TokenCache()
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth_scheme)]):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    if token_cache.is_revoked(token):
+        raise credentials_exception
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -101,6 +341,8 @@ async def get_current_user(token: Annotated[str, Depends(oauth_scheme)]):
     user = get_user(fake_users_db, username=token_data.username)
     if user is None:
         raise credentials_exception
+    if payload.get("exp") is not None:
+        token_cache.set(token, user, payload["exp"])
     return user
 
 
@@ -109,13 +351,14 @@ async def get_current_active_user(
 ):
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
+    return current_user
     
     
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
 ):
-    user = authenticate_user(fake_users_db, form_data.username, form_data.password)
+    user = await authenticate_user(fake_users_db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -129,6 +372,16 @@ async def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+@app.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+async def revoke_token(
+    token: Annotated[str, Depends(oauth_scheme)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    # get_current_user has verified it, so exp is trustworthy here.
+    claims = jwt.get_unverified_claims(token)
+    token_cache.revoke(token, claims.get("exp", float("inf")))
+
+
 @app.get("/user/me/", response_model=User)
 async def read_users_me(
     current_user: Annotated[User, Depends(get_current_active_user)]
@@ -140,4 +393,233 @@ async def read_users_me(
 async def read_own_items(
     current_user: Annotated[User, Depends(get_current_active_user)]
 ):
-    return [{"item_id": "Foo", "owner": current_user.username}]
\ No newline at end of file
+    return [{"item_id": "Foo", "owner": current_user.username}]
+
+
+def test_token_cache():
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app)
+    token = create_access_token(data={"sub": "johndoe"}, expires_delta=timedelta(minutes=5))
+    headers = {"Authorization": f"Bearer {token}"}
+    saved = dict(fake_users_db["johndoe"])
+    token_cache.entries.clear()
+    try:
+        assert client.get("/user/me/", headers=headers).json()["username"] == "johndoe"
+        assert token in token_cache.entries
+        # Served from the cache, even if the user lookup would fail now.
+        fake_users_db["other"] = fake_users_db.pop("johndoe")
+        try:
+            assert client.get("/user/me/", headers=headers).status_code == 200
+        finally:
+            fake_users_db["johndoe"] = fake_users_db.pop("other")
+
+        # Disabling the user drops its cached tokens.
+        update_user(fake_users_db, "johndoe", disabled=True)
+        assert token not in token_cache.entries
+        assert client.get("/user/me/", headers=headers).json() == {"detail": "Inactive user"}
+        update_user(fake_users_db, "johndoe", disabled=False)
+
+        # A revoked token isn't accepted, nor verified back into the cache.
+        assert client.post("/token/revoke", headers=headers).status_code == 204
+        assert client.get("/user/me/", headers=headers).status_code == 401
+        assert token not in token_cache.entries
+        assert client.post("/token/revoke", headers=headers).status_code == 401
+    finally:
+        fake_users_db["johndoe"] = saved
+        token_cache.entries.clear()
+
+    # Revoked tokens are forgotten once they would have expired anyway.
+    cache = TokenCache()
+    cache.revoke("old", time.time() - 1)
+    cache.revoke("new", time.time() + 60)
+    assert cache.revoked.keys() == {"new"}
+    assert cache.is_revoked("new") and not cache.is_revoked("old")
+
+
+def test_password_verifier():
+    global verify_and_update_password
+    from fastapi.testclient import TestClient
+
+    hashed = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")
+    verifier = PasswordVerifier(max_concurrency=2)
+
+    async def wrong_and_right():
+        return await verifier.verify("wrong", hashed), await verifier.verify("secret", hashed)
+
+    assert asyncio.run(wrong_and_right()) == (False, True)
+
+    # No more than max_concurrency at once, the others wait for a slot.
+    running, peak, lock = [0], [0], threading.Lock()
+    real = verify_and_update_password
+
+    def slow_verify(plain_password, hashed_password):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return True, None
+
+    async def six():
+        return await asyncio.gather(*(verifier.verify("secret", hashed) for _ in range(6)))
+
+    verify_and_update_password = slow_verify
+    try:
+        assert asyncio.run(six()) == [True] * 6
+    finally:
+        verify_and_update_password = real
+    assert peak[0] == 2
+    stats = verifier.stats()
+    assert stats["verified"] == 8 and stats["waiting"] == 0
+    # Two waited for one verify, two for two.
+    assert stats["max_wait"] >= 0.04 and stats["mean_wait"] > 0
+    verifier.shutdown()
+    assert verifier.pool is None
+
+    # The app's pool goes with its lifespan.
+    with TestClient(app):
+        asyncio.run(password_verifier.verify("wrong", hashed))
+        pool = password_verifier.pool
+        assert pool is not None
+    assert password_verifier.pool is None and pool._shutdown
+
+
+def test_rehash_on_login():
+    global pwd_context
+
+    # Cost 5 stands in for BCRYPT_ROUNDS, low enough to keep the test fast.
+    default, pwd_context = pwd_context, password_context(5)
+    db = {}
+    for name, rounds in (("cheap", 4), ("costly", 6), ("current", 5)):
+        hashed = CryptContext(schemes=["bcrypt"], bcrypt__rounds=rounds).hash("secret")
+        db[name] = {"username": name, "hashed_password": hashed}
+    before = {name: user["hashed_password"] for name, user in db.items()}
+    try:
+        for name in db:
+            user = asyncio.run(authenticate_user(db, name, "secret"))
+            assert user.hashed_password == db[name]["hashed_password"]
+        # A wrong password rehashes nothing.
+        db["wrong"] = {"username": "wrong", "hashed_password": before["cheap"]}
+        assert asyncio.run(authenticate_user(db, "wrong", "nope")) is False
+    finally:
+        pwd_context = default
+        password_verifier.shutdown()
+    # Hashes at another cost are rehashed at the configured one, up or down.
+    for name in ("cheap", "costly"):
+        assert db[name]["hashed_password"].startswith("$2b$05$")
+        assert db[name]["hashed_password"] != before[name]
+        assert verify_password("secret", db[name]["hashed_password"])
+    # Those already at it are left alone.
+    assert db["current"]["hashed_password"] == before["current"]
+    assert db["wrong"]["hashed_password"] == before["cheap"]
+
+    rounds, timings = calibrate_bcrypt_rounds(target_ms=float("inf"), max_rounds=5, samples=1)
+    assert rounds == 5 and list(timings) == [4, 5]
+    assert calibrate_bcrypt_rounds(target_ms=0, max_rounds=5, samples=1)[0] == 4
+
+
+async def bench_authenticated(args):
+    """Authenticated request throughput on /users/me/items/, without and with token_cache."""
+    import httpx
+
+    token = create_access_token(
+        data={"sub": "johndoe"},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for label, maxsize in (("without cache", 0), ("with cache", 10_000)):
+            token_cache.maxsize = maxsize
+            token_cache.entries.clear()
+            for _ in range(100):
+                await client.get("/users/me/items/", headers=headers)
+            start = time.perf_counter()
+            for _ in range(args.requests):
+                response = await client.get("/users/me/items/", headers=headers)
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, response.text
+            print(f"{label:<14} {args.requests / elapsed:9.1f} req/s")
+    token_cache.maxsize = 10_000
+
+
+class InlineVerifier:
+    """The old behaviour, bcrypt on the event loop, for comparison."""
+
+    async def verify_and_update(self, plain_password: str, hashed_password: str):
+        return verify_and_update_password(plain_password, hashed_password)
+
+
+async def bench_login_storm(args):
+    """Latency of an unrelated endpoint while ``--logins`` logins run at once."""
+    import httpx
+
+    global password_verifier
+    token = create_access_token(
+        data={"sub": "johndoe"},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES),
+    )
+    headers = {"Authorization": f"Bearer {token}"}
+    login = {"username": "johndoe", "password": "secret"}
+    transport = httpx.ASGITransport(app=app)
+    verifiers = {"inline": InlineVerifier(), "pool": PasswordVerifier()}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for label, verifier in verifiers.items():
+            password_verifier = verifier
+            latencies = []
+
+            async def probe(until: asyncio.Event):
+                # Latency counts from when the probe was due, so time spent
+                # with the event loop blocked shows up too.
+                due = time.perf_counter()
+                while not until.is_set():
+                    await client.get("/users/me/items/", headers=headers)
+                    latencies.append(time.perf_counter() - due)
+                    due += 0.01
+                    await asyncio.sleep(max(0.0, due - time.perf_counter()))
+
+            done = asyncio.Event()
+            prober = asyncio.create_task(probe(done))
+            await asyncio.sleep(0.05)
+            start = time.perf_counter()
+            responses = await asyncio.gather(
+                *(client.post("/token", data=login) for _ in range(args.logins))
+            )
+            storm = time.perf_counter() - start
+            done.set()
+            await prober
+            assert all(response.status_code == 200 for response in responses)
+            latencies.sort()
+            print(
+                f"{label:<7} {args.logins} logins in {storm:6.2f} s,"
+                f" /users/me/items/ p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms"
+                f" max {latencies[-1] * 1000:7.1f} ms ({len(latencies)} probes)"
+            )
+    password_verifier = verifiers["pool"]
+
+
+async def calibrate(args):
+    """Pick BCRYPT_ROUNDS for a target verify latency on this machine."""
+    rounds, timings = calibrate_bcrypt_rounds(args.target_ms)
+    for cost, ms in timings.items():
+        print(f"rounds {cost:>2}: {ms:9.1f} ms")
+    print(f"BCRYPT_ROUNDS={rounds}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    benchmarks = {
+        "auth": bench_authenticated,
+        "calibrate": calibrate,
+        "logins": bench_login_storm,
+    }
+    parser = argparse.ArgumentParser(description="Benchmarks and tools for this app.")
+    parser.add_argument("benchmark", choices=sorted(benchmarks))
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--logins", type=int, default=16)
+    parser.add_argument("--target-ms", type=float, default=250.0)
+    args = parser.parse_args()
+    asyncio.run(benchmarks[args.benchmark](args))
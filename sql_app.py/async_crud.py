@@ -0,0 +1,130 @@
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, schemas
+from .crud import (
+    BULK_CHUNK_SIZE,
+    USER_SNAPSHOT_LOAD,
+    cache_user,
+    chunked,
+    fake_hash_password,
+    new_user_rows,
+    user_cache,
+    user_email_key,
+    user_key,
+)
+
+# Async versions of the functions in crud.py, same names and arguments.
+# AsyncSession can't lazy load, so anything the schemas read (User.items)
+# has to be loaded up front: pass crud.eager_options() as ``options``.
+
+
+async def get_user(db: AsyncSession, user_id: int, options=()):
+    stmt = select(models.User).options(*options).where(models.User.id == user_id)
+    return (await db.scalars(stmt)).unique().first()
+
+
+async def get_user_by_email(db: AsyncSession, email: str, options=()):
+    stmt = select(models.User).options(*options).where(models.User.email == email)
+    return (await db.scalars(stmt)).unique().first()
+
+
+async def get_cached_user(db: AsyncSession, user_id: int):
+    cached = user_cache.get(user_key(user_id))
+    if cached is not None:
+        return cached
+    generation = user_cache.generation()
+    db_user = await get_user(db, user_id, USER_SNAPSHOT_LOAD)
+    if db_user is None:
+        return None
+    return cache_user(db_user, generation)
+
+
+async def get_cached_user_by_email(db: AsyncSession, email: str):
+    key = user_cache.get_alias(user_email_key(email))
+    if key is not None:
+        cached = user_cache.get(key)
+        if cached is not None:
+            return cached
+    generation = user_cache.generation()
+    db_user = await get_user_by_email(db, email, USER_SNAPSHOT_LOAD)
+    if db_user is None:
+        return None
+    return cache_user(db_user, generation)
+
+
+async def get_users(
+    db: AsyncSession, skip: int = 0, limit: int = 100, options=(), after_id: int | None = None
+):
+    stmt = select(models.User).options(*options).order_by(models.User.id)
+    if after_id is not None:
+        stmt = stmt.where(models.User.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    return (await db.scalars(stmt.limit(limit))).unique().all()
+
+
+async def create_user(db: AsyncSession, user: schemas.UserCreate):
+    fake_hashed_password = fake_hash_password(user.password)
+    db_user = models.User(
+        email=user.email, hashed_password=fake_hashed_password, items=[]
+    )
+    db.add(db_user)
+    await db.commit()
+    user_cache.invalidate(user_key(db_user.id), user_email_key(db_user.email))
+    return db_user
+
+
+async def create_users(
+    db: AsyncSession, users: list[schemas.UserCreate], chunk_size: int = BULK_CHUNK_SIZE
+):
+    ids, duplicates, seen = [], [], set()
+    stmt = insert(models.User).returning(models.User.id, sort_by_parameter_order=True)
+    for chunk in chunked(users, chunk_size):
+        emails = [user.email for user in chunk]
+        taken = seen | set(
+            await db.scalars(select(models.User.email).where(models.User.email.in_(emails)))
+        )
+        rows = new_user_rows(chunk, taken, duplicates)
+        seen.update(row["email"] for row in rows)
+        if rows:
+            ids.extend(await db.scalars(stmt, rows))
+    await db.commit()
+    user_cache.invalidate(*(user_key(user_id) for user_id in ids))
+    user_cache.invalidate(*(user_email_key(email) for email in seen))
+    return ids, duplicates
+
+
+async def get_items(
+    db: AsyncSession, skip: int = 0, limit: int = 100, after_id: int | None = None
+):
+    stmt = select(models.Item).order_by(models.Item.id)
+    if after_id is not None:
+        stmt = stmt.where(models.Item.id > after_id)
+    else:
+        stmt = stmt.offset(skip)
+    return (await db.scalars(stmt.limit(limit))).all()
+
+
+async def create_user_item(db: AsyncSession, item: schemas.ItemCreate, user_id: int):
+    db_item = models.Item(**item.dict(), owner_id=user_id)
+    db.add(db_item)
+    await db.commit()
+    user_cache.invalidate(user_key(user_id))
+    return db_item
+
+
+async def create_user_items(
+    db: AsyncSession,
+    items: list[schemas.ItemCreate],
+    user_id: int,
+    chunk_size: int = BULK_CHUNK_SIZE,
+):
+    ids = []
+    stmt = insert(models.Item).returning(models.Item.id, sort_by_parameter_order=True)
+    for chunk in chunked(items, chunk_size):
+        rows = [{**item.dict(), "owner_id": user_id} for item in chunk]
+        ids.extend(await db.scalars(stmt, rows))
+    await db.commit()
+    user_cache.invalidate(user_key(user_id))
+    return ids
@@ -0,0 +1,116 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, HTTPException, Response
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import async_crud, crud, models, schemas
+from .database import AsyncReadSessionLocal, AsyncSessionLocal
+from .pagination import cursor_query, set_next_cursor
+
+# Same API as main.py, but the routes are async def and talk to the database
+# through AsyncSession, so they run on the event loop instead of taking a
+# threadpool slot each. Run it with `uvicorn sql_app.async_main:app`, or keep
+# using `sql_app.main:app` for the sync version.
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The schema is created at startup, not when the module is imported.
+    await asyncio.to_thread(models.init_db)
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Relationships the response models serialize, loaded eagerly so listing N
+# users doesn't cost N extra queries. Lists use selectin; single users go
+# through the snapshot cache, which loads them joined.
+USERS_LOAD = crud.eager_options(models.User, schemas.User, strategy="selectin")
+
+# Dependency
+async def get_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Dependency for the GET routes, sessions on the read-only engine.
+async def get_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
+@app.post("/users/", response_model=schemas.User)
+async def create_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await async_crud.get_cached_user_by_email(db, email=user.email)
+    if db_user:
+        raise HTTPException(status_code=400, detail="Email already registered")
+    return await async_crud.create_user(db=db, user=user)
+
+
+@app.post("/users/bulk", response_model=schemas.BulkCreated)
+async def create_users(users: list[schemas.UserCreate], db: AsyncSession = Depends(get_db)):
+    try:
+        ids, duplicates = await async_crud.create_users(db=db, users=users)
+    except IntegrityError:
+        # Another request registered one of the emails after we checked.
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Email registered concurrently, retry")
+    return {"ids": ids, "duplicates": duplicates}
+
+
+@app.get("/users/", response_model=list[schemas.User])
+async def read_users(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = Depends(cursor_query),
+    db: AsyncSession = Depends(get_read_db),
+):
+    users = await async_crud.get_users(
+        db, skip=skip, limit=limit, options=USERS_LOAD, after_id=after_id
+    )
+    set_next_cursor(response, users, limit)
+    return users
+
+
+@app.get("/users/{user_id}", response_model=schemas.User)
+async def read_user(user_id: int, db: AsyncSession = Depends(get_read_db)):
+    db_user = await async_crud.get_cached_user(db, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+
+@app.post("/users/{user_id}/items/", response_model=schemas.Item)
+async def create_item_for_user(
+    user_id: int, item: schemas.ItemCreate, db: AsyncSession = Depends(get_db)
+):
+    return await async_crud.create_user_item(db=db, item=item, user_id=user_id)
+
+
+@app.post("/users/{user_id}/items/bulk", response_model=schemas.BulkCreated)
+async def create_items_for_user(
+    user_id: int, items: list[schemas.ItemCreate], db: AsyncSession = Depends(get_db)
+):
+    ids = await async_crud.create_user_items(db=db, items=items, user_id=user_id)
+    return {"ids": ids}
+
+
+@app.get("/cache/stats")
+async def read_cache_stats():
+    return crud.user_cache.stats()
+
+
+@app.get("/items/", response_model=list[schemas.Item])
+async def read_items(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = Depends(cursor_query),
+    db: AsyncSession = Depends(get_read_db),
+):
+    items = await async_crud.get_items(db, skip=skip, limit=limit, after_id=after_id)
+    set_next_cursor(response, items, limit)
+    return items
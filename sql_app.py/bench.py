@@ -0,0 +1,255 @@
+"""Load benchmarks for sql_app.
+
+The package directory is named sql_app.py, which can't be imported as
+sql_app, so link it under that name first. From the repository root:
+
+    ln -s sql_app.py sql_app
+    python -m sql_app.bench modes --requests 5000 --concurrency 200
+    python -m sql_app.bench pagination --rows 1000000
+    python -m sql_app.bench mixed --requests 5000 --concurrency 40
+
+Every benchmark works on a throwaway database in a temp directory, the
+apps' get_db dependencies are overridden to point at it. modes and mixed
+measure the database with crud.user_cache missing on every request, then
+once more with it warm ("+cache" rows), reporting its hit rate.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import statistics
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import create_engine, insert
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from . import async_main, crud, main, models
+from .cache import TTLCache
+from .database import SQLiteProfile, create_sqlite_engine
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(name: str, elapsed: float, latencies: list[float]):
+    print(
+        f"{name:<12} {len(latencies) / elapsed:>9.1f} req/s"
+        f"  p50 {statistics.median(latencies) * 1000:7.2f} ms"
+        f"  p99 {percentile(latencies, 99) * 1000:7.2f} ms"
+    )
+
+
+@contextlib.contextmanager
+def user_cache(enabled: bool):
+    """Run with crud.user_cache empty, and storing nothing unless ``enabled``."""
+    backend = crud.user_cache.backend
+    if not enabled:
+        crud.user_cache.backend = TTLCache(maxsize=0)
+    crud.user_cache.clear()
+    try:
+        yield crud.user_cache
+    finally:
+        crud.user_cache.backend = backend
+        crud.user_cache.clear()
+
+
+def report_cache(cache):
+    stats = cache.stats()
+    print(f"{'':<12} cache hits {stats['hits']}, misses {stats['misses']}, hit rate {stats['hit_rate']:.1%}")
+
+
+async def run_load(app, paths, concurrency: int):
+    """Send every request in ``paths``, ``concurrency`` at a time.
+
+    Plain strings are GETs, ``(path, body)`` tuples are POSTs of ``body``.
+    Returns the wall time and the per-request latencies in seconds.
+    """
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def one(path):
+            async with semaphore:
+                start = time.perf_counter()
+                if isinstance(path, tuple):
+                    response = await client.post(path[0], json=path[1])
+                else:
+                    response = await client.get(path)
+                latencies.append(time.perf_counter() - start)
+                response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(path) for path in paths))
+        return time.perf_counter() - start, latencies
+
+
+def seed(sync_engine, users: int, items_per_user: int):
+    models.init_db(bind=sync_engine)
+    with sync_engine.begin() as conn:
+        conn.execute(
+            insert(models.User),
+            [
+                {"email": f"user{n}@example.com", "hashed_password": "x", "is_active": True}
+                for n in range(1, users + 1)
+            ],
+        )
+        conn.execute(
+            insert(models.Item),
+            [
+                {"title": f"item {n}", "description": "bench", "owner_id": owner}
+                for owner in range(1, users + 1)
+                for n in range(items_per_user)
+            ],
+        )
+
+
+async def bench_modes(args):
+    """Sync (threadpool) vs async (AsyncSession) app on the same reads."""
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        # Size both pools to the concurrency, with the default 5 + 10 the sync
+        # app deadlocks: threads block on the pool while the connections they
+        # wait for are only released by teardowns that need a thread too.
+        sync_engine = create_engine(
+            f"sqlite:///{path}",
+            connect_args={"check_same_thread": False},
+            pool_size=args.concurrency,
+        )
+        async_engine = create_async_engine(
+            f"sqlite+aiosqlite:///{path}", pool_size=args.concurrency
+        )
+        seed(sync_engine, users=args.users, items_per_user=3)
+
+        SyncSession = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+        AsyncSessionBench = sessionmaker(
+            bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+        )
+
+        def sync_get_db():
+            db = SyncSession()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def async_get_db():
+            async with AsyncSessionBench() as db:
+                yield db
+
+        main.app.dependency_overrides[main.get_db] = sync_get_db
+        main.app.dependency_overrides[main.get_read_db] = sync_get_db
+        async_main.app.dependency_overrides[async_main.get_db] = async_get_db
+        async_main.app.dependency_overrides[async_main.get_read_db] = async_get_db
+
+        paths = [f"/users/{n % args.users + 1}" for n in range(args.requests)]
+        try:
+            for cached in (False, True):
+                for name, app in (("sync", main.app), ("async", async_main.app)):
+                    with user_cache(cached) as cache:
+                        elapsed, latencies = await run_load(app, paths, args.concurrency)
+                        report(name + "+cache" * cached, elapsed, latencies)
+                        if cached:
+                            report_cache(cache)
+        finally:
+            main.app.dependency_overrides.clear()
+            async_main.app.dependency_overrides.clear()
+            await async_engine.dispose()
+            sync_engine.dispose()
+
+
+async def bench_pagination(args):
+    """Offset vs keyset page latency at increasing depth."""
+    with tempfile.TemporaryDirectory() as tmp:
+        sync_engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        seed(sync_engine, users=args.rows, items_per_user=0)
+        SyncSession = sessionmaker(autocommit=False, autoflush=False, bind=sync_engine)
+        depths = [0, 1_000, 10_000, 100_000, 500_000, args.rows - args.limit]
+        print(f"{'depth':>9} {'offset ms':>10} {'keyset ms':>10}")
+        with SyncSession() as db:
+            for depth in (d for d in depths if 0 <= d <= args.rows - args.limit):
+                timings = []
+                for kwargs in ({"skip": depth}, {"after_id": depth}):
+                    start = time.perf_counter()
+                    for _ in range(args.repeat):
+                        page = crud.get_users(db, limit=args.limit, **kwargs)
+                        db.expunge_all()
+                    timings.append((time.perf_counter() - start) / args.repeat * 1000)
+                    assert page[0].id == depth + 1
+                print(f"{depth:>9} {timings[0]:>10.3f} {timings[1]:>10.3f}")
+        sync_engine.dispose()
+
+
+def session_dependency(bind):
+    SessionBench = sessionmaker(autocommit=False, autoflush=False, bind=bind)
+
+    def get_db():
+        db = SessionBench()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return get_db
+
+
+async def bench_mixed(args):
+    """Stock vs tuned SQLite engines, main.py under a mix of reads and writes."""
+    # One write (add an item) for every four reads (fetch a user).
+    paths = [
+        (f"/users/{n % args.users + 1}/items/", {"title": "bench"})
+        if n % 5 == 0
+        else f"/users/{n % args.users + 1}"
+        for n in range(args.requests)
+    ]
+    for name, cached in (("stock", False), ("tuned", False), ("tuned", True)):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+            if name == "stock":
+                # database.py before the profile, with the pool enlarged so
+                # it doesn't deadlock (see bench_modes).
+                write_engine = read_engine = create_engine(
+                    url,
+                    connect_args={"check_same_thread": False},
+                    pool_size=args.concurrency,
+                )
+            else:
+                profile = SQLiteProfile(pool_size=args.concurrency)
+                write_engine = create_sqlite_engine(url, profile)
+                read_engine = create_sqlite_engine(url, profile, read_only=True)
+            seed(write_engine, users=args.users, items_per_user=3)
+            main.app.dependency_overrides[main.get_db] = session_dependency(write_engine)
+            main.app.dependency_overrides[main.get_read_db] = session_dependency(read_engine)
+            try:
+                with user_cache(cached) as cache:
+                    elapsed, latencies = await run_load(main.app, paths, args.concurrency)
+                    report(name + "+cache" * cached, elapsed, latencies)
+                    if cached:
+                        report_cache(cache)
+            finally:
+                main.app.dependency_overrides.clear()
+                write_engine.dispose()
+                read_engine.dispose()
+
+
+BENCHMARKS = {"mixed": bench_mixed, "modes": bench_modes, "pagination": bench_pagination}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(BENCHMARKS[args.benchmark](args))
@@ -0,0 +1,214 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Read-through caching for crud. Values are serialized snapshots (JSON
+# strings of the response schemas), never live ORM objects: those are bound
+# to the session that loaded them and go stale or detached once it closes.
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire ``ttl`` seconds after set."""
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class LocalSharedCache:
+    """Local stand-in for a shared backend (Redis, memcached).
+
+    Same interface as TTLCache, but like a network cache it only stores
+    bytes and has no LRU, so code written against it keeps working when a
+    real client with get/set/delete is dropped in.
+    """
+
+    def __init__(self, ttl: float = 300.0):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            value, expires = self._entries.get(key, (None, 0.0))
+        if value is None or expires <= time.monotonic():
+            return None
+        return value.decode()
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (value.encode(), time.monotonic() + self.ttl)
+
+    def delete(self, *keys: str):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TieredCache:
+    """A local cache in front of a shared one.
+
+    Other workers only learn about an invalidation through the shared tier,
+    so keep the local TTL short when using this.
+    """
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key: str):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key: str, value: str):
+        self.shared.set(key, value)
+        self.local.set(key, value)
+
+    def delete(self, *keys: str):
+        self.shared.delete(*keys)
+        self.local.delete(*keys)
+
+    def clear(self):
+        self.shared.clear()
+        self.local.clear()
+
+
+class SnapshotCache:
+    """Caches ``schema`` snapshots of ORM rows in ``backend``, counting hits.
+
+    A reader that misses loads the row and stores it, and a writer may commit
+    and invalidate in between, so the row read is already stale. Readers take
+    generation() before reading the database and pass it to set(), which
+    stores nothing if anything was invalidated since. This covers the
+    writers of this process, those of other workers only reach the shared
+    tier through their own invalidations (see TieredCache).
+    """
+
+    def __init__(self, schema, backend):
+        self.schema = schema
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every invalidation.
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        raw = self.backend.get(key)
+        with self._lock:
+            if raw is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return self.schema.parse_raw(raw)
+
+    def generation(self) -> int:
+        return self._generation
+
+    def set(self, key: str, db_obj, generation: int | None = None):
+        """Store a snapshot of ``db_obj`` and return it.
+
+        Not stored if the cache was invalidated after ``generation``.
+        """
+        snapshot = self.schema.from_orm(db_obj)
+        with self._lock:
+            if generation is None or generation == self._generation:
+                self.backend.set(key, snapshot.json())
+        return snapshot
+
+    def get_alias(self, alias: str):
+        """The key ``alias`` points to (see set_alias), None counts as a miss."""
+        key = self.backend.get(alias)
+        if key is None:
+            with self._lock:
+                self.misses += 1
+        return key
+
+    def set_alias(self, alias: str, key: str, generation: int | None = None):
+        with self._lock:
+            if generation is None or generation == self._generation:
+                self.backend.set(alias, key)
+
+    def invalidate(self, *keys: str):
+        with self._lock:
+            self._generation += 1
+            self.backend.delete(*keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.backend.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+def test_snapshot_cache_invalidated_during_read():
+    from pydantic import BaseModel
+
+    class Row:
+        def __init__(self, name):
+            self.name = name
+
+    class Snapshot(BaseModel):
+        name: str
+
+        class Config:
+            orm_mode = True
+
+    cache = SnapshotCache(Snapshot, TTLCache())
+    assert cache.get("row") is None
+    generation = cache.generation()
+    row = Row("old")  # read from the database
+    cache.invalidate("row")  # a writer commits "new" meanwhile
+    assert cache.set("row", row, generation).name == "old"
+    assert cache.get("row") is None
+    cache.set("row", Row("new"), cache.generation())
+    assert cache.get("row").name == "new"
+    assert cache.stats() == {"hits": 1, "misses": 2, "hit_rate": 1 / 3}
@@ -1,31 +1,181 @@
-from sqlalchemy.orm import Session
+from sqlalchemy import insert, inspect, select
+from sqlalchemy.orm import Session, joinedload, selectinload
 
 from . import models, schemas
+from .cache import SnapshotCache, TTLCache
 
+# Eager loading strategies, see eager_options().
+LOADER_STRATEGIES = {"selectin": selectinload, "joined": joinedload}
 
-def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter(models.User.id == user_id).first()
+# Rows per INSERT statement in the bulk creators.
+BULK_CHUNK_SIZE = 500
 
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+def eager_options(model, schema, strategy: str = "selectin"):
+    """Loader options for every relationship of ``model`` that ``schema`` reads.
 
+    Lazy relationships cost one query per row when the response model
+    serializes them (N+1), so the routes build these once from their
+    response model and pass them to the getters below. Nested schemas are
+    followed. "selectin" is one extra query per relationship, "joined" folds
+    it into the main query (best for a single row).
+    """
+    loader = LOADER_STRATEGIES[strategy]
+    relationships = inspect(model).relationships
+    options = []
+    for name, field in schema.__fields__.items():
+        if name not in relationships:
+            continue
+        option = loader(getattr(model, name))
+        nested = eager_options(relationships[name].mapper.class_, field.type_, strategy)
+        if nested:
+            option = option.options(*nested)
+        options.append(option)
+    return options
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+
+# Loader options for building schemas.User snapshots, see user_cache.
+USER_SNAPSHOT_LOAD = eager_options(models.User, schemas.User, strategy="joined")
+
+# Read-through cache of schemas.User snapshots, keyed by id, with an email ->
+# id alias. get_cached_user and get_cached_user_by_email return snapshots, for
+# the routes that only serialize the user; get_user and get_user_by_email
+# still return session-bound ORM rows.
+# For several workers, swap the backend for a shared one, e.g.
+# TieredCache(TTLCache(ttl=5), LocalSharedCache()) with a real client.
+user_cache = SnapshotCache(schemas.User, TTLCache())
+
+
+def user_key(user_id: int):
+    return f"user:{user_id}"
+
+
+def user_email_key(email: str):
+    return f"user-email:{email}"
+
+
+def cache_user(db_user, generation: int | None = None):
+    """Cache ``db_user``, unless it was invalidated after ``generation``."""
+    user_cache.set_alias(user_email_key(db_user.email), user_key(db_user.id), generation)
+    return user_cache.set(user_key(db_user.id), db_user, generation)
+
+
+def get_user(db: Session, user_id: int, options=()):
+    return db.query(models.User).options(*options).filter(models.User.id == user_id).first()
+
+
+def get_user_by_email(db: Session, email: str, options=()):
+    return db.query(models.User).options(*options).filter(models.User.email == email).first()
+
+
+def get_cached_user(db: Session, user_id: int):
+    """get_user as a schemas.User snapshot, through user_cache."""
+    cached = user_cache.get(user_key(user_id))
+    if cached is not None:
+        return cached
+    generation = user_cache.generation()
+    db_user = get_user(db, user_id, USER_SNAPSHOT_LOAD)
+    if db_user is None:
+        return None
+    return cache_user(db_user, generation)
+
+
+def get_cached_user_by_email(db: Session, email: str):
+    """get_user_by_email as a schemas.User snapshot, through user_cache."""
+    key = user_cache.get_alias(user_email_key(email))
+    if key is not None:
+        cached = user_cache.get(key)
+        if cached is not None:
+            return cached
+    generation = user_cache.generation()
+    db_user = get_user_by_email(db, email, USER_SNAPSHOT_LOAD)
+    if db_user is None:
+        return None
+    return cache_user(db_user, generation)
+
+
+def get_users(
+    db: Session, skip: int = 0, limit: int = 100, options=(), after_id: int | None = None
+):
+    query = db.query(models.User).options(*options).order_by(models.User.id)
+    if after_id is not None:
+        # Keyset page, see pagination.py. ``skip`` is ignored.
+        return query.filter(models.User.id > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
+
+
+def fake_hash_password(password: str):
+    return password + "notreallyhased"
+
+
+def chunked(rows: list, size: int):
+    for start in range(0, len(rows), size):
+        yield rows[start : start + size]
+
+
+def new_user_rows(users: list[schemas.UserCreate], taken: set[str], duplicates: list[str]):
+    """Insert parameters for the users whose email isn't in ``taken``.
+
+    Skipped emails are appended to ``duplicates``, accepted ones are added to
+    ``taken`` so a repeat further down the batch is caught too.
+    """
+    rows = []
+    for user in users:
+        if user.email in taken:
+            duplicates.append(user.email)
+            continue
+        taken.add(user.email)
+        rows.append(
+            {
+                "email": user.email,
+                "hashed_password": fake_hash_password(user.password),
+                "is_active": True,
+            }
+        )
+    return rows
 
 
 def create_user(db: Session, user: schemas.UserCreate):
-    fake_hashed_password = user.password + "notreallyhased"
+    fake_hashed_password = fake_hash_password(user.password)
     db_user = models.User(email=user.email, hashed_password=fake_hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    user_cache.invalidate(user_key(db_user.id), user_email_key(db_user.email))
     return db_user
 
 
-def get_items(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Items).offsets(skip).limit(limit).all()
+def create_users(
+    db: Session, users: list[schemas.UserCreate], chunk_size: int = BULK_CHUNK_SIZE
+):
+    """Insert ``users`` in a single transaction, ``chunk_size`` rows per INSERT.
+
+    Existing emails are looked up once per chunk. Emails that are already
+    registered, or repeated within ``users``, are skipped rather than failing
+    the batch. Returns the new ids (in input order) and the skipped emails.
+    """
+    ids, duplicates, seen = [], [], set()
+    stmt = insert(models.User).returning(models.User.id, sort_by_parameter_order=True)
+    for chunk in chunked(users, chunk_size):
+        emails = [user.email for user in chunk]
+        taken = seen | set(
+            db.scalars(select(models.User.email).where(models.User.email.in_(emails)))
+        )
+        rows = new_user_rows(chunk, taken, duplicates)
+        seen.update(row["email"] for row in rows)
+        if rows:
+            ids.extend(db.scalars(stmt, rows))
+    db.commit()
+    user_cache.invalidate(*(user_key(user_id) for user_id in ids))
+    user_cache.invalidate(*(user_email_key(email) for email in seen))
+    return ids, duplicates
+
+
+def get_items(db: Session, skip: int = 0, limit: int = 100, after_id: int | None = None):
+    query = db.query(models.Item).order_by(models.Item.id)
+    if after_id is not None:
+        return query.filter(models.Item.id > after_id).limit(limit).all()
+    return query.offset(skip).limit(limit).all()
 
 
 def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
@@ -33,9 +183,27 @@ def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
     db.add(db_item)
     db.commit()
     db.refresh(db_item)
+    # The owner's snapshot lists its items.
+    user_cache.invalidate(user_key(user_id))
     return db_item
 
+
+def create_user_items(
+    db: Session,
+    items: list[schemas.ItemCreate],
+    user_id: int,
+    chunk_size: int = BULK_CHUNK_SIZE,
+):
+    """Insert ``items`` for ``user_id`` in a single transaction, returns their ids."""
+    ids = []
+    stmt = insert(models.Item).returning(models.Item.id, sort_by_parameter_order=True)
+    for chunk in chunked(items, chunk_size):
+        ids.extend(db.scalars(stmt, [{**item.dict(), "owner_id": user_id} for item in chunk]))
+    db.commit()
+    user_cache.invalidate(user_key(user_id))
+    return ids
+
+
 # By creating functions that are only dedicated to interacting with the database (get a user or an item) 
 # independent of your path operation function, you can more easily reuse them in multiple parts and also 
 # add unit tests for them.
-
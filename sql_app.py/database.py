@@ -1,12 +1,106 @@
-from sqlalchemy import create_engine
+from dataclasses import dataclass
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
+SQLALCHEMY_ASYNC_DATABASE_URL = "sqlite+aiosqlite:///./sql_app.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+# Sync routes run on anyio's worker threads, 40 by default. Every one of them
+# may hold a session, so the pools are sized to match.
+THREADPOOL_SIZE = 40
+
+
+@dataclass
+class SQLiteProfile:
+    """Pragmas applied to every new connection, and the pool size.
+
+    WAL lets readers run while a writer commits, and with it
+    synchronous=NORMAL only fsyncs at checkpoints. cache_size is negative
+    because SQLite reads that as KiB instead of pages. busy_timeout makes a
+    second writer wait for the lock instead of failing right away.
+    """
+
+    journal_mode: str = "WAL"
+    synchronous: str = "NORMAL"
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size: int = -64 * 1024
+    busy_timeout: int = 5000
+    pool_size: int = THREADPOOL_SIZE
+
+    def pragmas(self, read_only: bool = False):
+        pragmas = {
+            "synchronous": self.synchronous,
+            "mmap_size": self.mmap_size,
+            "cache_size": self.cache_size,
+            "busy_timeout": self.busy_timeout,
+        }
+        if read_only:
+            pragmas["query_only"] = "ON"
+        else:
+            # The journal mode is stored in the database file, only the
+            # writer needs to (and can) switch it.
+            pragmas["journal_mode"] = self.journal_mode
+        return pragmas
+
+
+def apply_profile(engine, profile: SQLiteProfile, read_only: bool = False):
+    pragmas = profile.pragmas(read_only)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def create_sqlite_engine(
+    url: str, profile: SQLiteProfile | None = None, read_only: bool = False
+):
+    """A sync engine for ``url`` tuned with ``profile``.
+
+    ``read_only`` engines are a separate pool of reader connections with
+    query_only set, for the GET routes. In WAL mode they see every committed
+    write and never block on, or get blocked by, the writer.
+    """
+    profile = profile or SQLiteProfile()
+    sqlite_engine = create_engine(
+        url, connect_args={"check_same_thread": False}, pool_size=profile.pool_size
+    )
+    apply_profile(sqlite_engine, profile, read_only)
+    return sqlite_engine
+
+
+def create_async_sqlite_engine(
+    url: str, profile: SQLiteProfile | None = None, read_only: bool = False
+):
+    profile = profile or SQLiteProfile()
+    sqlite_engine = create_async_engine(url, pool_size=profile.pool_size)
+    apply_profile(sqlite_engine.sync_engine, profile, read_only)
+    return sqlite_engine
+
+
+engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL)
+read_engine = create_sqlite_engine(SQLALCHEMY_DATABASE_URL, read_only=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
+
+# Async engine and session, used by async_main.py. The sync ones above stay
+# as they are for main.py.
+async_engine = create_async_sqlite_engine(SQLALCHEMY_ASYNC_DATABASE_URL)
+async_read_engine = create_async_sqlite_engine(
+    SQLALCHEMY_ASYNC_DATABASE_URL, read_only=True
+)
+# expire_on_commit=False because an expired attribute would need a lazy load
+# (implicit IO) the next time it is read, which AsyncSession doesn't allow.
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+AsyncReadSessionLocal = sessionmaker(
+    bind=async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
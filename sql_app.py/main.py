@@ -1,12 +1,31 @@
-from fastapi import Depends, FastAPI, HTTPException
-from sqlalchemy.orm import Session
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, HTTPException, Response
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 from . import crud, models, schemas
-from .database import SessionLocal, engine
+from .database import ReadSessionLocal, SessionLocal
+from .pagination import cursor_query, set_next_cursor
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The schema is created at startup, not when the module is imported.
+    models.init_db()
+    yield
 
-models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+
+# Relationships the response models serialize, loaded eagerly so listing N
+# users doesn't cost N extra queries. Lists use selectin; single users go
+# through the snapshot cache, which loads them joined.
+USERS_LOAD = crud.eager_options(models.User, schemas.User, strategy="selectin")
 
 # Dependency
 def get_db():
@@ -15,25 +34,54 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# Dependency for the GET routes, sessions on the read-only engine.
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
         
     
 @app.post("/users/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
+    db_user = crud.get_cached_user_by_email(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     return crud.create_user(db=db, user=user)
 
 
+@app.post("/users/bulk", response_model=schemas.BulkCreated)
+def create_users(users: list[schemas.UserCreate], db: Session = Depends(get_db)):
+    try:
+        ids, duplicates = crud.create_users(db=db, users=users)
+    except IntegrityError:
+        # Another request registered one of the emails after we checked.
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Email registered concurrently, retry")
+    return {"ids": ids, "duplicates": duplicates}
+
+
 @app.get("/users/", response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+def read_users(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = Depends(cursor_query),
+    db: Session = Depends(get_read_db),
+):
+    users = crud.get_users(
+        db, skip=skip, limit=limit, options=USERS_LOAD, after_id=after_id
+    )
+    set_next_cursor(response, users, limit)
     return users
 
 
 @app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+def read_user(user_id: int, db: Session = Depends(get_read_db)):
+    db_user = crud.get_cached_user(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
@@ -46,7 +94,156 @@ def create_item_for_user(
     return crud.create_user_item(db=db, item=item, user_id=user_id)
 
 
+@app.post("/users/{user_id}/items/bulk", response_model=schemas.BulkCreated)
+def create_items_for_user(
+    user_id: int, items: list[schemas.ItemCreate], db: Session = Depends(get_db)
+):
+    ids = crud.create_user_items(db=db, items=items, user_id=user_id)
+    return {"ids": ids}
+
+
+@app.get("/cache/stats")
+def read_cache_stats():
+    return crud.user_cache.stats()
+
+
 @app.get("/items/", response_model=list[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    items = crud.get_items(db, skip=skip, limit=limit)
-    return items
\ No newline at end of file
+def read_items(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after_id: int | None = Depends(cursor_query),
+    db: Session = Depends(get_read_db),
+):
+    items = crud.get_items(db, skip=skip, limit=limit, after_id=after_id)
+    set_next_cursor(response, items, limit)
+    return items
+
+
+def test_read_users_query_count():
+    # The list endpoint must stay at a fixed number of round trips however
+    # many users (each with items) it returns.
+    test_engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    models.init_db(bind=test_engine)
+    TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
+
+    def override_get_db():
+        db = TestingSessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    statements = []
+    event.listen(
+        test_engine, "before_cursor_execute", lambda *args: statements.append(args[2])
+    )
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    crud.user_cache.clear()
+    client = TestClient(app)
+    try:
+        for n in range(20):
+            user = client.post(
+                "/users/", json={"email": f"user{n}@example.com", "password": "secret"}
+            ).json()
+            client.post(f"/users/{user['id']}/items/", json={"title": "Plumbus"})
+            client.post(f"/users/{user['id']}/items/", json={"title": "Portal Gun"})
+
+        statements.clear()
+        response = client.get("/users/")
+        assert response.status_code == 200
+        assert len(response.json()) == 20
+        assert all(len(user["items"]) == 2 for user in response.json())
+        assert len(statements) == 2
+
+        statements.clear()
+        response = client.get("/users/1")
+        assert response.json()["items"][0]["title"] == "Plumbus"
+        assert len(statements) == 1
+
+        # Served from the user cache until an item is added.
+        statements.clear()
+        assert client.get("/users/1").json() == response.json()
+        assert statements == []
+        client.post("/users/1/items/", json={"title": "Meeseeks Box"})
+        assert len(client.get("/users/1").json()["items"]) == 3
+        assert client.get("/cache/stats").json()["hits"] == 1
+    finally:
+        app.dependency_overrides.clear()
+
+
+BULK_EMAILS = [
+    "a@example.com",
+    "b@example.com",
+    "a@example.com",  # repeated inside the first chunk
+    "taken@example.com",  # already registered
+    "c@example.com",
+    "b@example.com",  # repeated from an earlier chunk
+    "d@example.com",
+]
+BULK_TITLES = [f"Item {n}" for n in range(7)]
+
+
+def check_bulk_create(ids, duplicates, emails, item_ids, items):
+    """``emails`` of the users ``ids``, ``items`` by id."""
+    assert duplicates == ["a@example.com", "taken@example.com", "b@example.com"]
+    # The returned ids follow the input order.
+    assert emails == ["a@example.com", "b@example.com", "c@example.com", "d@example.com"]
+    assert [items[item_id].title for item_id in item_ids] == BULK_TITLES
+    assert all(items[item_id].owner_id == ids[0] for item_id in item_ids)
+
+
+def test_bulk_create():
+    test_engine = create_engine(
+        "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
+    )
+    models.init_db(bind=test_engine)
+    crud.user_cache.clear()
+    users = [schemas.UserCreate(email=email, password="x") for email in BULK_EMAILS]
+    items = [schemas.ItemCreate(title=title) for title in BULK_TITLES]
+    with sessionmaker(bind=test_engine)() as db:
+        crud.create_user(db, schemas.UserCreate(email="taken@example.com", password="x"))
+        ids, duplicates = crud.create_users(db, users, chunk_size=3)
+        item_ids = crud.create_user_items(db, items, ids[0], chunk_size=3)
+        check_bulk_create(
+            ids,
+            duplicates,
+            [crud.get_user(db, user_id).email for user_id in ids],
+            item_ids,
+            {item.id: item for item in crud.get_items(db)},
+        )
+
+
+def test_async_bulk_create():
+    import asyncio
+    import tempfile
+
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from . import async_crud
+
+    async def run(path):
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        users = [schemas.UserCreate(email=email, password="x") for email in BULK_EMAILS]
+        items = [schemas.ItemCreate(title=title) for title in BULK_TITLES]
+        try:
+            async with AsyncSession(engine, expire_on_commit=False) as db:
+                await async_crud.create_user(
+                    db, schemas.UserCreate(email="taken@example.com", password="x")
+                )
+                ids, duplicates = await async_crud.create_users(db, users, chunk_size=3)
+                item_ids = await async_crud.create_user_items(db, items, ids[0], chunk_size=3)
+                emails = [(await async_crud.get_user(db, user_id)).email for user_id in ids]
+                found = {item.id: item for item in await async_crud.get_items(db)}
+            check_bulk_create(ids, duplicates, emails, item_ids, found)
+        finally:
+            await engine.dispose()
+
+    crud.user_cache.clear()
+    with tempfile.TemporaryDirectory() as directory:
+        path = f"{directory}/bulk.db"
+        models.init_db(bind=create_engine(f"sqlite:///{path}"))
+        asyncio.run(run(path))
@@ -1,7 +1,7 @@
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, String
 from sqlalchemy.orm import relationship
 
-from .database import Base
+from .database import Base, engine
 
 class User(Base):
     __tablename__ = "users"
@@ -24,4 +24,18 @@ class Item(Base):
     
     owner = relationship("User", back_populates="items")
     
-    
\ No newline at end of file
+    
+
+def init_db(bind=engine):
+    """Create the tables that don't exist yet.
+
+    Called from the apps' lifespan, not at import, so importing them (a
+    worker starting, a test, a script using the models) doesn't touch the
+    database. Run it on its own as a migrate step with
+    `python -m sql_app.models`.
+    """
+    Base.metadata.create_all(bind=bind)
+
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,40 @@
+import base64
+
+from fastapi import HTTPException, Response
+
+# Keyset ("cursor") pagination on the primary key. A page is
+# ``WHERE id > :after_id ORDER BY id LIMIT :limit``, which the id index
+# answers directly, where ``OFFSET :skip`` has to walk and throw away every
+# skipped row first. The cursor handed to clients is opaque, they just send
+# back the X-Next-Cursor header of the previous page.
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    """Return the id a cursor points after, ValueError if it isn't one of ours."""
+    padded = cursor + "=" * (-len(cursor) % 4)
+    prefix, _, value = base64.urlsafe_b64decode(padded).decode().partition(":")
+    if prefix != "id" or not value.isdigit():
+        raise ValueError(f"invalid cursor: {cursor!r}")
+    return int(value)
+
+
+# Dependency
+def cursor_query(cursor: str | None = None) -> int | None:
+    if cursor is None:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def set_next_cursor(response: Response, rows, limit: int):
+    # A short page is the last one, anything else may have more after it.
+    if rows and len(rows) == limit:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(rows[-1].id)
@@ -32,4 +32,9 @@ class User(UserBase):
     items: list[Item] = []
     
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+
+class BulkCreated(BaseModel):
+    ids: list[int]
+    duplicates: list[str] = []
@@ -1,6 +1,514 @@
+import email.utils
+import hashlib
+import mimetypes
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 
-app = FastAPI()
+# StaticFiles stats every file on every request in a thread, sends an ETag made
+# of mtime and size, has no Cache-Control, and always reads the file through
+# Python. CachedStaticFiles below is a drop-in mount that keeps an index of the
+# directory in memory instead:
+#
+# - size, mtime and a strong ETag (a hash of the content) for every file,
+#   built at startup on a thread (``await mount.startup()`` from the app's
+#   lifespan) and checked again against the disk at most every
+#   ``refresh_interval`` seconds per file, so edits show up. A file is
+#   stat'ed once more as it's opened, so a change since the last check never
+#   goes out with the old Content-Length
+# - If-None-Match / If-Modified-Since answered with 304
+# - single byte ranges (Range, If-Range), answered with 206 or 416
+# - prebuilt ``.br`` / ``.gz`` siblings served with Content-Encoding when the
+#   client accepts them
+# - small files kept in an LRU of bodies
+# - larger files handed to the server with the ASGI zerocopysend or pathsend
+#   extension when it offers one, read in chunks otherwise
+
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+@dataclass
+class Entry:
+    path: str
+    size: int
+    mtime_ns: int
+    etag: str
+    content_type: str
+    checked: float
+    # Content-Encoding -> Entry of the precompressed sibling.
+    variants: dict = field(default_factory=dict)
+
+    @property
+    def last_modified(self) -> str:
+        return email.utils.formatdate(self.mtime_ns / 1e9, usegmt=True)
+
+
+def open_fresh(entry: "Entry"):
+    """Open ``entry.path``, None if the file no longer matches the entry."""
+    f = open(entry.path, "rb")
+    stat = os.fstat(f.fileno())
+    if (stat.st_size, stat.st_mtime_ns) != (entry.size, entry.mtime_ns):
+        f.close()
+        return None
+    return f
+
+
+def strong_etag(path: str) -> str:
+    with open(path, "rb") as f:
+        return '"' + hashlib.file_digest(f, "sha256").hexdigest()[:32] + '"'
+
+
+def accepted_encodings(header: str) -> set:
+    accepted = set()
+    for token in header.split(","):
+        name, *params = token.split(";")
+        if any(param.replace(" ", "").rstrip("0") in ("q=", "q=0.") for param in params):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def parse_range(header: str, size: int):
+    """(start, end) inclusive for a single ``bytes=`` range, None to ignore it.
+
+    Raises ValueError when the range can't be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        # Multiple ranges are allowed to get the whole file instead.
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash or not (first or last):
+        return None
+    if not (first or "0").isdigit() or not (last or "0").isdigit():
+        return None
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise ValueError(header)
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+class CachedStaticFiles:
+    """Serve ``directory`` from an in-memory index, see the notes above."""
+
+    chunk_size = 64 * 1024
+
+    def __init__(
+        self,
+        directory: str,
+        refresh_interval: float = 1.0,
+        cache_control: str | None = "public, max-age=3600",
+        max_cached_file: int = 64 * 1024,
+        max_cache_bytes: int = 32 * 1024**2,
+        check_dir: bool = True,
+    ):
+        if check_dir and not os.path.isdir(directory):
+            raise RuntimeError(f"Directory '{directory}' does not exist")
+        self.directory = os.path.realpath(directory)
+        self.refresh_interval = refresh_interval
+        self.cache_control = cache_control
+        self.max_cached_file = max_cached_file
+        self.max_cache_bytes = max_cache_bytes
+        # (path, etag) -> body, least recently used first.
+        self.bodies = OrderedDict()
+        self.cached_bytes = 0
+        # Filled by startup(), until then each file is loaded on first use.
+        self.index = {}
+
+    async def startup(self):
+        await run_in_threadpool(self.scan)
+
+    def scan(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                key = os.path.relpath(os.path.join(root, name), self.directory)
+                self.load(key.replace(os.sep, "/"))
+
+    def resolve(self, key: str) -> str | None:
+        path = os.path.realpath(os.path.join(self.directory, key))
+        if os.path.commonpath([path, self.directory]) != self.directory:
+            return None
+        return path
+
+    def stat_entry(self, path: str, old: "Entry | None", now: float) -> "Entry | None":
+        try:
+            stat = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        if not os.path.isfile(path):
+            return None
+        if old is not None and (old.size, old.mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+            old.checked = now
+            return old
+        content_type, _ = mimetypes.guess_type(path)
+        return Entry(
+            path=path,
+            size=stat.st_size,
+            mtime_ns=stat.st_mtime_ns,
+            etag=strong_etag(path),
+            content_type=content_type or "application/octet-stream",
+            checked=now,
+        )
+
+    def load(self, key: str) -> "Entry | None":
+        """Check ``key`` and its siblings against the disk and update the index."""
+        path = self.resolve(key)
+        old = self.index.get(key)
+        now = time.monotonic()
+        entry = self.stat_entry(path, old, now) if path else None
+        if entry is None:
+            self.index.pop(key, None)
+            return None
+        variants = {}
+        for encoding, suffix in ENCODINGS.items():
+            variant = self.stat_entry(path + suffix, entry.variants.get(encoding), now)
+            if variant is not None:
+                # The sibling describes the same resource as the original.
+                variant.content_type = entry.content_type
+                variants[encoding] = variant
+        entry.variants = variants
+        self.index[key] = entry
+        return entry
+
+    async def lookup(self, key: str) -> "Entry | None":
+        entry = self.index.get(key)
+        if entry is not None and time.monotonic() - entry.checked < self.refresh_interval:
+            return entry
+        return await run_in_threadpool(self.load, key)
+
+    def cached_body(self, entry: Entry) -> bytes | None:
+        cache_key = (entry.path, entry.etag)
+        body = self.bodies.get(cache_key)
+        if body is not None:
+            self.bodies.move_to_end(cache_key)
+        return body
+
+    def cache_body(self, entry: Entry, body: bytes):
+        if entry.size > self.max_cached_file:
+            return
+        self.bodies[(entry.path, entry.etag)] = body
+        self.cached_bytes += len(body)
+        while self.cached_bytes > self.max_cache_bytes:
+            _, evicted = self.bodies.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+    async def __call__(self, scope, receive, send):
+        assert scope["type"] == "http"
+        headers = {}
+        for name, value in scope["headers"]:
+            headers[name.decode("latin-1")] = value.decode("latin-1")
+        if scope["method"] not in ("GET", "HEAD"):
+            await self.respond(send, 405, [(b"allow", b"GET, HEAD")], b"Method Not Allowed")
+            return
+        # Mount has already stripped its own prefix from the path.
+        key = scope["path"].lstrip("/")
+        await self.serve(scope, send, headers, key, recheck=True)
+
+    async def serve(self, scope, send, headers: dict, key: str, recheck: bool):
+        entry = await self.lookup(key) if key and ".." not in key.split("/") else None
+        if entry is None:
+            await self.respond(send, 404, [], b"Not Found")
+            return
+
+        range_header = headers.get("range")
+        if_range = headers.get("if-range")
+        if range_header and if_range and if_range not in (entry.etag, entry.last_modified):
+            range_header = None
+        selected, encoding = entry, None
+        if not range_header:
+            accepted = accepted_encodings(headers.get("accept-encoding", ""))
+            for name, variant in entry.variants.items():
+                if name in accepted:
+                    selected, encoding = variant, name
+                    break
+
+        response_headers = [
+            (b"etag", selected.etag.encode()),
+            (b"last-modified", entry.last_modified.encode()),
+            (b"accept-ranges", b"bytes"),
+        ]
+        if self.cache_control:
+            response_headers.append((b"cache-control", self.cache_control.encode()))
+        if entry.variants:
+            response_headers.append((b"vary", b"Accept-Encoding"))
+
+        if self.not_modified(headers, selected, entry):
+            await self.respond(send, 304, response_headers, b"")
+            return
+
+        response_headers.append((b"content-type", selected.content_type.encode()))
+        if encoding:
+            response_headers.append((b"content-encoding", encoding.encode()))
+        status, start, end = 200, 0, selected.size - 1
+        if range_header:
+            try:
+                requested = parse_range(range_header, selected.size)
+            except ValueError:
+                response_headers.append((b"content-range", f"bytes */{selected.size}".encode()))
+                await self.respond(send, 416, response_headers, b"")
+                return
+            if requested is not None:
+                status, (start, end) = 206, requested
+                response_headers.append(
+                    (b"content-range", f"bytes {start}-{end}/{selected.size}".encode())
+                )
+        count = end - start + 1
+        body = f = None
+        if scope["method"] != "HEAD" and count > 0:
+            body = self.cached_body(selected)
+            if body is None:
+                f = await run_in_threadpool(open_fresh, selected)
+                if f is None and recheck:
+                    # Changed since the last check, check it now and start over.
+                    entry.checked = float("-inf")
+                    await self.serve(scope, send, headers, key, recheck=False)
+                    return
+                if f is None:
+                    # Still changing under us: send what's there, cut to the
+                    # announced length.
+                    f = await run_in_threadpool(open, selected.path, "rb")
+        try:
+            response_headers.append((b"content-length", str(count).encode()))
+            await send(
+                {"type": "http.response.start", "status": status, "headers": response_headers}
+            )
+            if f is None and body is None:
+                await send({"type": "http.response.body", "body": b""})
+                return
+            await self.send_body(scope, send, selected, start, count, body, f)
+        finally:
+            if f is not None:
+                await run_in_threadpool(f.close)
+
+    def not_modified(self, headers: dict, selected: Entry, entry: Entry) -> bool:
+        if_none_match = headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return "*" in tags or selected.etag in tags
+        if_modified_since = headers.get("if-modified-since")
+        if if_modified_since:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return entry.mtime_ns // 10**9 <= since
+        return False
+
+    async def send_body(self, scope, send, entry: Entry, start: int, count: int, body, f):
+        """Send ``count`` bytes from ``start``, of the cached ``body`` or the open ``f``."""
+        if body is None and entry.size <= self.max_cached_file:
+            body = await run_in_threadpool(f.read)
+            self.cache_body(entry, body)
+        if body is not None:
+            await send({"type": "http.response.body", "body": body[start : start + count]})
+            return
+        extensions = scope.get("extensions") or {}
+        if "http.response.pathsend" in extensions and start == 0 and count == entry.size:
+            await send({"type": "http.response.pathsend", "path": entry.path})
+            return
+        if "http.response.zerocopysend" in extensions:
+            await send(
+                {
+                    "type": "http.response.zerocopysend",
+                    "file": f,
+                    "offset": start,
+                    "count": count,
+                }
+            )
+            return
+        await run_in_threadpool(f.seek, start)
+        while count > 0:
+            chunk = await run_in_threadpool(f.read, min(self.chunk_size, count))
+            if not chunk:
+                break
+            count -= len(chunk)
+            await send({"type": "http.response.body", "body": chunk, "more_body": count > 0})
+        if count > 0:
+            # The file shrank underneath us, end the response anyway.
+            await send({"type": "http.response.body", "body": b""})
+
+    async def respond(self, send, status: int, headers: list, body: bytes):
+        if body:
+            headers = [
+                *headers,
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ]
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": body})
+
+
+# check_dir=False so the app still starts (and 404s) before static/ exists.
+static = CachedStaticFiles(directory="static", check_dir=False)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Mounted apps get no lifespan events of their own.
+    await static.startup()
+    yield
+
+
+app = FastAPI(lifespan=lifespan)
+app.mount("/static", static, name="static")
+
+
+def test_cached_static_files():
+    import asyncio
+    import gzip
+    import tempfile
+
+    from fastapi.testclient import TestClient
+
+    with tempfile.TemporaryDirectory() as directory:
+        body = b"console.log('hello');\n" * 100
+        with open(os.path.join(directory, "app.js"), "wb") as f:
+            f.write(body)
+        with open(os.path.join(directory, "app.js.gz"), "wb") as f:
+            f.write(gzip.compress(body))
+        test_app = FastAPI()
+        test_app.mount("/static", CachedStaticFiles(directory, refresh_interval=0))
+        client = TestClient(test_app)
+
+        response = client.get("/static/app.js", headers={"Accept-Encoding": "identity"})
+        assert response.status_code == 200
+        assert response.content == body
+        assert response.headers["content-type"].startswith("text/javascript")
+        assert response.headers["vary"] == "Accept-Encoding"
+        etag = response.headers["etag"]
+
+        response = client.get(
+            "/static/app.js", headers={"Accept-Encoding": "identity", "If-None-Match": etag}
+        )
+        assert response.status_code == 304
+
+        response = client.get("/static/app.js", headers={"Accept-Encoding": "gzip"})
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.headers["etag"] != etag
+        assert response.content == body  # httpx decodes it
+
+        response = client.get("/static/app.js", headers={"Range": "bytes=0-6"})
+        assert response.status_code == 206
+        assert response.content == b"console"
+        assert response.headers["content-range"] == f"bytes 0-6/{len(body)}"
+        response = client.get("/static/app.js", headers={"Range": f"bytes={len(body)}-"})
+        assert response.status_code == 416
+
+        # Changes on disk replace the ETag and the cached body.
+        with open(os.path.join(directory, "app.js"), "wb") as f:
+            f.write(b"changed")
+        response = client.get("/static/app.js", headers={"Accept-Encoding": "identity"})
+        assert response.content == b"changed"
+        assert response.headers["etag"] != etag
+
+        assert client.get("/static/../static-files.py").status_code == 404
+        assert client.get("/static/missing.js").status_code == 404
+
+        # Within refresh_interval, a file changed on disk is still sent with
+        # its own length, not the indexed one.
+        big = os.path.join(directory, "big.bin")
+        with open(big, "wb") as f:
+            f.write(b"x" * 100_000)
+        mount = CachedStaticFiles(directory, refresh_interval=3600, max_cached_file=1000)
+        asyncio.run(mount.startup())
+        assert mount.index["big.bin"].size == 100_000
+        test_app.routes.clear()
+        test_app.mount("/static", mount)
+        with open(big, "ab") as f:
+            f.write(b"y" * 10)
+        response = client.get("/static/big.bin")
+        assert response.headers["content-length"] == "100010"
+        assert response.content == b"x" * 100_000 + b"y" * 10
+
+
+def http_scope(path: str, headers: dict):
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        "client": ("127.0.0.1", 50000),
+        "server": ("bench", 80),
+    }
+
+
+async def drive(static_app, requests: int, path: str, headers: dict):
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        await static_app(http_scope(path, headers), receive, send)
+    return (time.perf_counter() - start) / requests
+
+
+async def bench(args):
+    """Mean time per request for StaticFiles and CachedStaticFiles."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name, size in (("small.css", 4 * 1024), ("large.bin", 4 * 1024**2)):
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(os.urandom(size))
+        mounts = {
+            "StaticFiles": StaticFiles(directory=directory),
+            "CachedStaticFiles": CachedStaticFiles(directory),
+        }
+        await mounts["CachedStaticFiles"].startup()
+        etags = {label: (await etag_of(mount, "/small.css")) for label, mount in mounts.items()}
+        cases = {
+            "4 KiB file": ("/small.css", lambda label: {}),
+            "4 KiB file, 304": ("/small.css", lambda label: {"If-None-Match": etags[label]}),
+            "4 MiB file": ("/large.bin", lambda label: {}),
+            "4 MiB file, 64 KiB range": ("/large.bin", lambda label: {"Range": "bytes=0-65535"}),
+        }
+        for case, (path, headers) in cases.items():
+            for label, mount in mounts.items():
+                requests = args.requests // 10 if case == "4 MiB file" else args.requests
+                await drive(mount, min(100, requests), path, headers(label))
+                per_request = await drive(mount, requests, path, headers(label))
+                print(f"{case:<26} {label:<18} {per_request * 1e6:9.1f} us/request")
+
+
+async def etag_of(static_app, path: str) -> str:
+    headers = {}
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            headers.update((k.decode(), v.decode()) for k, v in message["headers"])
+
+    await static_app(http_scope(path, {}), receive, send)
+    return headers["etag"]
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Benchmarks for this app.")
+    parser.add_argument("--requests", type=int, default=2000)
+    asyncio.run(bench(parser.parse_args()))